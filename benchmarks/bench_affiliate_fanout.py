@@ -0,0 +1,90 @@
+"""
+Product search latency with sequential vs concurrent (fan-out) provider calls.
+
+Registers local fake affiliate providers with configurable latency, jitter and failure
+rate, then runs uncached searches (a distinct query each time) two ways:
+- sequential: one provider after the other, each within its own deadline
+- fanout: affiliate_manager.search_platforms, all providers concurrently
+
+Usage: python -m benchmarks.bench_affiliate_fanout [--latencies 0.3,0.5,0.8] [--failure-rate 0.1]
+                                                   [--timeout 1.0] [--searches 20]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.stub_servers import percentile
+
+
+async def run(args):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    from src import affiliate_manager, db_manager
+    from src.models import SessionLocal
+
+    class FakeProvider(affiliate_manager.AffiliateProvider):
+        def __init__(self, name, latency, rng):
+            self.name = name
+            self.latency = latency
+            self.rng = rng
+            super().__init__(timeout=args.timeout)
+
+        async def search(self, query, limit, country="BR"):
+            await asyncio.sleep(self.latency * self.rng.uniform(1 - args.jitter, 1 + args.jitter))
+            if self.rng.random() < args.failure_rate:
+                raise RuntimeError("fake provider error")
+            return [
+                {"external_id": f"{self.name}-{query}-{i}", "name": f"{query} item {i}", "price": float(50 + i * 10 + len(self.name))}
+                for i in range(limit)
+            ]
+
+    db_manager.init_db()
+    db = SessionLocal()
+    rng = random.Random(args.seed)
+    latencies = [float(value) for value in args.latencies.split(",")]
+    for registry in (affiliate_manager.providers, affiliate_manager.breakers, affiliate_manager.provider_stats):
+        registry.clear()
+    for index, latency in enumerate(latencies):
+        affiliate_manager.register_provider(FakeProvider(f"fake{index}", latency, rng))
+    for breaker in affiliate_manager.breakers.values():
+        breaker.failure_threshold = 10 ** 9 # Measure raw latency, not the breaker
+
+    results = {}
+    for mode in ("sequential", "fanout"):
+        samples, counts = [], []
+        for run_index in range(args.searches):
+            query = f"{mode} query {run_index}"
+            started = time.perf_counter()
+            if mode == "sequential":
+                found = 0
+                for provider in affiliate_manager.providers.values():
+                    items = await affiliate_manager.query_provider(provider, query, affiliate_manager.SEARCH_PAGE_SIZE)
+                    found += len(items or [])
+            else:
+                per_platform = await affiliate_manager.search_platforms(db, query, limit=5)
+                found = sum(len(products) for products in per_platform.values())
+            samples.append(time.perf_counter() - started)
+            counts.append(found)
+        results[mode] = (samples, sum(counts) / len(counts))
+    db.close()
+
+    print(f"\nproviders latency={latencies} jitter=±{args.jitter:.0%} failure_rate={args.failure_rate} "
+          f"deadline={args.timeout}s searches={args.searches}")
+    for mode, (samples, count) in results.items():
+        print(f"{mode:10}  p50={percentile(samples, 50) * 1000:7.1f}ms  p95={percentile(samples, 95) * 1000:7.1f}ms  "
+              f"max={max(samples) * 1000:7.1f}ms  products/search={count:.1f}")
+    print(affiliate_manager.get_search_metrics()["providers"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latencies", default="0.3,0.5,0.8", help="Comma separated mean latency (s) of each fake provider")
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--failure-rate", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=1.0, help="Per provider deadline (s)")
+    parser.add_argument("--searches", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(run(parser.parse_args()))
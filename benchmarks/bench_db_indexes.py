@@ -0,0 +1,139 @@
+"""
+Query latency on large tables: per-user history with and without the composite indexes,
+and OFFSET vs keyset pagination of the admin user list.
+
+Seeds --users users, --messages messages and --wishlist wishlist items (random users,
+increasing timestamps) into a temporary SQLite file (or --database-url), then measures:
+- get_user_messages / get_wishlist_items for random users, before and after creating
+  ix_messages_user_id_timestamp / ix_wishlist_items_user_id_added_at (with the query plan)
+- the admin user list at increasing depths: OFFSET (old, by created_at and by id) vs
+  db_manager.list_users (keyset)
+
+Usage: python -m benchmarks.bench_db_indexes [--users 100000] [--messages 2000000] [--wishlist 300000]
+                                             [--queries 50] [--database-url URL]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.stub_servers import percentile
+
+BATCH = 50_000
+
+
+def seed(engine, args, rng):
+    from sqlalchemy import insert
+    from src.models import Message, User, WishlistItem
+
+    started = time.perf_counter()
+    epoch = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    with engine.begin() as conn:
+        for first in range(0, args.users, BATCH):
+            conn.execute(insert(User), [
+                {"id": i + 1, "whatsapp_id": f"55{i:09d}", "phone_number": f"55{i:09d}", "profile_name": f"User {i}",
+                 "created_at": epoch + timedelta(seconds=i * 60)}
+                for i in range(first, min(first + BATCH, args.users))
+            ])
+    for table, total, make_row in (
+        (Message, args.messages, lambda i: {"user_id": rng.randrange(args.users) + 1, "whatsapp_message_id": f"wamid.{i}",
+                                            "content": "quero um tênis de corrida", "sender": "user" if i % 2 else "assistant",
+                                            "timestamp": epoch + timedelta(seconds=i)}),
+        (WishlistItem, args.wishlist, lambda i: {"user_id": rng.randrange(args.users) + 1, "product_id": f"p{rng.randrange(50_000)}",
+                                                 "product_name": "Tênis", "added_at": epoch + timedelta(seconds=i * 5)}),
+    ):
+        for first in range(0, total, BATCH):
+            with engine.begin() as conn:
+                conn.execute(insert(table), [make_row(i) for i in range(first, min(first + BATCH, total))])
+    print(f"seeded {args.users} users, {args.messages} messages, {args.wishlist} wishlist items in {time.perf_counter() - started:.1f}s")
+
+
+def query_plan(engine, sql):
+    from sqlalchemy import text
+
+    prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    with engine.connect() as conn:
+        return " | ".join(str(row[-1]) for row in conn.execute(text(prefix + sql)))
+
+
+def time_queries(fn, user_ids):
+    samples = []
+    for user_id in user_ids:
+        started = time.perf_counter()
+        fn(user_id)
+        samples.append((time.perf_counter() - started) * 1000)
+    return percentile(samples, 50), percentile(samples, 95)
+
+
+def main(args):
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    from sqlalchemy import text
+    from sqlalchemy.schema import CreateIndex
+    from src import db_manager
+    from src.models import Message, SessionLocal, User, WishlistItem, engine
+
+    rng = random.Random(args.seed)
+    db_manager.init_db()
+    indexes = {
+        "messages": next(index for index in Message.__table__.indexes if index.name == "ix_messages_user_id_timestamp"),
+        "wishlist": next(index for index in WishlistItem.__table__.indexes if index.name == "ix_wishlist_items_user_id_added_at"),
+    }
+    with engine.begin() as conn: # Seed and measure without them first
+        for index in indexes.values():
+            conn.execute(text(f"DROP INDEX {index.name}"))
+    seed(engine, args, rng)
+    if engine.dialect.name == "postgresql":
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("ANALYZE"))
+
+    user_ids = [rng.randrange(args.users) + 1 for _ in range(args.queries)]
+    plans = {
+        "messages": f"SELECT * FROM messages WHERE user_id = {user_ids[0]} ORDER BY timestamp DESC, id DESC LIMIT 20",
+        "wishlist": f"SELECT * FROM wishlist_items WHERE user_id = {user_ids[0]} ORDER BY added_at DESC",
+    }
+    with SessionLocal() as db:
+        lookups = {
+            "messages": lambda user_id: db_manager.get_user_messages(db, user_id, limit=20),
+            "wishlist": lambda user_id: db_manager.get_wishlist_items(db, user_id),
+        }
+        for name, index in indexes.items():
+            before = time_queries(lookups[name], user_ids)
+            before_plan = query_plan(engine, plans[name])
+            started = time.perf_counter()
+            with engine.begin() as conn:
+                conn.execute(CreateIndex(index))
+            built = time.perf_counter() - started
+            after = time_queries(lookups[name], user_ids)
+            print(f"\n{name}: without index p50={before[0]:8.2f}ms p95={before[1]:8.2f}ms  plan: {before_plan}")
+            print(f"{name}: with {index.name} (built in {built:.1f}s) p50={after[0]:8.2f}ms p95={after[1]:8.2f}ms  "
+                  f"plan: {query_plan(engine, plans[name])}")
+
+        print(f"\nadmin user list, {args.page_size} per page:")
+        for page in sorted({1, 10, 100, max(1, args.users // args.page_size - 1)}):
+            started = time.perf_counter()
+            db.query(User).order_by(User.created_at.desc()).offset((page - 1) * args.page_size).limit(args.page_size).all()
+            offset_ms = (time.perf_counter() - started) * 1000
+            started = time.perf_counter() # Same order as the keyset, to isolate the cost of skipping rows
+            db.query(User).order_by(User.id.desc()).offset((page - 1) * args.page_size).limit(args.page_size).all()
+            offset_id_ms = (time.perf_counter() - started) * 1000
+            # Keyset: the cursor of the previous page is the last id it showed
+            before_id = args.users - (page - 1) * args.page_size + 1 if page > 1 else None
+            started = time.perf_counter()
+            db_manager.list_users(db, limit=args.page_size, before_id=before_id)
+            keyset_ms = (time.perf_counter() - started) * 1000
+            print(f"page {page:6}  offset(created_at)={offset_ms:8.2f}ms  offset(id)={offset_id_ms:7.2f}ms  keyset={keyset_ms:6.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--wishlist", type=int, default=300_000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--database-url", default=None, help="Defaults to a temporary SQLite file")
+    parser.add_argument("--seed", type=int, default=42)
+    main(parser.parse_args())
@@ -0,0 +1,120 @@
+"""
+Intent pre-classifier: accuracy and cost of intent_classifier.classify, and what it saves
+end to end.
+
+1. Classifies a labelled sample of typical messages and reports accuracy, the confusions
+   and microseconds per message.
+2. Runs respond_to_message for a greeting, a thank-you and a product search against a
+   local stub OpenAI server (--llm-latency) and a fake Graph API, with recommendations that
+   take --retrieval-latency, with the classifier off (the LLM answers everything and
+   retrieval starts after the reply) and on. Reports LLM calls and time until the last
+   WhatsApp message.
+
+Usage: python -m benchmarks.bench_intent_classifier [--llm-latency 0.8] [--retrieval-latency 0.4] [--runs 3]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.stub_servers import make_graph_api_stub, make_openai_stub, serve_in_thread
+
+LABELLED = [
+    ("oi", "greeting"), ("Oi!", "greeting"), ("olá", "greeting"), ("bom dia", "greeting"), ("Boa noite!!", "greeting"),
+    ("e aí, tudo bem?", "greeting"), ("opa", "greeting"), ("oie tudo bom", "greeting"),
+    ("obrigado", "thanks"), ("obrigada!", "thanks"), ("valeu", "thanks"), ("vlw, tchau", "thanks"),
+    ("muito obrigado pela ajuda", "thanks"), ("perfeito, obrigada", "thanks"), ("até mais", "thanks"),
+    ("quero um tênis de corrida", "product_search"), ("procuro um presente para minha mãe", "product_search"),
+    ("tem fone bluetooth até R$ 200?", "product_search"), ("me indica um notebook para estudar", "product_search"),
+    ("oi, quero uma bolsa de couro", "product_search"), ("preciso de um vestido para casamento", "product_search"),
+    ("qual o melhor celular até 1500 reais", "product_search"), ("sugestões de perfume masculino", "product_search"),
+    ("queria comprar uma airfryer", "product_search"), ("boa tarde, estou procurando uma mochila", "product_search"),
+    ("qual a diferença entre os dois?", "other"), ("mais opções", "other"), ("e a entrega demora quanto?", "other"),
+    ("não gostei", "other"), ("ok", "other"), ("pode ser", "other"), ("o segundo é de qual marca?", "other"),
+    ("meu número é 42", "other"), ("oi, cadê meu pedido?", "other"), ("bom dia, qual o status", "other"),
+    ("obrigado mas não gostei", "other"), ("tudo bem?", "greeting"), ("oi, ok", "greeting"),
+]
+
+REPLY = "Encontrei algumas opções que combinam com o que você pediu. Vou te mandar as melhores!"
+
+
+def classifier_report():
+    from src import intent_classifier
+
+    wrong = [(text, label, intent_classifier.classify(text)) for text, label in LABELLED]
+    wrong = [item for item in wrong if item[1] != item[2]]
+    print(f"accuracy: {1 - len(wrong) / len(LABELLED):.1%} on {len(LABELLED)} labelled messages")
+    for text, label, predicted in wrong:
+        print(f"  {text!r}: expected {label}, got {predicted}")
+    repeat = 20_000
+    started = time.perf_counter()
+    for index in range(repeat):
+        intent_classifier.classify(LABELLED[index % len(LABELLED)][0])
+    print(f"classify: {(time.perf_counter() - started) / repeat * 1e6:.1f}us per message\n")
+
+
+async def run(args):
+    openai_url, openai_server = serve_in_thread(make_openai_stub(latency=args.llm_latency, reply=REPLY))
+    graph = make_graph_api_stub(latency=0.01)
+    graph_url, graph_server = serve_in_thread(graph)
+    os.environ.update({
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "WHATSAPP_API_BASE_URL": graph_url,
+        "WHATSAPP_API_TOKEN": "stub",
+        "WHATSAPP_PHONE_NUMBER_ID": "1234",
+        "DATABASE_URL": f"sqlite:///{tempfile.mkdtemp()}/bench.db",
+        "RESPONSE_CACHE_ENABLED": "false",
+        "PROFILE_EXTRACTION_ENABLED": "false", # Background extraction calls would add to the completions measured
+        "LLM_TOOLS_ENABLED": "false", # Retrieval next to the LLM call; with tools the model searches (bench_tool_calling)
+    })
+    from src import ai_service, db_manager, whatsapp_handler
+    from src.config import settings
+    from src.models import AsyncSessionLocal, async_engine
+    from src.recommendation_engine import RecommendedProduct
+
+    classifier_report()
+
+    async def fake_recommendations(user, query, db, num_recommendations=3, offset=0, max_price=None):
+        await asyncio.sleep(args.retrieval_latency)
+        return [RecommendedProduct(id=f"p{i}", name=f"Produto {i}", price="R$ 199,90", image_url=None, affiliate_link="#")
+                for i in range(num_recommendations)]
+
+    whatsapp_handler.get_recommendations = fake_recommendations
+    settings.STREAMING_REPLIES = False
+    db_manager.init_db()
+    db = AsyncSessionLocal()
+    user = await db_manager.create_user_async(db, phone_number="5511999990000", whatsapp_id="5511999990000", profile_name="Ana")
+
+    arrivals = graph.state.arrivals
+    print(f"llm_latency={args.llm_latency}s retrieval_latency={args.retrieval_latency}s runs={args.runs}")
+    for enabled in (False, True):
+        settings.INTENT_CLASSIFIER_ENABLED = enabled
+        for content in ("oi", "obrigado!", "quero um tênis de corrida"):
+            llm_calls, elapsed, messages = 0, 0.0, 0
+            for run_index in range(args.runs):
+                message = {"phone_number": user.phone_number, "whatsapp_id": user.whatsapp_id, "profile_name": "Ana", "content": content,
+                           "whatsapp_message_id": f"wamid.{enabled}.{content}.{run_index}"}
+                arrivals.clear()
+                completed = ai_service.llm_stats["completed"]
+                started = time.perf_counter()
+                await whatsapp_handler.respond_to_message(db, user.id, message)
+                elapsed += time.perf_counter() - started
+                llm_calls += ai_service.llm_stats["completed"] - completed
+                messages += len(arrivals)
+            print(f"classifier={'on ' if enabled else 'off'}  {content!r:28} llm_calls={llm_calls / args.runs:.0f}  "
+                  f"messages={messages / args.runs:.0f}  time-to-last-message={elapsed / args.runs * 1000:7.1f}ms")
+
+    await db.close()
+    await async_engine.dispose() # aiosqlite connection threads would keep the process alive
+    openai_server.should_exit = graph_server.should_exit = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--retrieval-latency", type=float, default=0.4)
+    parser.add_argument("--runs", type=int, default=3)
+    asyncio.run(run(parser.parse_args()))
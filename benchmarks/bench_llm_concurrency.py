@@ -0,0 +1,90 @@
+"""
+Webhook p99 latency while LLM calls are saturated.
+
+Starts a local stub OpenAI server with a fixed completion latency, keeps
+``--conversations`` get_ai_response calls in flight and probes the webhook
+endpoint meanwhile. ``--mode blocking`` reproduces the old synchronous client
+for comparison.
+
+Usage: python -m benchmarks.bench_llm_concurrency [--mode async|blocking] [--conversations 50] [--llm-latency 1.0]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.stub_servers import make_openai_stub, percentile, serve_in_thread
+
+STATUS_PAYLOAD = {
+    "object": "whatsapp_business_account",
+    "entry": [{"id": "1", "changes": [{"field": "messages", "value": {
+        "messaging_product": "whatsapp", "metadata": {}, "statuses": [{"id": "wamid.x", "status": "delivered"}],
+    }}]}],
+}
+
+
+async def run(args):
+    base_url, server = serve_in_thread(make_openai_stub(latency=args.llm_latency))
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ["OPENAI_MAX_CONCURRENCY"] = str(args.conversations)
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+
+    import httpx
+    import openai
+    from src import ai_service, db_manager
+    from src.main import app
+    from src.models import AsyncSessionLocal, async_engine, SessionLocal
+
+    if args.mode == "blocking":
+        sync_client = openai.OpenAI(api_key="stub", base_url=f"{base_url}/v1")
+
+        async def blocking_completion(**kwargs):
+            kwargs.setdefault("model", "gpt-4o-mini")
+            return sync_client.chat.completions.create(**kwargs)
+
+        ai_service.create_chat_completion = blocking_completion
+
+    with SessionLocal() as sync_db:
+        user = db_manager.create_user(sync_db, phone_number="5511999990000", whatsapp_id="5511999990000")
+    db = AsyncSessionLocal()
+    # Load the user and their history once: the concurrent turns below then share the session
+    # without querying (an AsyncSession cannot run concurrent queries), which keeps the
+    # benchmark from measuring DB pool exhaustion instead of the LLM client
+    await ai_service.prepare_conversation(db, user.id, "quero um tênis barato")
+
+    async def conversation():
+        await ai_service.get_ai_response(user_id=user.id, user_message="quero um tênis barato", db=db)
+
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as http:
+        started = time.perf_counter()
+        llm_tasks = [asyncio.create_task(conversation()) for _ in range(args.conversations)]
+        while not all(task.done() for task in llm_tasks):
+            t0 = time.perf_counter()
+            await http.post("/whatsapp/webhook", json=STATUS_PAYLOAD)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*llm_tasks)
+        elapsed = time.perf_counter() - started
+
+    await db.close()
+    await async_engine.dispose() # aiosqlite connection threads would keep the process alive
+    await ai_service.close_client()
+    server.should_exit = True
+
+    print(f"\nmode={args.mode} conversations={args.conversations} llm_latency={args.llm_latency}s")
+    print(f"all completions finished in {elapsed:.2f}s")
+    print(f"webhook probes: n={len(latencies)} p50={percentile(latencies, 50):.1f}ms "
+          f"p99={percentile(latencies, 99):.1f}ms max={max(latencies):.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["async", "blocking"], default="async")
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    asyncio.run(run(parser.parse_args()))
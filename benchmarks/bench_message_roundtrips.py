@@ -0,0 +1,140 @@
+"""
+Database round trips and time per inbound message (no LLM): legacy writes vs the unit of work.
+
+Stores --messages inbound texts from --users users (new users on their first message),
+each followed by an assistant reply, in webhook batches of 1 and of --batch-size messages,
+three ways:
+- legacy: the original per-message sequence (get_user_by_whatsapp_id, create_user with
+  commit + refresh, create_message with commit + refresh, history query, create_message
+  with commit + refresh)
+- unit_of_work: db_manager.record_inbound_batch for the whole batch (user upsert + message
+  insert, one commit), history from the conversation cache, each reply with create_message
+  (INSERT .. RETURNING + commit)
+- unit_of_work_async: the same with the AsyncSession functions used by the webhook
+
+and reports statements, commits (fsyncs) and milliseconds per message. Every reply still
+commits on its own (the inbound messages must be stored before the LLM call), so with one
+message per webhook the commits stay at ~2 per message and, on an fsync-bound disk, so does
+the time; the batch insert pays off when Meta packs several messages into one webhook.
+
+Usage: python -m benchmarks.bench_message_roundtrips [--users 50] [--messages 200] [--batch-size 5] [--database-url URL]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+
+def legacy_message(db, item):
+    """The per-message writes as they were before the unit of work."""
+    from src.db_manager import get_user_by_whatsapp_id
+    from src.models import Message, User
+
+    user = get_user_by_whatsapp_id(db, item["whatsapp_id"])
+    if user is None:
+        user = User(phone_number=item["phone_number"], whatsapp_id=item["whatsapp_id"], profile_name=item["profile_name"])
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+    for whatsapp_message_id, content, sender in ((item["whatsapp_message_id"], item["content"], "user"),
+                                                 (f"ai_{item['whatsapp_message_id']}", item["reply"], "assistant")):
+        message = Message(user_id=user.id, whatsapp_message_id=whatsapp_message_id, content=content, sender=sender)
+        db.add(message)
+        db.commit()
+        db.refresh(message)
+        if sender == "user":
+            db.query(Message).filter(Message.user_id == user.id).order_by(Message.timestamp.desc()).limit(20).all()
+
+
+def unit_of_work_batch(db, batch):
+    from src import context_builder, db_manager
+
+    users, _ = db_manager.record_inbound_batch(db, batch)
+    for item in batch:
+        user_id = users[item["whatsapp_id"]].id
+        context_builder.conversation_cache.get(user_id, lambda: db_manager.load_conversation_state(db, user_id))
+        db_manager.create_message(db, user_id, f"ai_{item['whatsapp_message_id']}", item["reply"], "assistant")
+
+
+async def unit_of_work_batch_async(db, batch):
+    from src import context_builder, db_manager
+
+    users, _ = await db_manager.record_inbound_batch_async(db, batch)
+    for item in batch:
+        user_id = users[item["whatsapp_id"]].id
+        await context_builder.conversation_cache.get_async(user_id, lambda: db_manager.load_conversation_state_async(db, user_id))
+        await db_manager.create_message_async(db, user_id, f"ai_{item['whatsapp_message_id']}", item["reply"], "assistant")
+
+
+def count_round_trips(engine, counters):
+    from sqlalchemy import event
+
+    event.listen(engine, "before_cursor_execute", lambda *args: counters.__setitem__("statements", counters["statements"] + 1))
+    event.listen(engine, "commit", lambda *args: counters.__setitem__("commits", counters["commits"] + 1))
+
+
+async def run(args):
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    from src import context_builder, db_manager
+    from src.models import AsyncSessionLocal, SessionLocal, async_engine, engine
+
+    db_manager.init_db()
+    counters = {"statements": 0, "commits": 0}
+    count_round_trips(engine, counters)
+    count_round_trips(async_engine.sync_engine, counters)
+    rng = random.Random(args.seed)
+    run_id = rng.randrange(10 ** 6) # Fresh users on every run, also against a persistent database
+
+    def workload(mode, batch_size):
+        """Webhook batches of `batch_size` messages."""
+        batch = []
+        for index in range(args.messages):
+            user = rng.randrange(args.users)
+            whatsapp_id = f"{run_id}{mode[:1]}{len(mode)}{batch_size}{user:05d}"
+            batch.append({"whatsapp_id": whatsapp_id, "phone_number": whatsapp_id, "profile_name": f"User {user}",
+                          "whatsapp_message_id": f"wamid.{whatsapp_id}.{index}", "content": "quero um tênis de corrida",
+                          "reply": "Claro! Qual o seu orçamento?", "metadata": None})
+            if len(batch) == batch_size or index == args.messages - 1:
+                yield batch
+                batch = []
+
+    results = {}
+    for batch_size in dict.fromkeys((1, args.batch_size)):
+        for mode in ("legacy", "unit_of_work", "unit_of_work_async"):
+            context_builder.conversation_cache._windows.clear()
+            context_builder.conversation_cache.size_bytes = 0
+            counters.update(statements=0, commits=0)
+            started = time.perf_counter()
+            if mode == "unit_of_work_async":
+                async with AsyncSessionLocal() as db:
+                    for batch in workload(mode, batch_size):
+                        await unit_of_work_batch_async(db, batch)
+            else:
+                # Like AsyncSessionLocal: reading the returned users after commit must not reload them
+                with SessionLocal(expire_on_commit=False) as db:
+                    for batch in workload(mode, batch_size):
+                        if mode == "legacy":
+                            for item in batch:
+                                legacy_message(db, item)
+                        else:
+                            unit_of_work_batch(db, batch)
+            elapsed = time.perf_counter() - started
+            results[batch_size, mode] = (counters["statements"] / args.messages, counters["commits"] / args.messages, elapsed / args.messages * 1000)
+
+    await async_engine.dispose() # aiosqlite connection threads would keep the process alive
+    print(f"\nusers={args.users} messages={args.messages} database={engine.url.get_backend_name()}")
+    for (batch_size, mode), (statements, commits, ms) in results.items():
+        print(f"batch={batch_size:<3} {mode:19} statements/msg={statements:5.2f}  commits/msg={commits:4.2f}  time/msg={ms:6.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=5, help="Messages per webhook batch (also run with 1)")
+    parser.add_argument("--database-url", default=None, help="Defaults to a temporary SQLite file")
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(run(parser.parse_args()))
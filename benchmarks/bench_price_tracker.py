@@ -0,0 +1,118 @@
+"""
+Wishlist price refresh at scale: one price_tracker cycle over --items wishlist items.
+
+Seeds --items wishlist items over --products distinct products (so several users share a
+product) on the registered platforms into a temporary SQLite file (or --database-url), with
+fake providers that answer get_prices after --latency-ms and drop --drop-rate of the prices
+by 20%. Then runs price_tracker.run_cycle twice and reports:
+- products due vs wishlist items (each distinct product fetched once)
+- provider calls, products/s, time spent storing batches (summed over the platforms), alerts queued
+- the second cycle: nothing due (the refresh is incremental)
+
+Sends are counted instead of going to the WhatsApp API.
+
+Usage: python -m benchmarks.bench_price_tracker [--items 150000] [--products 100000] [--rate 1000]
+                                                [--latency-ms 20] [--drop-rate 0.05] [--database-url URL]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+BATCH = 50_000
+
+
+def seed(engine, args, platforms, rng):
+    from sqlalchemy import insert
+    from src.models import User, WishlistItem
+
+    started = time.perf_counter()
+    users = max(1, args.items // 5)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": i + 1, "whatsapp_id": f"55{i:09d}", "phone_number": f"55{i:09d}"} for i in range(users)])
+        for first in range(0, args.items, BATCH):
+            rows = []
+            for i in range(first, min(first + BATCH, args.items)):
+                product = i if i < args.products else rng.randrange(args.products) # Every product tracked at least once
+                price = 100.0 + product % 900
+                rows.append({"user_id": rng.randrange(users) + 1, "platform": platforms[product % len(platforms)], "product_id": f"p{product}",
+                             "product_name": f"Produto {product}", "current_price": price, "reference_price": price,
+                             "target_price": price * 0.9 if i % 10 == 0 else None})
+            conn.execute(insert(WishlistItem), rows)
+    print(f"seeded {users} users, {args.items} wishlist items over {args.products} products in {time.perf_counter() - started:.1f}s")
+
+
+async def run(args):
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    os.environ["PRICE_REFRESH_MAX_PER_CYCLE"] = str(args.products * 2)
+    os.environ["PRICE_REFRESH_REQUESTS_PER_SECOND"] = str(args.rate)
+    from src import affiliate_manager, db_manager, price_tracker, whatsapp_sender
+    from src.models import engine
+
+    rng = random.Random(args.seed)
+    counters = {"calls": 0, "sent": 0, "store_seconds": 0.0}
+
+    class FakePriceProvider(affiliate_manager.AffiliateProvider):
+        price_batch_size = args.price_batch
+
+        def __init__(self, name):
+            self.name = name
+            super().__init__(timeout=5.0)
+
+        async def get_prices(self, external_ids, country="BR"):
+            counters["calls"] += 1
+            await asyncio.sleep(args.latency_ms / 1000)
+            prices = {}
+            for external_id in external_ids:
+                price = 100.0 + int(external_id[1:]) % 900
+                prices[external_id] = round(price * 0.8, 2) if rng.random() < args.drop_rate else price
+            return prices
+
+    async def fake_send_text(to, message_body):
+        counters["sent"] += 1
+
+    store_checks = price_tracker.store_checks
+
+    def timed_store_checks(*store_args):
+        started = time.perf_counter()
+        try:
+            return store_checks(*store_args)
+        finally:
+            counters["store_seconds"] += time.perf_counter() - started
+
+    platforms = list(affiliate_manager.providers)
+    for platform in platforms:
+        affiliate_manager.register_provider(FakePriceProvider(platform))
+    whatsapp_sender.send_text = fake_send_text
+    price_tracker.store_checks = timed_store_checks
+
+    db_manager.init_db()
+    seed(engine, args, platforms, rng)
+
+    for cycle in (1, 2):
+        counters.update(calls=0, sent=0, store_seconds=0.0)
+        price_tracker.tracker_stats.update(products_checked=0, products_failed=0, price_changes=0)
+        started = time.perf_counter()
+        due = await price_tracker.run_cycle()
+        elapsed = time.perf_counter() - started
+        stats = price_tracker.tracker_stats
+        print(f"\ncycle {cycle}: {due} products due for {args.items} wishlist items, {elapsed:.1f}s "
+              f"({due / elapsed if elapsed else 0:,.0f} products/s)")
+        print(f"  provider calls={counters['calls']}  store time={counters['store_seconds']:.1f}s  alerts sent={counters['sent']}  "
+              f"checked={stats['products_checked']}  failed={stats['products_failed']}  changes={stats['price_changes']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=150_000)
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--price-batch", type=int, default=10, help="Product IDs per provider call")
+    parser.add_argument("--rate", type=float, default=1000, help="Provider calls per second per platform")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--drop-rate", type=float, default=0.05)
+    parser.add_argument("--database-url", default=None, help="Defaults to a temporary SQLite file")
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(run(parser.parse_args()))
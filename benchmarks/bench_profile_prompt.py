@@ -0,0 +1,90 @@
+"""
+Per-user profile block in the prompt: cost per message and change-driven regeneration.
+
+1. Seeds --users users with profiles into a temporary SQLite file and builds the profile block
+   for --messages messages (random users, a new AsyncSession per message as in the webhook
+   path): naively (User query + string building every time) and through
+   profile_prompt.profile_blocks. Reports microseconds per message, queries and cache hits.
+2. Runs profile_extractor.extract_profile for every user against a local stub OpenAI server
+   that answers with a size, twice: the first run writes the field and regenerates the block,
+   the second finds nothing new (no write, block unchanged).
+
+Usage: python -m benchmarks.bench_profile_prompt [--users 300] [--messages 20000] [--concurrency 8]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.stub_servers import make_openai_stub, serve_in_thread
+
+EXTRACTED = {"sizes": {"tênis": "38"}}
+
+
+async def run(args):
+    openai_url, openai_server = serve_in_thread(make_openai_stub(latency=0.05, reply=json.dumps(EXTRACTED, ensure_ascii=False)))
+    os.environ.update({
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "DATABASE_URL": f"sqlite:///{tempfile.mkdtemp()}/bench.db",
+    })
+    from sqlalchemy import event, insert
+    from src import context_builder, db_manager, profile_extractor
+    from src.models import AsyncSessionLocal, User, async_engine, engine
+    from src.profile_prompt import profile_block, profile_blocks
+
+    db_manager.init_db()
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{
+            "id": i + 1, "whatsapp_id": f"55{i:09d}", "phone_number": f"55{i:09d}", "style_preferences": "casual, minimalista",
+            "budget_range": "até R$ 300", "preferred_categories": ["tênis", "moda feminina"], "brand_preferences": ["Nike", "Adidas"],
+        } for i in range(args.users)])
+
+    queries = {"count": 0}
+    event.listen(async_engine.sync_engine, "before_cursor_execute", lambda *_: queries.__setitem__("count", queries["count"] + 1))
+    rng = random.Random(42)
+    user_ids = [rng.randrange(args.users) + 1 for _ in range(args.messages)]
+
+    async def naive(db, user_id):
+        return profile_block(await db.get(User, user_id))
+
+    print(f"users={args.users} messages={args.messages}")
+    for name, build in (("naive", naive), ("cached", profile_blocks.get_async)):
+        queries["count"] = 0
+        started = time.perf_counter()
+        for user_id in user_ids:
+            async with AsyncSessionLocal() as db:
+                await build(db, user_id)
+        elapsed = time.perf_counter() - started
+        print(f"{name:6}  {elapsed / args.messages * 1e6:7.1f}us/message  queries={queries['count']}")
+    print(f"block: {profile_blocks.peek(user_ids[0])!r}")
+    print(f"cache: {profile_blocks.metrics()}\n")
+
+    for user_id in range(1, args.users + 1): # Recent turns the extractor reads from the conversation window
+        context_builder.conversation_cache._fill(user_id, None, [])
+        context_builder.conversation_cache.append(user_id, "user", "quero um tênis de corrida, calço 38")
+    for run_index in (1, 2):
+        regenerations = profile_blocks.stats["regenerations"]
+        started = time.perf_counter()
+        results = []
+        for first in range(1, args.users + 1, args.concurrency): # A few at a time, as messages arrive (SQLite has one writer)
+            results += await asyncio.gather(*(profile_extractor.extract_profile(user_id)
+                                              for user_id in range(first, min(first + args.concurrency, args.users + 1))))
+        print(f"extraction run {run_index}: {time.perf_counter() - started:.1f}s  users updated={sum(1 for r in results if r)}  "
+              f"blocks regenerated={profile_blocks.stats['regenerations'] - regenerations}  stats={profile_extractor.extraction_stats}")
+    print(f"block: {profile_blocks.peek(1)!r}")
+
+    await async_engine.dispose() # aiosqlite connection threads would keep the process alive
+    openai_server.should_exit = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=8, help="Extractions running at once")
+    asyncio.run(run(parser.parse_args()))
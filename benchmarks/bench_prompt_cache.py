@@ -0,0 +1,130 @@
+"""
+Prompt-prefix caching and LLM usage accounting.
+
+1. Runs --turns conversation turns for --users users through respond_to_message against a
+   local stub OpenAI server that reports usage like the API does: ~4 characters per token
+   and, as cached tokens, the longest prefix (from 1024 tokens, in 128-token steps) shared
+   with a recent request. With a small CONTEXT_TOKEN_BUDGET the history is trimmed within a
+   few turns; compares trimming one message per turn (--trim-step 0, the previous behaviour)
+   with trimming in CONTEXT_TRIM_STEP_TOKENS steps. Reports the cache hit rate (cached /
+   prompt tokens), cost and latency from the llm_calls table.
+2. Seeds --rows llm_calls rows over 30 days and times the admin usage report queries.
+
+Usage: python -m benchmarks.bench_prompt_cache [--users 5] [--turns 30] [--budget 1500] [--trim-step 500] [--rows 200000]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.stub_servers import make_graph_api_stub, make_openai_stub, serve_in_thread
+
+REPLY = ("Boa escolha! Para corrida no asfalto, procure amortecimento macio e um cabedal respirável. "
+         "Se for treinar mais de três vezes por semana, vale investir em um modelo com placa de propulsão. "
+         "Quer que eu busque opções na sua faixa de preço?")
+QUESTIONS = [
+    "quero um tênis de corrida para treinar no asfalto, uso mais de manhã cedo e corro uns 5 km",
+    "e qual a diferença entre amortecimento macio e firme para quem está começando agora?",
+    "tenho uma pisada um pouco pronada, isso muda alguma coisa na escolha do modelo ideal?",
+    "prefiro cores mais discretas, preto ou cinza, e gostaria de algo que também sirva no dia a dia",
+    "meu orçamento é de até 600 reais, mas posso esticar um pouco se valer muito a pena",
+]
+
+
+def seed_usage_rows(engine, rows, rng):
+    from sqlalchemy import insert
+    from src.models import LLMCall
+
+    now = datetime.now(timezone.utc)
+    batch = []
+    with engine.begin() as conn:
+        for index in range(rows):
+            prompt = rng.randrange(800, 3000)
+            batch.append({"created_at": now - timedelta(seconds=rng.randrange(30 * 86400)), "user_id": rng.randrange(5000) + 1,
+                          "purpose": rng.choice(("reply", "reply", "reply", "summary", "profile_extraction")), "model": "gpt-4o-mini",
+                          "prompt_tokens": prompt, "cached_tokens": prompt // 2 if rng.random() < 0.6 else 0,
+                          "completion_tokens": rng.randrange(20, 300), "cost_usd": 0.0003, "latency_ms": rng.uniform(300, 3000)})
+            if len(batch) == 50_000 or index == rows - 1:
+                conn.execute(insert(LLMCall), batch)
+                batch = []
+
+
+async def run(args):
+    openai_app = make_openai_stub(latency=0.05, reply=REPLY)
+    openai_url, openai_server = serve_in_thread(openai_app)
+    graph_url, graph_server = serve_in_thread(make_graph_api_stub(latency=0.01))
+    os.environ.update({
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "WHATSAPP_API_BASE_URL": graph_url,
+        "WHATSAPP_API_TOKEN": "stub",
+        "WHATSAPP_PHONE_NUMBER_ID": "1234",
+        "DATABASE_URL": f"sqlite:///{tempfile.mkdtemp()}/bench.db",
+        "CONTEXT_TOKEN_BUDGET": str(args.budget),
+        "RESPONSE_CACHE_ENABLED": "false",
+        "SUMMARY_ENABLED": "false", # A summary run would change the prefix mid-conversation
+        "PROFILE_EXTRACTION_ENABLED": "false",
+    })
+    from src import ai_service, context_builder, db_manager, llm_usage, whatsapp_handler
+    from src.config import settings
+    from src.models import AsyncSessionLocal, SessionLocal, async_engine, engine
+
+    async def fake_recommendations(*_, **__):
+        return []
+
+    whatsapp_handler.get_recommendations = fake_recommendations
+    db_manager.init_db()
+    db = AsyncSessionLocal()
+    static = context_builder.estimate_tokens(str(ai_service.STATIC_PREFIX[settings.LLM_TOOLS_ENABLED]))
+    print(f"users={args.users} turns={args.turns} context_budget={args.budget} static prefix ~{static} tokens "
+          f"(+ tool schemas), hash {ai_service.PREFIX_HASH[settings.LLM_TOOLS_ENABLED]}")
+
+    for label, trim_step in (("one message per turn", 0), (f"{args.trim_step}-token steps", args.trim_step)):
+        settings.CONTEXT_TRIM_STEP_TOKENS = trim_step
+        openai_app.state.prompts = [] # Cold provider cache for each variant
+        since = datetime.now(timezone.utc)
+        users = [await db_manager.create_user_async(db, phone_number=f"55{trim_step}{i:05d}", whatsapp_id=f"55{trim_step}{i:05d}")
+                 for i in range(args.users)]
+        started = time.perf_counter()
+        for turn in range(args.turns):
+            for user in users:
+                content = f"{QUESTIONS[turn % len(QUESTIONS)]} (mensagem {turn})"
+                message = {"phone_number": user.phone_number, "whatsapp_id": user.whatsapp_id, "profile_name": None,
+                           "content": content, "whatsapp_message_id": f"wamid.{user.id}.{turn}"}
+                await db_manager.create_message_async(db, user_id=user.id, whatsapp_message_id=message["whatsapp_message_id"],
+                                                      content=content, sender="user")
+                await whatsapp_handler.respond_to_message(db, user.id, message)
+        elapsed = time.perf_counter() - started
+        await llm_usage.flush()
+        with SessionLocal() as sync_db:
+            (row,) = db_manager.get_llm_usage_report(sync_db, since, "purpose")
+        print(f"trim {label:22}  calls={row['calls']}  prompt_tokens={row['prompt_tokens']}  cached={row['cached_tokens']}  "
+              f"hit_rate={row['cache_hit_rate']:.1%}  cost=${row['cost_usd']:.4f}  avg_latency={row['avg_latency_ms']:.0f}ms  "
+              f"wall={elapsed:.1f}s")
+
+    seed_usage_rows(engine, args.rows, random.Random(42))
+    print(f"\nusage report over {args.rows} seeded rows (last {settings.LLM_USAGE_REPORT_DAYS} days):")
+    with SessionLocal() as sync_db:
+        since = datetime.now(timezone.utc) - timedelta(days=settings.LLM_USAGE_REPORT_DAYS)
+        for group_by in ("day", "model", "purpose", "user"):
+            started = time.perf_counter()
+            report = db_manager.get_llm_usage_report(sync_db, since, group_by, limit=50)
+            print(f"  by {group_by:8} {len(report):3} rows in {(time.perf_counter() - started) * 1000:6.1f}ms")
+
+    await db.close()
+    await async_engine.dispose() # aiosqlite connection threads would keep the process alive
+    openai_server.should_exit = graph_server.should_exit = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--budget", type=int, default=1500, help="CONTEXT_TOKEN_BUDGET")
+    parser.add_argument("--trim-step", type=int, default=500, help="CONTEXT_TRIM_STEP_TOKENS")
+    parser.add_argument("--rows", type=int, default=200_000)
+    asyncio.run(run(parser.parse_args()))
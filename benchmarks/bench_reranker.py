@@ -0,0 +1,86 @@
+"""
+Throughput of the profile-aware re-ranking stage (reranker.py).
+
+Indexes a synthetic catalog, retrieves N candidates for random queries and scores them
+against a sample profile two ways:
+- vectorized: reranker.rerank (feature matrix @ weights)
+- loop: the same features computed product by product in Python
+and reports candidates/sec for each.
+
+Usage: python -m benchmarks.bench_reranker [--products 200000] [--candidates 1000,5000,20000] [--rounds 20]
+"""
+
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from benchmarks.bench_search_index import WORDS, synthetic_catalog
+
+
+def loop_scores(rows, relevance, features, weights):
+    """Reference implementation: one Python iteration per candidate."""
+    from src.text_utils import normalize, tokenize
+
+    top = max(relevance) if len(relevance) else 1.0
+    scores = []
+    for (_, text, category, price), rel in zip(rows, relevance):
+        tokens = set(tokenize(text))
+        if features.max_price is None and features.min_price is None:
+            budget = 0.5
+        else:
+            over = max(0.0, price - features.max_price) / features.max_price if features.max_price else 0.0
+            under = max(0.0, features.min_price - price) / features.min_price if features.min_price else 0.0
+            budget = 1.0 / (1.0 + 4.0 * over + under)
+        category_match = float(normalize(category) in features.categories)
+        brand = float(any(all(term in tokens for term in brand) for brand in features.brands))
+        style = sum(term in tokens for term in features.style_terms) / len(features.style_terms) if features.style_terms else 0.0
+        scores.append(weights["relevance"] * rel / top + weights["budget"] * budget + weights["category"] * category_match
+                      + weights["brand"] * brand + weights["style"] * style)
+    return sorted(range(len(scores)), key=lambda i: -scores[i])
+
+
+def main(args):
+    from src import reranker
+    from src.config import settings
+    from src.search_index import ProductIndex
+
+    rng = random.Random(args.seed)
+    catalog = list(synthetic_catalog(args.products, rng))
+    index = ProductIndex()
+    index.add_many(catalog)
+    user = SimpleNamespace(id=1, budget_range="R$ 100 a 400", preferred_categories=["calcados", "esporte"],
+                           brand_preferences=["esportivo"], style_preferences="estilo casual preto", sizes=None)
+
+    print(f"\nproducts={args.products} rounds={args.rounds}")
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        reranker.profile_cache._entries.clear()
+        reranker.profile_features(user)
+    print(f"profile parse={(time.perf_counter() - started) / args.rounds * 1e6:.0f}us (then cached)")
+    features = reranker.profile_features(user)
+
+    for count in (int(value) for value in args.candidates.split(",")):
+        vectorized, loop = 0.0, 0.0
+        for _ in range(args.rounds):
+            # A broad query so there are enough candidates; ties broken by BM25 order
+            slots, relevance = index.top_slots(" ".join(rng.sample(WORDS[:10], 3)), k=count)
+            started = time.perf_counter()
+            reranker.rerank(index, slots, relevance, features, k=10)
+            vectorized += time.perf_counter() - started
+            rows = [catalog[product_id - 1] for product_id in index.product_ids(slots).tolist()]
+            started = time.perf_counter()
+            loop_scores(rows, relevance.tolist(), features, settings.RERANK_WEIGHTS)
+            loop += time.perf_counter() - started
+        scored = len(slots) * args.rounds
+        print(f"candidates={len(slots):6}  vectorized={scored / vectorized:12,.0f}/s ({vectorized / args.rounds * 1000:6.2f}ms)  "
+              f"loop={scored / loop:10,.0f}/s ({loop / args.rounds * 1000:7.2f}ms)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=200_000)
+    parser.add_argument("--candidates", default="1000,5000,20000")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    main(parser.parse_args())
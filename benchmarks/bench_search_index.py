@@ -0,0 +1,85 @@
+"""
+Build, query and snapshot times of the in-process product search index.
+
+Generates a synthetic catalog (Zipf-distributed vocabulary, random categories and
+prices), indexes it, then times top-k queries with and without facet filters and a
+snapshot save/load round trip. No database needed.
+
+Usage: python -m benchmarks.bench_search_index [--products 1000000] [--queries 200] [--k 10]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.stub_servers import percentile
+
+WORDS = ["tenis", "corrida", "camiseta", "vestido", "calca", "jeans", "bolsa", "couro", "relogio", "smartwatch",
+         "fone", "bluetooth", "notebook", "gamer", "cadeira", "escritorio", "perfume", "feminino", "masculino", "infantil",
+         "preto", "branco", "azul", "vermelho", "algodao", "esportivo", "casual", "social", "academia", "praia"]
+CATEGORIES = ["moda", "calcados", "eletronicos", "casa", "beleza", "esporte", "infantil", "acessorios"]
+
+
+def synthetic_catalog(count: int, rng: random.Random):
+    # Common words from WORDS plus a long tail of rarer synthetic terms (Zipf-like)
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    for product_id in range(1, count + 1):
+        words = rng.choices(WORDS, weights=weights, k=rng.randint(3, 8))
+        words.append(f"modelo{rng.randint(1, count // 10 + 1)}")
+        yield product_id, " ".join(words), rng.choice(CATEGORIES), round(rng.uniform(10, 3000), 2)
+
+
+def main(args):
+    from src.search_index import ProductIndex
+
+    rng = random.Random(args.seed)
+    index = ProductIndex()
+    started = time.perf_counter()
+    batch = []
+    for row in synthetic_catalog(args.products, rng):
+        batch.append(row)
+        if len(batch) == 50000:
+            index.add_many(batch)
+            batch = []
+    index.add_many(batch)
+    build_time = time.perf_counter() - started
+
+    queries = [" ".join(rng.sample(WORDS, rng.randint(1, 3))) for _ in range(args.queries)]
+    timings = {}
+    for label, filters in (("plain", {}), ("price+category", {"max_price": 300, "categories": ["moda", "calcados"]})):
+        samples = []
+        for query in queries:
+            started = time.perf_counter()
+            index.search(query, k=args.k, **filters)
+            samples.append(time.perf_counter() - started)
+        timings[label] = samples
+    started = time.perf_counter()
+    facets = index.facets(queries[0])
+    facet_time = time.perf_counter() - started
+
+    path = os.path.join(tempfile.mkdtemp(), "index.npz")
+    started = time.perf_counter()
+    index.save(path)
+    save_time = time.perf_counter() - started
+    started = time.perf_counter()
+    loaded = ProductIndex.load(path)
+    load_time = time.perf_counter() - started
+    assert loaded.search(queries[0], k=args.k) == index.search(queries[0], k=args.k)
+
+    print(f"\nproducts={args.products} terms={len(index._postings)} build={build_time:.1f}s "
+          f"({args.products / build_time:,.0f} products/s)")
+    for label, samples in timings.items():
+        print(f"top-{args.k} {label:15} p50={percentile(samples, 50) * 1000:6.1f}ms  p99={percentile(samples, 99) * 1000:6.1f}ms")
+    print(f"facets('{queries[0]}') {facet_time * 1000:.1f}ms -> {facets['categories']}")
+    print(f"snapshot save={save_time:.2f}s load={load_time:.2f}s size={os.path.getsize(path) / 1e6:.0f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    main(parser.parse_args())
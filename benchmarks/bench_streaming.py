@@ -0,0 +1,81 @@
+"""
+Time-to-first-WhatsApp-message with and without streaming replies.
+
+Runs respond_to_message for one inbound message against a local streaming stub
+OpenAI server and a fake Graph API, and reports when the first and the last
+WhatsApp message reached the fake API.
+
+Usage: python -m benchmarks.bench_streaming [--first-token 0.4] [--token-delay 0.02] [--runs 5]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.stub_servers import make_graph_api_stub, make_openai_stub, serve_in_thread
+
+REPLY = (
+    "Ótima escolha! Para corrida no asfalto, tênis com bom amortecimento fazem toda a diferença. "
+    "Modelos com entressola de espuma leve ajudam a reduzir o impacto nos joelhos.\n\n"
+    "Se o seu orçamento for até R$ 400, há boas opções de marcas nacionais e linhas de entrada das grandes marcas. "
+    "Você prefere algo mais leve para provas ou mais estruturado para treinos longos? "
+    "Me conta também o seu número que eu separo algumas sugestões."
+)
+
+
+async def run(args):
+    openai_url, openai_server = serve_in_thread(make_openai_stub(latency=args.first_token, reply=REPLY, token_delay=args.token_delay))
+    graph = make_graph_api_stub(latency=0.01)
+    graph_url, graph_server = serve_in_thread(graph)
+
+    arrivals = graph.state.arrivals # When each message reached the fake Graph API
+    os.environ.update({
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "WHATSAPP_API_BASE_URL": graph_url,
+        "WHATSAPP_API_TOKEN": "stub",
+        "WHATSAPP_PHONE_NUMBER_ID": "1234",
+        "DATABASE_URL": f"sqlite:///{tempfile.mkdtemp()}/bench.db",
+        "PROFILE_EXTRACTION_ENABLED": "false", # Background extraction calls would add to the completions measured
+    })
+    from src import db_manager, whatsapp_handler
+    from src.config import settings
+    from src.models import AsyncSessionLocal, async_engine
+
+    db_manager.init_db()
+    db = AsyncSessionLocal()
+    user = await db_manager.create_user_async(db, phone_number="5511999990000", whatsapp_id="5511999990000")
+
+    results = {}
+    for streaming in (False, True):
+        settings.STREAMING_REPLIES = streaming
+        first, last, counts = [], [], []
+        for run_index in range(args.runs):
+            message = {"phone_number": user.phone_number, "whatsapp_id": user.whatsapp_id, "profile_name": None,
+                       "content": "quero um tênis de corrida", "whatsapp_message_id": f"wamid.{streaming}.{run_index}"}
+            arrivals.clear()
+            started = time.perf_counter()
+            await whatsapp_handler.respond_to_message(db, user.id, message)
+            first.append(arrivals[0] - started)
+            last.append(arrivals[-1] - started)
+            counts.append(len(arrivals))
+        results[streaming] = (sum(first) / len(first), sum(last) / len(last), sum(counts) / len(counts))
+
+    await db.close()
+    await async_engine.dispose() # aiosqlite connection threads would keep the process alive
+    openai_server.should_exit = graph_server.should_exit = True
+
+    print(f"\nfirst_token={args.first_token}s token_delay={args.token_delay}s words={len(REPLY.split())} runs={args.runs}")
+    for streaming, (first, last, count) in results.items():
+        print(f"streaming={str(streaming):5}  time-to-first-message={first * 1000:7.1f}ms  "
+              f"time-to-last-message={last * 1000:7.1f}ms  messages={count:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--first-token", type=float, default=0.4)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--runs", type=int, default=5)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,118 @@
+"""
+LLM tool calling: round trips, concurrent tool execution and time per turn.
+
+Runs respond_to_message for "quero um tênis de corrida e meias, calço 38" against a local
+stub OpenAI server (--llm-latency per completion) that answers the first completion with
+three tool calls (two search_products and one update_user_profile) and a fake Graph API.
+Searches take --tool-latency. Compares:
+- tools off: one completion that cannot see products, with retrieval running next to it
+  (the model can only promise to look products up)
+- tools on: completion -> concurrent tool calls -> completion that answers with the products
+
+and reports completions, tool calls, the wall time of the tool round against the sum of the
+tool durations (what running them one after another would cost), product cards and time
+per turn.
+
+Usage: python -m benchmarks.bench_tool_calling [--llm-latency 0.6] [--tool-latency 0.3] [--runs 3]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.stub_servers import make_graph_api_stub, make_openai_stub, serve_in_thread
+
+MESSAGE = "quero um tênis de corrida e meias, calço 38"
+TOOL_CALLS = [
+    {"name": "search_products", "arguments": {"query": "tênis de corrida", "num_results": 2}},
+    {"name": "search_products", "arguments": {"query": "meia de corrida", "max_price": 60, "num_results": 1}},
+    {"name": "update_user_profile", "arguments": {"sizes": {"tênis": "38"}}},
+]
+REPLY = "Separei dois tênis de corrida com bom amortecimento e uma meia que cabe no seu orçamento. Quer salvar algum na lista de desejos?"
+
+
+async def run(args):
+    openai_app = make_openai_stub(latency=args.llm_latency, reply=REPLY, tool_calls=TOOL_CALLS)
+    openai_url, openai_server = serve_in_thread(openai_app)
+    graph = make_graph_api_stub(latency=0.01)
+    graph_url, graph_server = serve_in_thread(graph)
+    os.environ.update({
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "WHATSAPP_API_BASE_URL": graph_url,
+        "WHATSAPP_API_TOKEN": "stub",
+        "WHATSAPP_PHONE_NUMBER_ID": "1234",
+        "DATABASE_URL": f"sqlite:///{tempfile.mkdtemp()}/bench.db",
+        "RESPONSE_CACHE_ENABLED": "false",
+        "PROFILE_EXTRACTION_ENABLED": "false", # Background extraction calls would add to the completions measured
+    })
+    from src import db_manager, llm_tools, whatsapp_handler
+    from src.config import settings
+    from src.models import AsyncSessionLocal, async_engine
+    from src.recommendation_engine import RecommendedProduct
+
+    async def fake_recommendations(user, query, db, num_recommendations=3, offset=0, max_price=None):
+        await asyncio.sleep(args.tool_latency)
+        return [RecommendedProduct(id=f"{query}-{i}", name=f"{query} {i}", price="R$ 199,90", image_url=None, affiliate_link="#", price_value=199.9)
+                for i in range(num_recommendations)]
+
+    timings = {"tool_seconds": 0.0, "round_seconds": 0.0}
+    execute, run_tool_calls = llm_tools.execute, llm_tools.run_tool_calls
+
+    async def timed_execute(*execute_args):
+        started = time.perf_counter()
+        try:
+            return await execute(*execute_args)
+        finally:
+            timings["tool_seconds"] += time.perf_counter() - started
+
+    async def timed_run_tool_calls(*round_args):
+        started = time.perf_counter()
+        try:
+            return await run_tool_calls(*round_args)
+        finally:
+            timings["round_seconds"] += time.perf_counter() - started
+
+    llm_tools.get_recommendations = whatsapp_handler.get_recommendations = fake_recommendations
+    llm_tools.execute, llm_tools.run_tool_calls = timed_execute, timed_run_tool_calls
+    settings.STREAMING_REPLIES = False
+    db_manager.init_db()
+    db = AsyncSessionLocal()
+    user = await db_manager.create_user_async(db, phone_number="5511999990000", whatsapp_id="5511999990000")
+
+    print(f"llm_latency={args.llm_latency}s tool_latency={args.tool_latency}s runs={args.runs}")
+    for enabled in (False, True):
+        settings.LLM_TOOLS_ENABLED = enabled
+        completions = tool_calls = cards = 0
+        elapsed = 0.0
+        timings.update(tool_seconds=0.0, round_seconds=0.0)
+        for run_index in range(args.runs):
+            message = {"phone_number": user.phone_number, "whatsapp_id": user.whatsapp_id, "profile_name": None, "content": MESSAGE,
+                       "whatsapp_message_id": f"wamid.{enabled}.{run_index}"}
+            requests_before, calls_before, arrivals_before = len(openai_app.state.requests), sum(s["calls"] for s in llm_tools.tool_stats.values()), graph.state.requests
+            started = time.perf_counter()
+            await whatsapp_handler.respond_to_message(db, user.id, message)
+            elapsed += time.perf_counter() - started
+            completions += len(openai_app.state.requests) - requests_before
+            tool_calls += sum(s["calls"] for s in llm_tools.tool_stats.values()) - calls_before
+            cards += graph.state.requests - arrivals_before - 1 # Everything after the reply is a product card
+        line = (f"tools={'on ' if enabled else 'off'}  completions={completions / args.runs:.0f}  tool_calls={tool_calls / args.runs:.0f}  "
+                f"product_cards={cards / args.runs:.0f}  time/turn={elapsed / args.runs * 1000:7.1f}ms")
+        if enabled:
+            line += (f"  tool round={timings['round_seconds'] / args.runs * 1000:.0f}ms "
+                     f"(sequential would be {timings['tool_seconds'] / args.runs * 1000:.0f}ms)")
+        print(line)
+
+    await db.close()
+    await async_engine.dispose() # aiosqlite connection threads would keep the process alive
+    openai_server.should_exit = graph_server.should_exit = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency", type=float, default=0.6)
+    parser.add_argument("--tool-latency", type=float, default=0.3)
+    parser.add_argument("--runs", type=int, default=3)
+    asyncio.run(run(parser.parse_args()))
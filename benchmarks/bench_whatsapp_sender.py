@@ -0,0 +1,71 @@
+"""
+Outbound WhatsApp throughput against a local fake Graph API.
+
+Sends ``--messages`` messages to each of ``--recipients`` users and reports
+messages/second, retries and whether every recipient got their messages in
+order. ``--mode requests`` reproduces the old one-blocking-requests.post-per-message
+sender for comparison.
+
+Usage: python -m benchmarks.bench_whatsapp_sender [--mode pooled|requests] [--recipients 50] [--messages 4] [--latency 0.05] [--error-rate 0.05]
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.stub_servers import make_graph_api_stub, serve_in_thread
+
+
+async def run(args):
+    stub = make_graph_api_stub(latency=args.latency, error_rate=args.error_rate)
+    base_url, server = serve_in_thread(stub)
+    os.environ.update({
+        "WHATSAPP_API_BASE_URL": base_url,
+        "WHATSAPP_API_TOKEN": "stub",
+        "WHATSAPP_PHONE_NUMBER_ID": "1234",
+        "WHATSAPP_MESSAGES_PER_SECOND": str(args.rate),
+    })
+    from src import whatsapp_sender
+
+    recipients = [f"55119{i:08d}" for i in range(args.recipients)]
+    expected = {to: [f"msg {n}" for n in range(args.messages)] for to in recipients}
+
+    started = time.perf_counter()
+    if args.mode == "requests":
+        import requests
+
+        def send_all():
+            for n in range(args.messages):
+                for to in recipients:
+                    response = requests.post(f"{base_url}/1234/messages", json={"to": to, "type": "text", "text": {"body": f"msg {n}"}})
+                    if response.status_code >= 400: # Old sender did not retry
+                        continue
+        await asyncio.to_thread(send_all)
+    else:
+        await asyncio.gather(*(whatsapp_sender.send_text(to, f"msg {n}") for n in range(args.messages) for to in recipients))
+        await whatsapp_sender.sender.close()
+    elapsed = time.perf_counter() - started
+    server.should_exit = True
+
+    total = args.recipients * args.messages
+    delivered = sum(len(bodies) for bodies in stub.state.received.values())
+    in_order = all(stub.state.received.get(to) == bodies for to, bodies in expected.items())
+    print(f"\nmode={args.mode} recipients={args.recipients} messages/recipient={args.messages} "
+          f"api_latency={args.latency}s error_rate={args.error_rate}")
+    print(f"delivered {delivered}/{total} in {elapsed:.2f}s -> {delivered / elapsed:.1f} msg/s "
+          f"(api requests: {stub.state.requests})")
+    print(f"every recipient complete and in order: {in_order}")
+    if args.mode == "pooled":
+        print(f"sender stats: {whatsapp_sender.get_sender_metrics()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["pooled", "requests"], default="pooled")
+    parser.add_argument("--recipients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--rate", type=float, default=80, help="WHATSAPP_MESSAGES_PER_SECOND")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,174 @@
+# Local stub servers used by the benchmarks (no external network calls)
+
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+
+
+def serve_in_thread(app: FastAPI) -> tuple[str, uvicorn.Server]:
+    """Runs an ASGI app with uvicorn on a free local port in a daemon thread. Returns (base_url, server)."""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}", server
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of samples."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+# --- Stub OpenAI API ---
+
+PROMPT_CACHE_MIN_TOKENS = 1024 # Like OpenAI: prefixes from 1024 tokens are cached, in 128-token steps
+PROMPT_CACHE_STEP_TOKENS = 128
+
+
+def stub_usage(app: FastAPI, body: dict, completion_tokens: int) -> dict:
+    """
+    `usage` for a request: ~4 characters per token, and the longest prefix shared with a recent
+    request (tools, then messages, as the API lays out the prompt) counted as cached tokens.
+    """
+    prompt = json.dumps(body.get("tools"), ensure_ascii=False) + json.dumps(body["messages"], ensure_ascii=False)
+    shared = max((len(os.path.commonprefix([prompt, earlier])) for earlier in app.state.prompts), default=0)
+    app.state.prompts = [*app.state.prompts[-199:], prompt]
+    prompt_tokens, cached = len(prompt) // 4, shared // 4
+    cached = 0 if cached < PROMPT_CACHE_MIN_TOKENS else cached - (cached - PROMPT_CACHE_MIN_TOKENS) % PROMPT_CACHE_STEP_TOKENS
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached}}
+
+
+def make_openai_stub(latency: float = 1.0, reply: str = "Olá! Como posso ajudar nas suas compras hoje?",
+                     token_delay: float = 0.0, tool_calls: list[dict] | None = None) -> FastAPI:
+    """
+    Minimal /v1/chat/completions endpoint.
+
+    `latency` is the time to the first token; each further word takes `token_delay`.
+    Requests with "stream": true get server-sent events, one word per chunk.
+    With `tool_calls` ([{"name", "arguments"}]), a request that offers tools and ends with the
+    user's message is answered with those tool calls; the request carrying their results
+    gets the reply. Every request body is recorded in `app.state.requests`. Responses carry a
+    `usage` with simulated prompt caching (stub_usage), streamed ones when
+    stream_options.include_usage is set.
+    """
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI()
+    app.state.requests = []
+    app.state.prompts = []
+    words = reply.split(" ")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests.append(body)
+        model = body.get("model", "stub")
+        created = int(time.time())
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        def usage_event(completion_tokens: int) -> str:
+            chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [], "usage": stub_usage(app, body, completion_tokens)}
+            return f"data: {json.dumps(chunk)}\n\n" if include_usage else ""
+
+        if tool_calls and body.get("tools") and body.get("tool_choice") != "none" and body["messages"][-1]["role"] == "user":
+            calls = [{"id": f"call_{index}", "type": "function", "function": {"name": call["name"], "arguments": json.dumps(call["arguments"])}}
+                     for index, call in enumerate(tool_calls)]
+            await asyncio.sleep(latency)
+            if body.get("stream"):
+                async def tool_events():
+                    for index, call in enumerate(calls):
+                        delta = {"tool_calls": [{"index": index, **call}]}
+                        chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                                 "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                        yield f"data: {json.dumps(chunk)}\n\n"
+                    done = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                            "choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}]}
+                    yield f"data: {json.dumps(done)}\n\n{usage_event(20)}data: [DONE]\n\n"
+                return StreamingResponse(tool_events(), media_type="text/event-stream")
+            return {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": None, "tool_calls": calls}, "finish_reason": "tool_calls"}],
+                "usage": stub_usage(app, body, 20),
+            }
+        if body.get("stream"):
+            async def events():
+                await asyncio.sleep(latency)
+                for index, word in enumerate(words):
+                    if index:
+                        await asyncio.sleep(token_delay)
+                    delta = {"content": word if index == 0 else f" {word}"}
+                    chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                             "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                done = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+                yield f"data: {json.dumps(done)}\n\n{usage_event(len(words))}data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        await asyncio.sleep(latency + token_delay * (len(words) - 1))
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+            "usage": stub_usage(app, body, len(words)),
+        }
+
+    return app
+
+
+# --- Fake WhatsApp Graph API ---
+
+def make_graph_api_stub(latency: float = 0.05, error_rate: float = 0.0, seed: int = 0) -> FastAPI:
+    """
+    Fake Cloud API /{phone_number_id}/messages endpoint.
+
+    Answers after `latency` seconds; a fraction `error_rate` of requests gets a 429 or 503.
+    Accepted message bodies are recorded per recipient in `app.state.received`, and the
+    perf_counter() time each request arrived in `app.state.arrivals`.
+    """
+    import random
+
+    rng = random.Random(seed)
+    app = FastAPI()
+    app.state.received = {}
+    app.state.requests = 0
+    app.state.arrivals = []
+
+    @app.post("/{phone_number_id}/messages")
+    async def send_message(phone_number_id: str, request: Request):
+        from fastapi.responses import JSONResponse
+
+        app.state.arrivals.append(time.perf_counter())
+        body = await request.json()
+        app.state.requests += 1
+        await asyncio.sleep(latency)
+        if rng.random() < error_rate:
+            status = rng.choice([429, 503])
+            return JSONResponse({"error": {"code": status}}, status_code=status, headers={"Retry-After": "0.05"} if status == 429 else {})
+        app.state.received.setdefault(body["to"], []).append(body["text"]["body"])
+        return {"messaging_product": "whatsapp", "messages": [{"id": f"wamid.stub{app.state.requests}"}]}
+
+    return app
@@ -1,15 +1,19 @@
 # Routes for the Admin Dashboard API and UI
 
-from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Request
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 import secrets
-from typing import List
+from typing import List, Optional
+from datetime import datetime, timedelta, timezone
 import os
 
-from . import db_manager, models, config
+from . import db_manager, models, config, ingestion_queue, ai_service, dedup, whatsapp_sender, context_builder, summarizer, affiliate_manager, search_index, reranker, db_pool, price_tracker, intent_classifier, llm_tools, profile_prompt, profile_extractor, llm_usage
+from .response_cache import response_cache
+from .query_budget import query_budget, budget_stats as query_budget_stats
+from .recommendation_cache import recommendation_cache
 
 # Determine the base directory for templates relative to this file
 template_dir = os.path.join(os.path.dirname(__file__), "templates")
@@ -45,40 +49,83 @@ auth_dependency = Depends(get_current_admin_user)
 @router.get("/", response_class=HTMLResponse, name="admin_home")
 async def admin_home(request: Request, username: str = auth_dependency):
     """Renders the main admin dashboard page."""
-    return templates.TemplateResponse("admin_dashboard.html", {"request": request, "username": username})
+    return templates.TemplateResponse("admin_dashboard.html", {
+        "request": request,
+        "username": username,
+        "response_cache": response_cache.metrics(),
+        "product_search": affiliate_manager.get_search_metrics(),
+        "search_index": search_index.product_index.metrics(),
+        "reranker_profile_cache": reranker.profile_cache.stats,
+        "recommendation_cache": recommendation_cache.metrics(),
+    })
+
+# Each page is capped at what it displays and declares its SQL query budget (query_budget.py)
+page_size = Query(100, ge=1, le=config.settings.ADMIN_MAX_PAGE_SIZE)
 
 @router.get("/users-ui", response_class=HTMLResponse, name="list_users_html")
-async def list_users_html(request: Request, skip: int = 0, limit: int = 100, db: Session = Depends(db_manager.get_db), username: str = auth_dependency):
-    """Renders the user list page."""
-    users = db.query(models.User).order_by(models.User.created_at.desc()).offset(skip).limit(limit).all()
-    return templates.TemplateResponse("admin_users.html", {"request": request, "users": users, "username": username})
+@query_budget(1)
+async def list_users_html(request: Request, before_id: Optional[int] = None, limit: int = page_size, db: Session = Depends(db_manager.get_db), username: str = auth_dependency):
+    """Renders the user list page (keyset pagination, newest first)."""
+    users, next_before_id = db_manager.list_users(db, limit=limit, before_id=before_id)
+    return templates.TemplateResponse("admin_users.html", {
+        "request": request,
+        "users": users,
+        "limit": limit,
+        "is_first_page": before_id is None,
+        "next_before_id": next_before_id,
+        "username": username,
+    })
 
 @router.get("/users-ui/{whatsapp_id}", response_class=HTMLResponse, name="get_user_details_html")
+@query_budget(3)
 async def get_user_details_html(request: Request, whatsapp_id: str, db: Session = Depends(db_manager.get_db), username: str = auth_dependency):
     """Renders the user details page."""
-    user = db_manager.get_user_by_whatsapp_id(db, whatsapp_id=whatsapp_id)
-    if user is None:
+    details = db_manager.get_user_details(db, whatsapp_id, message_limit=config.settings.ADMIN_MESSAGES_LIMIT,
+                                          wishlist_limit=config.settings.ADMIN_WISHLIST_LIMIT)
+    if details is None:
         raise HTTPException(status_code=404, detail="User not found")
-    messages = db_manager.get_user_messages(db, user_id=user.id, limit=50)
-    wishlist_items = db_manager.get_wishlist_items(db, user_id=user.id)
+    user, messages, wishlist_items = details
     return templates.TemplateResponse("admin_user_details.html", {
         "request": request,
         "user": user,
-        "messages": reversed(messages), # Show newest first in template if needed, or handle in template
+        "messages": list(reversed(messages)), # Oldest first; a list so the template can also take its length
         "wishlist_items": wishlist_items,
         "username": username
     })
 
+USAGE_GROUPS = ("day", "model", "purpose", "user")
+USAGE_PAGE_ROWS = 50 # Rows per table on the usage page (users: the most expensive)
+usage_days = Query(config.settings.LLM_USAGE_REPORT_DAYS, ge=1, le=366)
+
+def llm_usage_report(db: Session, days: int, limit: int) -> dict:
+    """LLM cost, tokens, cache hit rate and latency of the last `days` days, one aggregate query per grouping."""
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    return {group_by: db_manager.get_llm_usage_report(db, since, group_by, limit=limit) for group_by in USAGE_GROUPS}
+
+@router.get("/usage-ui", response_class=HTMLResponse, name="llm_usage_html")
+@query_budget(len(USAGE_GROUPS))
+async def llm_usage_html(request: Request, days: int = usage_days, db: Session = Depends(db_manager.get_db), username: str = auth_dependency):
+    """Renders the LLM usage page: cost and latency per day, model, purpose and user."""
+    return templates.TemplateResponse("admin_usage.html", {
+        "request": request,
+        "days": days,
+        "report": llm_usage_report(db, days, limit=USAGE_PAGE_ROWS),
+        "live": llm_usage.get_usage_metrics(),
+        "username": username,
+    })
+
 # --- API Endpoints (Data for potential JS frontend or direct API access) ---
 # These routes are kept separate from the HTML rendering routes
 
-@router.get("/api/users", response_model=List[models.UserProfile], dependencies=[auth_dependency])
-def list_users_api(skip: int = 0, limit: int = 100, db: Session = Depends(db_manager.get_db)):
-    """API endpoint to list registered users."""
-    users = db.query(models.User).offset(skip).limit(limit).all()
-    return users
+@router.get("/api/users", response_model=models.UserPage, dependencies=[auth_dependency])
+@query_budget(1)
+def list_users_api(before_id: Optional[int] = None, limit: int = page_size, db: Session = Depends(db_manager.get_db)):
+    """API endpoint to list registered users, newest first. Pass next_before_id as before_id for the next page."""
+    users, next_before_id = db_manager.list_users(db, limit=limit, before_id=before_id)
+    return {"users": users, "next_before_id": next_before_id}
 
 @router.get("/api/users/{whatsapp_id}", response_model=models.UserProfile, dependencies=[auth_dependency])
+@query_budget(1)
 def get_user_details_api(whatsapp_id: str, db: Session = Depends(db_manager.get_db)):
     """API endpoint to get details for a specific user by WhatsApp ID."""
     user = db_manager.get_user_by_whatsapp_id(db, whatsapp_id=whatsapp_id)
@@ -87,7 +134,8 @@ def get_user_details_api(whatsapp_id: str, db: Session = Depends(db_manager.get_
     return user
 
 @router.get("/api/users/{whatsapp_id}/messages", dependencies=[auth_dependency])
-def get_user_conversation_api(whatsapp_id: str, limit: int = 50, db: Session = Depends(db_manager.get_db)):
+@query_budget(2)
+def get_user_conversation_api(whatsapp_id: str, limit: int = Query(50, ge=1, le=config.settings.ADMIN_MAX_PAGE_SIZE), db: Session = Depends(db_manager.get_db)):
     """API endpoint to get the recent conversation history for a specific user."""
     user = db_manager.get_user_by_whatsapp_id(db, whatsapp_id=whatsapp_id)
     if user is None:
@@ -96,13 +144,46 @@ def get_user_conversation_api(whatsapp_id: str, limit: int = 50, db: Session = D
     return [{"sender": msg.sender, "content": msg.content, "timestamp": msg.timestamp} for msg in reversed(messages)]
 
 @router.get("/api/users/{whatsapp_id}/wishlist", response_model=List[models.WishlistItemResponse], dependencies=[auth_dependency])
-def get_user_wishlist_api(whatsapp_id: str, db: Session = Depends(db_manager.get_db)):
+@query_budget(2)
+def get_user_wishlist_api(whatsapp_id: str, limit: int = Query(100, ge=1, le=config.settings.ADMIN_MAX_PAGE_SIZE), db: Session = Depends(db_manager.get_db)):
     """API endpoint to get the wishlist items for a specific user."""
     user = db_manager.get_user_by_whatsapp_id(db, whatsapp_id=whatsapp_id)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    wishlist_items = db_manager.get_wishlist_items(db, user_id=user.id)
+    wishlist_items = db_manager.get_wishlist_items(db, user_id=user.id, limit=limit)
     return wishlist_items
 
+@router.get("/api/metrics", dependencies=[auth_dependency])
+async def get_metrics_api():
+    """API endpoint with runtime metrics (ingestion queue, DB pool, LLM, dedup, outbound sender, caches)."""
+    return {
+        "ingestion_queue": await ingestion_queue.get_queue_metrics(),
+        "db_pool": db_pool.get_pool_metrics(models.engine),
+        "db_pool_async": db_pool.get_pool_metrics(models.async_engine),
+        "llm": ai_service.llm_stats,
+        "intents": intent_classifier.intent_stats,
+        "llm_tools": llm_tools.tool_stats,
+        "dedup": dedup.get_dedup_metrics(),
+        "whatsapp_sender": whatsapp_sender.get_sender_metrics(),
+        "conversation_cache": context_builder.conversation_cache.metrics(),
+        "summarizer": summarizer.summary_stats,
+        "profile_blocks": profile_prompt.profile_blocks.metrics(),
+        "profile_extraction": profile_extractor.extraction_stats,
+        "llm_usage": llm_usage.get_usage_metrics(),
+        "response_cache": response_cache.metrics(),
+        "product_search": affiliate_manager.get_search_metrics(),
+        "search_index": search_index.product_index.metrics(),
+        "reranker_profile_cache": reranker.profile_cache.stats,
+        "recommendation_cache": recommendation_cache.metrics(),
+        "price_tracker": price_tracker.get_tracker_metrics(),
+        "query_budgets": query_budget_stats,
+    }
+
+@router.get("/api/llm-usage", dependencies=[auth_dependency])
+@query_budget(len(USAGE_GROUPS))
+def get_llm_usage_api(days: int = usage_days, limit: int = page_size, db: Session = Depends(db_manager.get_db)):
+    """API endpoint with LLM usage aggregated per day, model, purpose and user (most expensive first)."""
+    return {"days": days, **llm_usage_report(db, days, limit=limit)}
+
 # Add more admin API endpoints as needed
 
@@ -1,12 +1,19 @@
 # Manages interactions with affiliate program APIs (e.g., Amazon Associates, Magalu, AliExpress)
 
-import requests
+import asyncio
+import time
+from sqlalchemy.orm import Session
 from .config import settings
-from typing import List, Dict, Optional
+from .models import SessionLocal, Product
+from .db_manager import get_cached_search, store_search_results
+from . import search_index
+from .text_utils import parse_price
+from typing import List, Dict, Optional, Any
 
 # Placeholder for product data structure returned by affiliate APIs
 class AffiliateProduct:
-    def __init__(self, id: str, name: str, price: str, image_url: str, product_url: str, affiliate_link: str, description: Optional[str] = None):
+    def __init__(self, id: str, name: str, price: str, image_url: str, product_url: str, affiliate_link: str, description: Optional[str] = None,
+                 platform: Optional[str] = None, category: Optional[str] = None, price_value: Optional[float] = None):
         self.id = id
         self.name = name
         self.price = price
@@ -14,47 +21,271 @@ class AffiliateProduct:
         self.product_url = product_url # Original product URL
         self.affiliate_link = affiliate_link # Tracking link
         self.description = description
+        self.platform = platform
+        self.category = category
+        self.price_value = price_value if price_value is not None else parse_price(price) # Numeric BRL price
 
-def search_products(query: str, limit: int = 5, country: str = "BR") -> List[AffiliateProduct]:
+    @classmethod
+    def from_model(cls, product: Product) -> "AffiliateProduct":
+        return cls(
+            id=product.external_id,
+            name=product.name,
+            price=product.price_display,
+            image_url=product.image_url,
+            product_url=product.product_url,
+            affiliate_link=product.affiliate_link,
+            description=product.description,
+            platform=product.platform,
+            category=product.category,
+            price_value=product.price,
+        )
+
+SEARCH_PAGE_SIZE = 10 # Products requested per platform call; cached so smaller limits are served locally
+RRF_K = 60 # Reciprocal rank fusion constant used to merge the platforms' rankings
+
+search_stats = {"cache_hits": 0, "cache_misses": 0, "stale_served": 0}
+
+def fetch_from_platform(platform: str, query: str, limit: int, country: str = "BR") -> List[Dict[str, Any]]:
     """
-    Searches for products across integrated affiliate platforms based on a query.
-    
+    Calls one affiliate platform's search API and returns product dicts with the Product
+    columns (external_id, name, category, price, price_display, image_url, product_url,
+    affiliate_link, description).
+
     This is a placeholder implementation. A real implementation would:
-    1. Identify the target platform(s) (Amazon, Magalu, etc.) based on user preference or availability.
-    2. Call the respective affiliate API (e.g., Amazon Product Advertising API) with the query.
-    3. Parse the API response to extract product details (ID, name, price, image, URL).
-    4. Generate an affiliate tracking link for the product URL using the platform's tools/API.
-    5. Handle API errors, rate limits, and authentication.
-    6. Potentially cache results.
+    1. Call the respective affiliate API (e.g., Amazon Product Advertising API) with the query.
+    2. Parse the API response to extract product details (ID, name, price, image, URL).
+    3. Generate an affiliate tracking link for the product URL using the platform's tools/API.
+    4. Handle API errors, rate limits, and authentication.
     """
-    print(f"Affiliate Manager: Searching for 
-'{query}
-' (limit {limit}) - Placeholder Implementation")
+    print(f"Affiliate Manager: Searching {platform} for '{query}' (limit {limit}) - Placeholder Implementation")
 
-    # --- Placeholder Logic --- 
+    # --- Placeholder Logic ---
     # Simulate API call and response parsing
     # Replace this with actual API calls to Amazon PAAPI, Magalu Parceiros, AliExpress Portals etc.
     # Requires specific credentials, SDKs, and handling for each platform.
-
     dummy_results = []
     for i in range(limit):
-        product_id = f"AFF_{query.replace(' ', '_').upper()}_{i+1}"
-        dummy_results.append(
-            AffiliateProduct(
-                id=product_id,
-                name=f"Produto Afiliado {i+1} para 
-'{query[:15]}...
-'",
-                price=f"R$ {99 + i*20:.2f}".replace(".", ","),
-                image_url=f"https://via.placeholder.com/150?text=Produto+{i+1}",
-                product_url=f"#product_link_{i+1}",
-                affiliate_link=f"#affiliate_link_{i+1}" # This should be a real tracking link
-            )
-        )
-    
-    print(f"Affiliate Manager: Found {len(dummy_results)} dummy products.")
+        price = 99 + i * 20
+        dummy_results.append({
+            "external_id": f"AFF_{platform.upper()}_{query.replace(' ', '_').upper()}_{i+1}",
+            "name": f"Produto Afiliado {i+1} para '{query[:15]}...'",
+            "price": float(price),
+            "price_display": f"R$ {price:.2f}".replace(".", ","),
+            "image_url": f"https://via.placeholder.com/150?text=Produto+{i+1}",
+            "product_url": f"#product_link_{i+1}",
+            "affiliate_link": f"#affiliate_link_{i+1}", # This should be a real tracking link
+        })
     return dummy_results
 
+# --- Provider Plugins ---
+
+class AffiliateProvider:
+    """
+    One affiliate platform integration. Subclasses set `name` and implement search(), returning
+    product dicts as described in fetch_from_platform, and get_prices() for wishlist price
+    tracking. Register instances with register_provider().
+    """
+    name: str = ""
+    price_batch_size: int = 10 # Product IDs per get_prices call (Amazon PA-API GetItems takes 10)
+
+    def __init__(self, timeout: Optional[float] = None):
+        # Deadline for one search call; slower answers are dropped (and count as failures)
+        self.timeout = timeout or settings.AFFILIATE_TIMEOUT_BY_PLATFORM.get(self.name, settings.AFFILIATE_TIMEOUT_SECONDS)
+
+    async def search(self, query: str, limit: int, country: str = "BR") -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def get_prices(self, external_ids: List[str], country: str = "BR") -> Dict[str, Optional[float]]:
+        """Current BRL price of each product (at most price_batch_size IDs); unavailable products are left out."""
+        raise NotImplementedError
+
+class PlaceholderProvider(AffiliateProvider):
+    """Stands in for a real platform client until its API integration exists."""
+
+    def __init__(self, name: str, timeout: Optional[float] = None):
+        self.name = name
+        super().__init__(timeout)
+
+    async def search(self, query: str, limit: int, country: str = "BR") -> List[Dict[str, Any]]:
+        return fetch_from_platform(self.name, query, limit, country)
+
+    async def get_prices(self, external_ids: List[str], country: str = "BR") -> Dict[str, Optional[float]]:
+        return {} # No price lookup API yet: tracked products keep their last known price
+
+class CircuitBreaker:
+    """
+    Stops calling a provider after `failure_threshold` consecutive failures. After
+    `reset_seconds` one trial call is let through (half-open): success closes the breaker,
+    failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+providers: Dict[str, AffiliateProvider] = {}
+breakers: Dict[str, CircuitBreaker] = {}
+provider_stats: Dict[str, Dict[str, int]] = {}
+
+def register_provider(provider: AffiliateProvider) -> None:
+    """Adds (or replaces) the provider used for `provider.name`."""
+    providers[provider.name] = provider
+    breakers[provider.name] = CircuitBreaker(settings.AFFILIATE_BREAKER_FAILURES, settings.AFFILIATE_BREAKER_RESET_SECONDS)
+    provider_stats[provider.name] = {"calls": 0, "errors": 0, "timeouts": 0, "short_circuited": 0}
+
+for _platform in settings.AFFILIATE_PLATFORMS:
+    register_provider(PlaceholderProvider(_platform))
+
+async def call_provider(provider: AffiliateProvider, call, action: str) -> Optional[Any]:
+    """Awaits `call()` within the provider's deadline and circuit breaker. Returns None if it failed or was skipped."""
+    breaker, stats = breakers[provider.name], provider_stats[provider.name]
+    if not breaker.allow():
+        stats["short_circuited"] += 1
+        return None
+    stats["calls"] += 1
+    try:
+        result = await asyncio.wait_for(call(), timeout=provider.timeout)
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+        breaker.record_failure()
+        print(f"WARNING: {action} on {provider.name} exceeded its {provider.timeout}s deadline")
+        return None
+    except Exception as e:
+        stats["errors"] += 1
+        breaker.record_failure()
+        print(f"ERROR: {action} on {provider.name} failed: {e}")
+        return None
+    breaker.record_success()
+    return result
+
+async def query_provider(provider: AffiliateProvider, query: str, limit: int, country: str = "BR") -> Optional[List[Dict[str, Any]]]:
+    """Searches one provider within its deadline and circuit breaker. Returns None if it failed or was skipped."""
+    return await call_provider(provider, lambda: provider.search(query, limit, country), "Product search")
+
+async def query_prices(provider: AffiliateProvider, external_ids: List[str], country: str = "BR") -> Optional[Dict[str, Optional[float]]]:
+    """Looks up prices on one provider within its deadline and circuit breaker. Returns None if it failed or was skipped."""
+    return await call_provider(provider, lambda: provider.get_prices(external_ids, country), "Price lookup")
+
+# --- Search ---
+
+async def search_platforms(db: Session, query: str, limit: int, country: str = "BR",
+                           platforms: Optional[List[str]] = None) -> Dict[str, List[Product]]:
+    """
+    Each platform's ranked results for `query`. Fresh cached results (younger than the
+    platform's PRODUCT_CACHE_TTL) are served from the DB; the other platforms are queried
+    concurrently, each bounded by its own deadline. A platform that fails or misses its
+    deadline falls back to its stale cached results, if any.
+    """
+    results: Dict[str, List[Product]] = {}
+    stale: Dict[str, List[Product]] = {}
+    to_fetch: List[str] = []
+    for platform in platforms or list(providers):
+        if platform not in providers:
+            print(f"WARNING: No affiliate provider registered for '{platform}'")
+            continue
+        cached = await asyncio.to_thread(get_cached_search, db, platform, query) # Sync session: off the event loop
+        ttl = settings.PRODUCT_CACHE_TTL_BY_PLATFORM.get(platform, settings.PRODUCT_CACHE_TTL_SECONDS)
+        if cached is not None and cached[1] <= ttl and len(cached[0]) >= min(limit, SEARCH_PAGE_SIZE):
+            search_stats["cache_hits"] += 1
+            results[platform] = cached[0]
+            continue
+        search_stats["cache_misses"] += 1
+        if cached is not None:
+            stale[platform] = cached[0]
+        to_fetch.append(platform)
+
+    fetch_size = max(limit, SEARCH_PAGE_SIZE)
+    fetched = await asyncio.gather(*(query_provider(providers[platform], query, fetch_size, country) for platform in to_fetch))
+    items_by_platform = {}
+    for platform, items in zip(to_fetch, fetched):
+        if items is None:
+            if platform in stale:
+                search_stats["stale_served"] += 1 # A stale result beats no result
+            results[platform] = stale.get(platform, [])
+        else:
+            items_by_platform[platform] = items
+    if items_by_platform:
+        stored = await asyncio.to_thread(store_search_results, db, query, items_by_platform, update_index=False)
+        # The live index is read on the event loop: update it here, not in the worker thread
+        search_index.index_products(product for products in stored.values() for product in products)
+        results.update(stored)
+    return {platform: results[platform] for platform in platforms or list(providers) if platform in results}
+
+def merge_results(per_platform: Dict[str, List[Product]], limit: int) -> List[Product]:
+    """
+    Merges the platforms' rankings with reciprocal rank fusion. The same product listed on
+    several platforms (same normalized name) counts once, as its cheapest offer, and
+    accumulates the score of every listing.
+    """
+    scores: Dict[str, float] = {}
+    best: Dict[str, Product] = {}
+    for products in per_platform.values():
+        for rank, product in enumerate(products):
+            key = product.normalized_name
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+            current = best.get(key)
+            if current is None or (product.price is not None and (current.price is None or product.price < current.price)):
+                best[key] = product
+    ranked = sorted(scores, key=lambda key: (-scores[key], best[key].price if best[key].price is not None else float("inf")))
+    return [best[key] for key in ranked[:limit]]
+
+async def search_products(query: str, limit: int = 5, country: str = "BR", db: Optional[Session] = None,
+                          platforms: Optional[List[str]] = None) -> List[AffiliateProduct]:
+    """
+    Searches for products across integrated affiliate platforms based on a query.
+
+    All enabled providers are queried in parallel (see search_platforms), so latency is that
+    of the slowest provider within its deadline rather than the sum of all of them. Results
+    are merged, deduplicated and ranked with merge_results.
+    """
+    own_session = db is None
+    db = db or SessionLocal()
+    try:
+        per_platform = await search_platforms(db, query, limit, country, platforms)
+        return [AffiliateProduct.from_model(product) for product in merge_results(per_platform, limit)]
+    finally:
+        if own_session:
+            db.close()
+
+def get_search_metrics() -> Dict[str, Any]:
+    lookups = search_stats["cache_hits"] + search_stats["cache_misses"]
+    return {
+        "hit_rate": round(search_stats["cache_hits"] / lookups, 3) if lookups else 0.0,
+        **search_stats,
+        "providers": {name: {"breaker": breakers[name].state, **stats} for name, stats in provider_stats.items()},
+    }
+
 def generate_affiliate_link(product_url: str, platform: str = "amazon") -> Optional[str]:
     """
     Generates an affiliate tracking link for a given product URL.
@@ -1,22 +1,77 @@
 # Service for interacting with the AI model (e.g., OpenAI)
 
+import asyncio
+import hashlib
+import re
+from typing import AsyncIterator, Dict, List, Optional
+import httpx
 import openai
 from .config import settings
 from .models import Message, User # To potentially use message history and user profile
-from sqlalchemy.orm import Session
-from .db_manager import get_user_messages, get_user_by_whatsapp_id # To fetch conversation history and user profile
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db_manager import load_conversation_state_async # To fetch conversation history
+from . import context_builder, llm_tools, llm_usage
+from .response_cache import response_cache
+from .profile_prompt import profile_blocks, block_fingerprint
 import json
 
 # Configure OpenAI client
+# A single AsyncOpenAI client is shared by every request so completions reuse one
+# keep-alive connection pool instead of blocking the event loop on a sync call.
 if settings.OPENAI_API_KEY:
-    # Consider using async client if available and beneficial
-    # from openai import AsyncOpenAI
-    # client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-    client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=settings.OPENAI_MAX_CONCURRENCY,
+            max_keepalive_connections=settings.OPENAI_MAX_CONCURRENCY,
+        )
+    )
+    client = openai.AsyncOpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        base_url=settings.OPENAI_BASE_URL,
+        timeout=settings.OPENAI_TIMEOUT_SECONDS,
+        max_retries=settings.OPENAI_MAX_RETRIES,
+        http_client=http_client,
+    )
 else:
     print("WARNING: OPENAI_API_KEY not found in environment variables. AI service will not function.")
     client = None
 
+# Caps concurrent completions so a burst of messages queues here instead of
+# opening unbounded connections (and hitting OpenAI rate limits all at once)
+llm_semaphore = asyncio.Semaphore(settings.OPENAI_MAX_CONCURRENCY)
+llm_stats = {"in_flight": 0, "waiting": 0, "completed": 0, "timeouts": 0}
+
+async def create_chat_completion(purpose: str = "reply", prefix_hash: Optional[str] = None, **kwargs):
+    """
+    Calls the chat completions API under the concurrency limiter with a per-call timeout.
+    Usage and latency are recorded under `purpose` (llm_usage.py).
+    """
+    llm_stats["waiting"] += 1
+    try:
+        await llm_semaphore.acquire()
+    finally:
+        llm_stats["waiting"] -= 1
+    llm_stats["in_flight"] += 1
+    try:
+        kwargs.setdefault("model", settings.OPENAI_MODEL)
+        kwargs.setdefault("timeout", settings.OPENAI_TIMEOUT_SECONDS)
+        timer = llm_usage.Timer()
+        response = await client.chat.completions.create(**kwargs)
+        llm_stats["completed"] += 1
+        llm_usage.record(response.model or kwargs["model"], purpose, response.usage, timer.elapsed_ms(), prefix_hash=prefix_hash)
+        return response
+    except openai.APITimeoutError:
+        llm_stats["timeouts"] += 1
+        raise
+    finally:
+        llm_stats["in_flight"] -= 1
+        llm_semaphore.release()
+
+async def close_client():
+    """Closes the shared OpenAI connection pool (call on application shutdown)."""
+    if client:
+        await client.close()
+
 # --- Enhanced System Prompt --- (Can be further refined)
 SYSTEM_PROMPT = """
 You are ShopperGPT, a friendly, expert, and highly personalized AI shopping assistant operating on WhatsApp.
@@ -43,77 +98,275 @@ Constraint: Always prioritize the user's stated needs and preferences.
 Constraint: Keep responses concise and suitable for WhatsApp chat format.
 """
 
-async def get_ai_response(user_id: int, user_message: str, db: Session) -> str:
-    """Gets a response from the AI model based on the user message, profile, and context."""
+# --- Static prompt prefix ---
+# Every reply prompt starts with these exact messages (per-user content comes after them, see
+# context_builder.build_conversation), so the provider's prompt cache can reuse the prefix.
+# Nothing per user or per request (names, dates, ids) may be added here; PREFIX_HASH is
+# recorded with each call so a deploy that changes the prefix shows up in the usage report.
+STATIC_PREFIX = {
+    False: [{"role": "system", "content": SYSTEM_PROMPT}],
+    True: [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "system", "content": llm_tools.TOOLS_PROMPT}], # With tool calling
+}
+PREFIX_HASH = {
+    tools: hashlib.sha1(json.dumps([messages, llm_tools.TOOLS if tools else None], ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+    for tools, messages in STATIC_PREFIX.items()
+}
+
+async def prepare_conversation(db: AsyncSession, user_id: int, user_message: str, tools: bool = False,
+                               message_id: Optional[str] = None) -> tuple[Optional[List[Dict[str, str]]], Optional[str], Optional[str]]:
+    """
+    Builds the chat messages for a turn (with the tool instructions when `tools` is set).
+    `message_id` is the whatsapp_message_id of the stored inbound message being answered: the
+    history then stops before it, even if later messages of the same batch are stored already.
+
+    Returns (conversation, cache_fingerprint, cached_reply). When the reply cache answers the
+    turn, conversation is None and cached_reply is set; cache_fingerprint is set when the
+    model's reply should be stored in the cache.
+    """
+    # 1. User profile: precomputed block, rebuilt only when the profile changes (profile_prompt.py)
+    profile = await profile_blocks.get_async(db, user_id)
+
+    # 2. Prepare Conversation History
+    # The per-user window is kept in memory (updated by create_message), so this only hits
+    # the DB on a cache miss; history is trimmed to CONTEXT_TOKEN_BUDGET tokens and older
+    # turns are represented by the rolling summary
+    window = await context_builder.conversation_cache.get_async(
+        user_id, lambda: load_conversation_state_async(db, user_id, limit=settings.CONTEXT_HISTORY_LOAD_LIMIT)
+    )
+    # The loads above autobegin a transaction on the request's session: end it now so the
+    # connection is not held idle in transaction through the LLM call
+    if db.in_transaction():
+        await db.commit()
+    # Stateless turns (no earlier context) can be answered from the reply cache
+    cache_fingerprint = None
+    if settings.RESPONSE_CACHE_ENABLED and context_builder.is_stateless_turn(window, user_message, message_id):
+        cache_fingerprint = block_fingerprint(profile)
+        cached_reply = response_cache.get(cache_fingerprint, user_message)
+        if cached_reply is not None:
+            print(f"Reply cache hit for user {user_id}: {user_message}")
+            return None, None, cached_reply
+
+    conversation = context_builder.build_conversation(STATIC_PREFIX[tools], window, user_message, profile=profile, message_id=message_id)
+    print(f"\n--- Sending to OpenAI for user {user_id} ---")
+    # print(json.dumps(conversation, indent=2))
+    print(f"Current User Message: {user_message}")
+    print(f"History length: {len(conversation) - 1} messages")
+    print("-------------------------------------\n")
+    return conversation, cache_fingerprint, None
+
+def error_reply(error: Exception) -> str:
+    """Logs an error from the AI call and returns the message to send to the user instead."""
+    if isinstance(error, openai.APITimeoutError):
+        print(f"ERROR: OpenAI request timed out after {settings.OPENAI_TIMEOUT_SECONDS}s.")
+        return "Desculpe, o serviço de IA demorou demais para responder. Tente novamente em instantes."
+    if isinstance(error, openai.AuthenticationError):
+        print("ERROR: OpenAI Authentication failed. Check your API key.")
+        return "Desculpe, houve um problema de autenticação com o serviço de IA."
+    if isinstance(error, openai.RateLimitError):
+        print("ERROR: OpenAI Rate Limit exceeded.")
+        return "Desculpe, estou recebendo muitas solicitações no momento. Tente novamente em breve."
+    if isinstance(error, openai.APIError):
+        print(f"ERROR: OpenAI API Error: {error}")
+        return "Desculpe, houve um problema com o serviço de IA. Tente novamente mais tarde."
+    print(f"ERROR: Unexpected error in get_ai_response: {error}")
+    # Consider logging the full traceback here
+    return "Desculpe, não consegui processar sua solicitação no momento devido a um erro inesperado."
+
+def tool_options(tool_context: Optional[llm_tools.ToolContext], round_index: int) -> Dict:
+    """Completion arguments that offer the tools (the last allowed round must answer in text)."""
+    if tool_context is None:
+        return {}
+    return {"tools": llm_tools.TOOLS, "tool_choice": "none" if round_index >= settings.LLM_MAX_TOOL_ROUNDS else "auto"}
+
+async def get_ai_response(user_id: int, user_message: str, db: AsyncSession, tool_context: Optional[llm_tools.ToolContext] = None,
+                          message_id: Optional[str] = None) -> str:
+    """
+    Gets a response from the AI model based on the user message, profile, and context.
+
+    With a `tool_context` the model may call the tools in llm_tools.py: the calls of each
+    completion run concurrently and their results are sent back in the same loop until the
+    model answers in text (at most LLM_MAX_TOOL_ROUNDS tool rounds).
+    """
     if not client:
         return "Desculpe, o serviço de IA não está configurado corretamente."
 
+    llm_usage.current_user.set(user_id)
     try:
-        # 1. Fetch User Profile (Optional, but useful for personalization)
-        # user = get_user_by_whatsapp_id(db, whatsapp_id=...) # Need whatsapp_id here, maybe pass it?
-        # For now, we only have user_id
-        # user_profile_info = f"User Profile: Style={user.style_preferences}, Budget={user.budget_range}" # Example
-
-        # 2. Fetch & Prepare Conversation History
-        history_messages = get_user_messages(db, user_id, limit=20) # Increase limit slightly
-        history_messages.reverse() # Order from oldest to newest
-
-        conversation = [
-            {"role": "system", "content": SYSTEM_PROMPT}
-            # Add user profile info here if available and relevant
-            # {"role": "system", "content": user_profile_info}
-        ]
-
-        # Simple context window management: Add messages until near token limit
-        # A more robust approach would use token counting (e.g., tiktoken library)
-        # For now, limit message count
-        max_history = 10 # Limit to last 5 back-and-forths approx
-        start_index = max(0, len(history_messages) - max_history)
-
-        for msg in history_messages[start_index:]:
-            role = "user" if msg.sender == "user" else "assistant"
-            conversation.append({"role": role, "content": msg.content})
-
-        # Add the current user message
-        conversation.append({"role": "user", "content": user_message})
-
-        # 3. Call OpenAI API
-        print(f"\n--- Sending to OpenAI for user {user_id} ---")
-        # print(json.dumps(conversation, indent=2))
-        print(f"Current User Message: {user_message}")
-        print(f"History length: {len(conversation) - 1} messages")
-        print("-------------------------------------\n")
-
-        # Using await client.chat.completions.create if using async client
-        response = client.chat.completions.create(
-            model="gpt-4o-mini", # Using a more recent/capable model if budget allows
-            messages=conversation,
-            max_tokens=300, # Increased slightly for potentially more detailed answers
-            temperature=0.6, # Slightly lower for more focused responses
-            # Add other parameters like frequency_penalty, presence_penalty if needed
-        )
+        conversation, cache_fingerprint, cached_reply = await prepare_conversation(db, user_id, user_message, tools=tool_context is not None, message_id=message_id)
+        if cached_reply is not None:
+            return cached_reply
 
-        ai_message = response.choices[0].message.content.strip()
-        usage = response.usage
-        print(f"\n--- OpenAI Response --- ({usage.total_tokens} tokens used)")
+        # 3. Call OpenAI API (again after each round of tool calls)
+        round_index = 0
+        while True:
+            response = await create_chat_completion(
+                messages=conversation,
+                max_tokens=300, # Increased slightly for potentially more detailed answers
+                temperature=0.6, # Slightly lower for more focused responses
+                # Add other parameters like frequency_penalty, presence_penalty if needed
+                prefix_hash=PREFIX_HASH[tool_context is not None],
+                **tool_options(tool_context, round_index),
+            )
+            message = response.choices[0].message
+            if not message.tool_calls or tool_context is None or round_index >= settings.LLM_MAX_TOOL_ROUNDS:
+                break
+            tool_calls = [call.model_dump(include={"id", "type", "function"}) for call in message.tool_calls]
+            print(f"Tool calls for user {user_id}: {', '.join(call['function']['name'] for call in tool_calls)}")
+            conversation = conversation + [{"role": "assistant", "content": message.content, "tool_calls": tool_calls}]
+            conversation += await llm_tools.run_tool_calls(tool_context, tool_calls)
+            round_index += 1
+
+        ai_message = (message.content or "").strip()
+        print("\n--- OpenAI Response ---") # Token usage is recorded per call in llm_calls (llm_usage.py)
         print(ai_message)
         print("----------------------\n")
 
+        # A reply built on tool results is not reusable for another user
+        if cache_fingerprint is not None and ai_message and not (tool_context and tool_context.calls):
+            response_cache.put(cache_fingerprint, user_message, ai_message)
+
         return ai_message
 
-    except openai.AuthenticationError:
-        print("ERROR: OpenAI Authentication failed. Check your API key.")
-        return "Desculpe, houve um problema de autenticação com o serviço de IA."
-    except openai.RateLimitError:
-        print("ERROR: OpenAI Rate Limit exceeded.")
-        return "Desculpe, estou recebendo muitas solicitações no momento. Tente novamente em breve."
-    except openai.APIError as e:
-        print(f"ERROR: OpenAI API Error: {e}")
-        return "Desculpe, houve um problema com o serviço de IA. Tente novamente mais tarde."
     except Exception as e:
-        print(f"ERROR: Unexpected error in get_ai_response: {e}")
-        # Consider logging the full traceback here
-        return "Desculpe, não consegui processar sua solicitação no momento devido a um erro inesperado."
+        return error_reply(e)
 
-# Placeholder for future enhancements like visual recognition, context integration (weather, etc.)
+# --- Streaming ---
+
+class ReplyChunker:
+    """
+    Cuts streamed text into WhatsApp-sized pieces at paragraph or sentence boundaries.
+
+    A paragraph break always ends a chunk; a sentence end does once the chunk has at least
+    `min_chars` characters, so short sentences are grouped instead of sent one by one.
+    """
+    SENTENCE_END = re.compile(r"[.!?…](?=\s)|\n")
+
+    def __init__(self, min_chars: int):
+        self.min_chars = min_chars
+        self.buffer = ""
+        self._whitespace = "" # Whitespace-only pieces are carried into the next chunk, so "".join(chunks) == text
+
+    def feed(self, text: str) -> List[str]:
+        self.buffer += text
+        chunks = []
+        while True:
+            paragraph = self.buffer.find("\n\n")
+            if paragraph != -1:
+                cut = paragraph + 2
+            else:
+                cut = None
+                for match in self.SENTENCE_END.finditer(self.buffer, self.min_chars - 1 if self.min_chars else 0):
+                    # Only cut once the following whitespace has arrived (the sentence is complete)
+                    cut = match.end()
+                    break
+                if cut is None or cut >= len(self.buffer):
+                    return chunks
+            chunk, self.buffer = self.buffer[:cut], self.buffer[cut:]
+            if chunk.strip():
+                chunks.append(self._whitespace + chunk)
+                self._whitespace = ""
+            else:
+                self._whitespace += chunk
+
+    def flush(self) -> Optional[str]:
+        chunk, self.buffer = self._whitespace + self.buffer, ""
+        self._whitespace = ""
+        return chunk if chunk.strip() else None
 
+async def stream_chat_completion(tool_calls: Optional[List[Dict]] = None, purpose: str = "reply", prefix_hash: Optional[str] = None,
+                                 **kwargs) -> AsyncIterator[str]:
+    """
+    Streams completion text deltas, holding a concurrency slot until the stream ends.
+    Tool calls in the stream are assembled into `tool_calls` (OpenAI message format).
+    Usage (sent in the last event), latency and time to first token are recorded as in
+    create_chat_completion.
+    """
+    async with llm_semaphore:
+        llm_stats["in_flight"] += 1
+        try:
+            kwargs.setdefault("model", settings.OPENAI_MODEL)
+            kwargs.setdefault("timeout", settings.OPENAI_TIMEOUT_SECONDS)
+            kwargs.setdefault("stream_options", {"include_usage": True})
+            timer = llm_usage.Timer()
+            model, usage = kwargs["model"], None
+            stream = await client.chat.completions.create(stream=True, **kwargs)
+            async for event in stream:
+                model = event.model or model
+                usage = event.usage or usage
+                if not event.choices:
+                    continue
+                delta = event.choices[0].delta
+                if delta.content or delta.tool_calls:
+                    timer.mark_first_token()
+                if delta.content:
+                    yield delta.content
+                for call in delta.tool_calls or []: # Arrive in pieces: id and name first, then the arguments
+                    if tool_calls is None:
+                        continue
+                    while len(tool_calls) <= call.index:
+                        tool_calls.append({"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                    assembled = tool_calls[call.index]
+                    if call.id:
+                        assembled["id"] = call.id
+                    if call.function and call.function.name:
+                        assembled["function"]["name"] += call.function.name
+                    if call.function and call.function.arguments:
+                        assembled["function"]["arguments"] += call.function.arguments
+            llm_stats["completed"] += 1
+            llm_usage.record(model, purpose, usage, timer.elapsed_ms(), first_token_ms=timer.first_token_ms, prefix_hash=prefix_hash)
+        except openai.APITimeoutError:
+            llm_stats["timeouts"] += 1
+            raise
+        finally:
+            llm_stats["in_flight"] -= 1
+
+async def stream_ai_response(user_id: int, user_message: str, db: AsyncSession, tool_context: Optional[llm_tools.ToolContext] = None,
+                             message_id: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Streaming variant of get_ai_response: yields the reply in chunks (see ReplyChunker) as soon
+    as each is complete. Joining the chunks gives the full reply. On errors a user-facing
+    error message is yielded instead of (or after) the partial reply. Tool calls are handled
+    as in get_ai_response; text the model writes before calling a tool is streamed too.
+    """
+    if not client:
+        yield "Desculpe, o serviço de IA não está configurado corretamente."
+        return
+
+    llm_usage.current_user.set(user_id)
+    try:
+        conversation, cache_fingerprint, cached_reply = await prepare_conversation(db, user_id, user_message, tools=tool_context is not None, message_id=message_id)
+        if cached_reply is not None:
+            yield cached_reply
+            return
+
+        chunker = ReplyChunker(min_chars=settings.STREAM_MIN_CHUNK_CHARS)
+        parts = []
+        round_index = 0
+        while True:
+            tool_calls: List[Dict] = []
+            round_parts = []
+            async for delta in stream_chat_completion(tool_calls=tool_calls, messages=conversation, max_tokens=300, temperature=0.6,
+                                                      prefix_hash=PREFIX_HASH[tool_context is not None], **tool_options(tool_context, round_index)):
+                round_parts.append(delta)
+                for chunk in chunker.feed(delta):
+                    yield chunk
+            parts += round_parts
+            if not tool_calls or tool_context is None or round_index >= settings.LLM_MAX_TOOL_ROUNDS:
+                break
+            print(f"Tool calls for user {user_id}: {', '.join(call['function']['name'] for call in tool_calls)}")
+            conversation = conversation + [{"role": "assistant", "content": "".join(round_parts) or None, "tool_calls": tool_calls}]
+            conversation += await llm_tools.run_tool_calls(tool_context, tool_calls)
+            round_index += 1
+        tail = chunker.flush()
+        if tail:
+            yield tail
+
+        ai_message = "".join(parts).strip()
+        print(f"\n--- OpenAI Streamed Response ---\n{ai_message}\n----------------------\n")
+        if cache_fingerprint is not None and ai_message and not (tool_context and tool_context.calls):
+            response_cache.put(cache_fingerprint, user_message, ai_message)
+
+    except Exception as e:
+        yield error_reply(e)
+
+# Placeholder for future enhancements like visual recognition, context integration (weather, etc.)
@@ -0,0 +1,136 @@
+# Offline item-item collaborative filtering
+#
+# Batch job (run it periodically, e.g. from a cron job: `python -m src.collaborative_filtering`):
+# 1. Streams (user, product) interactions from wishlist_items and recommendation_clicks in
+#    batches (yield_per) into a sparse user-item matrix held as NumPy COO/CSR arrays.
+# 2. For each item, computes the cosine similarity with every co-occurring item through the
+#    users it shares with them, and keeps the CF_TOP_K most similar.
+# 3. Replaces the item_neighbors table in one transaction, inserting in batches.
+# Memory is linear in the number of interactions (a few arrays of 4-8 bytes per row) plus one
+# item's co-occurrences at a time; items with more than CF_MAX_USERS_PER_ITEM users are
+# computed on a random sample of them to bound the work. At request time
+# db_manager.get_collaborative_scores turns the user's wishlist into scores with one query.
+
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import delete, insert
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .models import ItemNeighbor, RecommendationClick, SessionLocal, WishlistItem
+
+def read_interactions(db: Session, batch_size: int) -> Iterator[Tuple[List[int], List[str], float]]:
+    """Yields (user_ids, product_ids, weight) batches of wishlist additions and recommendation clicks."""
+    sources = (
+        (WishlistItem.user_id, WishlistItem.product_id, settings.CF_WISHLIST_WEIGHT),
+        (RecommendationClick.user_id, RecommendationClick.product_id, settings.CF_CLICK_WEIGHT),
+    )
+    for user_column, product_column, weight in sources:
+        users, products = [], []
+        for user_id, product_id in db.query(user_column, product_column).filter(product_column.isnot(None)).yield_per(batch_size):
+            users.append(user_id)
+            products.append(product_id)
+            if len(users) >= batch_size:
+                yield users, products, weight
+                users, products = [], []
+        if users:
+            yield users, products, weight
+
+def build_matrix(batches) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]]:
+    """
+    Sparse user-item matrix from interaction batches, duplicates summed.
+    Returns (user ids, item codes, weights) sorted by user then item, and code -> product id.
+    """
+    codes: Dict[str, int] = {}
+    user_chunks, item_chunks, weight_chunks = [], [], []
+    for users, products, weight in batches:
+        user_chunks.append(np.asarray(users, dtype=np.int64))
+        item_chunks.append(np.fromiter((codes.setdefault(product, len(codes)) for product in products), dtype=np.int64, count=len(products)))
+        weight_chunks.append(np.full(len(users), weight, dtype=np.float64))
+    item_ids = list(codes)
+    if not user_chunks:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float64), item_ids
+    keys = np.concatenate(user_chunks) * len(item_ids) + np.concatenate(item_chunks)
+    weights = np.concatenate(weight_chunks)
+    del user_chunks, item_chunks, weight_chunks
+    keys, inverse = np.unique(keys, return_inverse=True)
+    weights = np.bincount(inverse, weights=weights)
+    return keys // len(item_ids), keys % len(item_ids), weights, item_ids
+
+def compute_neighbors(users: np.ndarray, items: np.ndarray, weights: np.ndarray, n_items: int, top_k: int,
+                      max_users_per_item: int, seed: int = 0) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """Yields (item, neighbor items, cosine scores) for every item with at least one neighbor, best first."""
+    rng = np.random.default_rng(seed)
+    # Rows by user (input order) and by item
+    user_values, user_starts, user_counts = np.unique(users, return_index=True, return_counts=True)
+    user_rows = np.searchsorted(user_values, users) # Compact user index of every entry
+    by_item = np.argsort(items, kind="stable")
+    item_starts = np.searchsorted(items[by_item], np.arange(n_items + 1))
+    norms = np.sqrt(np.bincount(items, weights=weights ** 2, minlength=n_items))
+
+    for item in range(n_items):
+        entries = by_item[item_starts[item]:item_starts[item + 1]]
+        if len(entries) > max_users_per_item:
+            entries = rng.choice(entries, max_users_per_item, replace=False)
+        rows, row_weights = user_rows[entries], weights[entries]
+        starts, counts = user_starts[rows], user_counts[rows]
+        total = int(counts.sum())
+        if total <= len(rows): # Its users interacted with nothing else
+            continue
+        # Positions of every item of those users (CSR gather without a Python loop)
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        co_items, co_inverse = np.unique(items[positions], return_inverse=True)
+        dots = np.bincount(co_inverse, weights=weights[positions] * np.repeat(row_weights, counts))
+        scores = dots / (norms[item] * norms[co_items])
+        scores[co_items == item] = 0.0
+        if len(scores) > top_k:
+            top = np.argpartition(-scores, top_k)[:top_k]
+            co_items, scores = co_items[top], scores[top]
+        keep = scores > 0
+        co_items, scores = co_items[keep], scores[keep]
+        order = np.argsort(-scores, kind="stable")
+        if len(order):
+            yield item, co_items[order], scores[order]
+
+def build_item_neighbors(db: Session, top_k: Optional[int] = None, batch_size: Optional[int] = None) -> Dict[str, float]:
+    """Runs the whole job and replaces item_neighbors. Returns run statistics."""
+    top_k = top_k or settings.CF_TOP_K
+    batch_size = batch_size or settings.CF_BATCH_SIZE
+    started = time.perf_counter()
+    users, items, weights, item_ids = build_matrix(read_interactions(db, batch_size))
+    loaded = time.perf_counter()
+    print(f"CF: {len(weights)} user-item pairs, {len(np.unique(users))} users, {len(item_ids)} items loaded in {loaded - started:.1f}s")
+
+    written, rows = 0, []
+    try:
+        db.execute(delete(ItemNeighbor))
+        for item, neighbors, scores in compute_neighbors(users, items, weights, len(item_ids), top_k, settings.CF_MAX_USERS_PER_ITEM):
+            item_id = item_ids[item]
+            rows.extend(
+                {"item_id": item_id, "rank": rank, "neighbor_id": item_ids[neighbor], "score": float(score)}
+                for rank, (neighbor, score) in enumerate(zip(neighbors.tolist(), scores.tolist()))
+            )
+            if len(rows) >= batch_size:
+                db.execute(insert(ItemNeighbor), rows)
+                written += len(rows)
+                rows = []
+        if rows:
+            db.execute(insert(ItemNeighbor), rows)
+            written += len(rows)
+        db.commit() # Readers keep seeing the previous neighbors until here
+    except Exception:
+        db.rollback()
+        raise
+    stats = {"pairs": len(weights), "items": len(item_ids), "neighbors_written": written,
+             "load_seconds": round(loaded - started, 2), "total_seconds": round(time.perf_counter() - started, 2)}
+    print(f"CF: wrote {written} item neighbors in {stats['total_seconds']}s")
+    return stats
+
+if __name__ == "__main__":
+    session = SessionLocal()
+    try:
+        build_item_neighbors(session)
+    finally:
+        session.close()
@@ -0,0 +1,234 @@
+# Conversation context assembly for the LLM
+#
+# Keeps a rolling window of each user's recent messages in memory so the hot path does not
+# query the messages table on every inbound message. Windows are filled from the DB on first
+# use, appended to by db_manager whenever a message is stored, and evicted LRU once the cache
+# exceeds CONTEXT_CACHE_MAX_BYTES. History is trimmed by token budget, not by message count.
+# A webhook batch stores all its inbound messages before any is answered, so entries carry
+# their whatsapp_message_id: a reply (ai_<id>) is placed right after the message it answers,
+# and the prompt for a message only has the history before it (not the later messages).
+# Older turns folded into the user's rolling summary (summarizer.py) are not part of the
+# window; the summary is carried alongside it and prepended to the prompt.
+
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .config import settings
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base") # Tokenizer used by gpt-4o / gpt-4o-mini
+except Exception: # Not installed, or encoding files unavailable offline
+    _encoding = None
+
+MESSAGE_OVERHEAD_TOKENS = 4 # Role/separator tokens the chat format adds per message
+ENTRY_OVERHEAD_BYTES = 96 # Rough per-message bookkeeping cost in the cache
+
+def estimate_tokens(text: str) -> int:
+    """Token count of `text` (exact with tiktoken, otherwise ~4 characters per token)."""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+class ConversationWindow:
+    """A user's most recent messages, oldest first, capped at CONTEXT_WINDOW_MAX_TOKENS."""
+
+    def __init__(self, max_tokens: int, summary: Optional[str] = None):
+        self.max_tokens = max_tokens
+        self.summary = summary
+        self.entries: deque = deque() # (role, content, tokens, whatsapp_message_id)
+        self.tokens = 0
+        self.size_bytes = len(summary.encode("utf-8")) if summary else 0
+        self.loaded_at = time.monotonic()
+        self.first_index = 0 # Position of entries[0] in the conversation (grows as old entries are dropped)
+        self.history_start = 0 # Position where the prompt history starts (see history())
+        self.messages_since_extraction = 0 # User messages since the last profile extraction (profile_extractor.py)
+
+    def append(self, role: str, content: str, message_id: Optional[str] = None) -> None:
+        """Adds a message at the end, or a reply (ai_<id>) right after the message it answers."""
+        tokens = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        entry = (role, content, tokens, message_id)
+        answered = self.position(message_id[len("ai_"):]) if message_id and message_id.startswith("ai_") else None
+        if answered is None:
+            self.entries.append(entry)
+        else:
+            self.entries.insert(answered + 1 - self.first_index, entry)
+            if answered + 1 <= self.history_start: # Its message is no longer in the prompt history; keep it out too
+                self.history_start += 1
+        self.tokens += tokens
+        self.size_bytes += len(content.encode("utf-8")) + ENTRY_OVERHEAD_BYTES
+        while len(self.entries) > 1 and self.tokens > self.max_tokens:
+            _, old_content, old_tokens, _ = self.entries.popleft()
+            self.first_index += 1
+            self.tokens -= old_tokens
+            self.size_bytes -= len(old_content.encode("utf-8")) + ENTRY_OVERHEAD_BYTES
+
+    def last_messages(self, token_budget: int) -> List[Dict[str, str]]:
+        """Newest messages that fit in `token_budget`, returned oldest first."""
+        selected, used = [], 0
+        for role, content, tokens, _ in reversed(self.entries):
+            if used + tokens > token_budget:
+                break
+            selected.append({"role": role, "content": content})
+            used += tokens
+        selected.reverse()
+        return selected
+
+    def position(self, message_id: str) -> Optional[int]:
+        """Position (as in first_index) of the message with this whatsapp_message_id, if in the window."""
+        for index in range(len(self.entries) - 1, -1, -1): # Usually one of the newest
+            if self.entries[index][3] == message_id:
+                return self.first_index + index
+        return None
+
+    def history(self, token_budget: int, trim_step: int, end: Optional[int] = None) -> List[Dict[str, str]]:
+        """
+        Messages from history_start up to position `end` (excluded; default: the newest),
+        oldest first, within `token_budget`.
+
+        The start only moves forward, and then past at least `trim_step` tokens at once, so
+        consecutive turns send the same leading history (a prefix the provider can serve from
+        its prompt cache) instead of dropping one old message per turn.
+        """
+        start = max(self.history_start, self.first_index)
+        entries = list(self.entries)[start - self.first_index:None if end is None else max(end - self.first_index, 0)]
+        used = sum(entry[2] for entry in entries)
+        if used > token_budget:
+            target = max(token_budget - trim_step, 0)
+            dropped = 0
+            while dropped < len(entries) and used > target:
+                used -= entries[dropped][2]
+                dropped += 1
+            entries = entries[dropped:]
+            start += dropped
+        self.history_start = start
+        return [{"role": role, "content": content} for role, content, _, _ in entries]
+
+class ConversationCache:
+    """LRU map of user_id -> ConversationWindow bounded by total (approximate) memory."""
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, window_max_tokens: int):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds # Reload from the DB now and then (other workers also write messages)
+        self.window_max_tokens = window_max_tokens
+        self._windows: "OrderedDict[int, ConversationWindow]" = OrderedDict()
+        self.size_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, user_id: int, loader: Callable[[], Tuple[Optional[str], Iterable]]) -> ConversationWindow:
+        """
+        Returns the user's window. On a miss it is loaded with `loader()`, which returns
+        (summary text or None, unsummarized Message rows newest first).
+        """
+        window = self._lookup(user_id)
+        if window is not None:
+            return window
+        return self._fill(user_id, *loader())
+
+    async def get_async(self, user_id: int, loader: Callable[[], Awaitable[Tuple[Optional[str], Iterable]]]) -> ConversationWindow:
+        """get() with an async loader (AsyncSession queries)."""
+        window = self._lookup(user_id)
+        if window is not None:
+            return window
+        return self._fill(user_id, *await loader())
+
+    def _lookup(self, user_id: int) -> Optional[ConversationWindow]:
+        window = self._windows.get(user_id)
+        if window is not None and time.monotonic() - window.loaded_at < self.ttl_seconds:
+            self.stats["hits"] += 1
+            self._windows.move_to_end(user_id)
+            return window
+        self.stats["misses"] += 1
+        self.invalidate(user_id)
+        return None
+
+    def _fill(self, user_id: int, summary: Optional[str], messages: Iterable) -> ConversationWindow:
+        window = ConversationWindow(self.window_max_tokens, summary=summary)
+        for message in reversed(list(messages)):
+            window.append(role_for(message.sender), message.content, message.whatsapp_message_id)
+        self._store(user_id, window)
+        return window
+
+    def peek(self, user_id: int) -> Optional[ConversationWindow]:
+        """The cached window, if any, without loading or touching LRU order."""
+        return self._windows.get(user_id)
+
+    def append(self, user_id: int, sender: str, content: str, message_id: Optional[str] = None) -> None:
+        """Adds a stored message to the user's window if it is cached (otherwise the next get loads it)."""
+        window = self._windows.get(user_id)
+        if window is None:
+            return
+        self.size_bytes -= window.size_bytes
+        window.append(role_for(sender), content, message_id)
+        self._store(user_id, window)
+
+    def invalidate(self, user_id: int) -> None:
+        window = self._windows.pop(user_id, None)
+        if window is not None:
+            self.size_bytes -= window.size_bytes
+
+    def _store(self, user_id: int, window: ConversationWindow) -> None:
+        self._windows[user_id] = window
+        self._windows.move_to_end(user_id)
+        self.size_bytes += window.size_bytes
+        while self.size_bytes > self.max_bytes and len(self._windows) > 1:
+            _, evicted = self._windows.popitem(last=False)
+            self.size_bytes -= evicted.size_bytes
+            self.stats["evictions"] += 1
+
+    def metrics(self) -> Dict[str, int]:
+        return {"users": len(self._windows), "size_bytes": self.size_bytes, "max_bytes": self.max_bytes, **self.stats}
+
+def role_for(sender: str) -> str:
+    return "user" if sender == "user" else "assistant"
+
+conversation_cache = ConversationCache(
+    max_bytes=settings.CONTEXT_CACHE_MAX_BYTES,
+    ttl_seconds=settings.CONTEXT_CACHE_TTL_SECONDS,
+    window_max_tokens=settings.CONTEXT_WINDOW_MAX_TOKENS,
+)
+
+def record_message(user_id: int, sender: str, content: str, message_id: Optional[str] = None) -> None:
+    """Called by db_manager after a message is committed."""
+    conversation_cache.append(user_id, sender, content, message_id)
+
+def is_stateless_turn(window: ConversationWindow, user_message: str, message_id: Optional[str] = None) -> bool:
+    """True when there is no earlier context (no summary, no history before the current message)."""
+    if window.summary:
+        return False
+    end = window.position(message_id) if message_id else None
+    if end is not None:
+        return end == 0 # Nothing before it, not even dropped entries
+    entries = list(window.entries)
+    if entries and entries[-1][:2] == ("user", user_message):
+        entries.pop()
+    return not entries
+
+def build_conversation(static_messages: List[Dict[str, str]], window: ConversationWindow, user_message: str,
+                       profile: Optional[str] = None, token_budget: Optional[int] = None,
+                       message_id: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    Assembles the chat messages, least to most volatile so consecutive prompts share the
+    longest possible prefix (OpenAI caches prompt prefixes of 1024+ tokens):
+    1. `static_messages`: identical bytes for every user and turn (nothing per user or per
+       request may go here)
+    2. the user's profile block (changes when the profile does)
+    3. the rolling summary of older turns (changes when the summarizer runs)
+    4. recent history within `token_budget` (CONTEXT_TOKEN_BUDGET by default), trimmed in
+       CONTEXT_TRIM_STEP_TOKENS steps (see ConversationWindow.history); with `message_id`
+       (the current message's whatsapp_message_id), only what came before that message
+    5. the current user message
+    """
+    token_budget = token_budget or settings.CONTEXT_TOKEN_BUDGET
+    end = window.position(message_id) if message_id else None
+    history = window.history(token_budget, settings.CONTEXT_TRIM_STEP_TOKENS, end=end)
+    # Without its id, the inbound message (stored before the LLM call) is the newest entry
+    if end is None and history and history[-1] == {"role": "user", "content": user_message}:
+        history.pop()
+    messages = list(static_messages)
+    if profile:
+        messages.append({"role": "system", "content": profile})
+    if window.summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation with this user:\n{window.summary}"})
+    return [*messages, *history, {"role": "user", "content": user_message}]
@@ -1,10 +1,19 @@
 # Database session management and basic CRUD operations
 
-from sqlalchemy.orm import Session
-from sqlalchemy import update, func # Import func for server_default
-from .models import Base, engine, SessionLocal, User, Message, WishlistItem
+from sqlalchemy.orm import Session, raiseload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import update, func, inspect, text, select, insert, or_ # Import func for server_default
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateIndex
+from .models import Base, engine, SessionLocal, AsyncSessionLocal, User, Message, WishlistItem, ConversationSummary, Product, ProductSearchCache, RecommendationClick, ItemNeighbor, PriceHistory, LLMCall
 from .config import settings
-from typing import List, Optional, Dict, Any
+from . import context_builder, search_index
+from .profile_prompt import PROFILE_FIELDS, profile_blocks
+from .recommendation_cache import recommendation_cache
+from .text_utils import normalize, format_price
+import time
+from datetime import datetime
+from typing import Iterable, List, Optional, Dict, Any
 
 def get_db():
     """Dependency to get a database session."""
@@ -14,6 +23,11 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    """Dependency to get an async database session (webhook hot path)."""
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def init_db():
     """Initializes the database by creating tables."""
     print("Initializing database...")
@@ -21,9 +35,81 @@ def init_db():
     try:
         Base.metadata.create_all(bind=engine)
         print("Database tables checked/created.")
+        run_migrations()
     except Exception as e:
         print(f"ERROR initializing database: {e}")
 
+def run_migrations():
+    """Applies schema changes that create_all cannot make on existing databases (idempotent)."""
+    inspector = inspect(engine)
+    if "messages" in inspector.get_table_names():
+        indexes = {index["name"]: index for index in inspector.get_indexes("messages")}
+        message_id_index = indexes.get("ix_messages_whatsapp_message_id")
+        if message_id_index is not None and not message_id_index["unique"]:
+            print("Migrating: making messages.whatsapp_message_id unique...")
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text("DROP INDEX ix_messages_whatsapp_message_id"))
+                    conn.execute(text("CREATE UNIQUE INDEX ix_messages_whatsapp_message_id ON messages (whatsapp_message_id)"))
+            except Exception as e:
+                print(f"ERROR: Could not add unique index on messages.whatsapp_message_id (remove duplicated rows first): {e}")
+    add_missing_columns(inspector)
+    create_missing_indexes(inspector)
+
+def add_missing_columns(inspector) -> None:
+    """Adds the nullable columns declared on the models that existing tables do not have yet."""
+    existing_tables = set(inspector.get_table_names())
+    quote = engine.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in present:
+                continue
+            if not column.nullable:
+                print(f"ERROR: Cannot add NOT NULL column {table.name}.{column.name} automatically")
+                continue
+            print(f"Migrating: adding column {table.name}.{column.name}...")
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column.type.compile(dialect=engine.dialect)}"))
+
+def create_missing_indexes(inspector) -> None:
+    """
+    Creates the indexes declared on the models that existing tables do not have yet.
+    On PostgreSQL they are built CONCURRENTLY, so large tables keep accepting writes meanwhile.
+    """
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in present:
+                continue
+            print(f"Migrating: creating index {index.name} on {table.name}...")
+            started = time.perf_counter()
+            try:
+                if engine.dialect.name == "postgresql":
+                    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+                    index.dialect_options["postgresql"]["concurrently"] = True
+                    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                        conn.execute(CreateIndex(index))
+                else:
+                    with engine.begin() as conn:
+                        conn.execute(CreateIndex(index))
+                print(f"Created index {index.name} in {time.perf_counter() - started:.1f}s")
+            except Exception as e:
+                print(f"ERROR: Could not create index {index.name}: {e}")
+            finally:
+                index.dialect_options["postgresql"]["concurrently"] = False
+
+def insert_stmt(db: Session | AsyncSession, model):
+    """Dialect-specific INSERT that supports ON CONFLICT ... DO NOTHING (PostgreSQL and SQLite)."""
+    if db.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
 # --- User CRUD Operations ---
 
 def get_user_by_whatsapp_id(db: Session, whatsapp_id: str) -> User | None:
@@ -43,8 +129,35 @@ def create_user(db: Session, phone_number: str, whatsapp_id: str, profile_name:
     print(f"Created user {db_user.id} for whatsapp_id {whatsapp_id}")
     return db_user
 
-def update_user_profile(db: Session, whatsapp_id: str, profile_data: Dict[str, Any]) -> User | None:
-    """Updates a user's profile information."""
+def list_users(db: Session, limit: int = 100, before_id: Optional[int] = None) -> tuple[list[User], Optional[int]]:
+    """
+    One page of users, newest first, with keyset pagination.
+
+    Pass the returned cursor as before_id to get the next page (None on the last page).
+    Unlike OFFSET, every page costs the same however deep it is (primary key range scan).
+    """
+    stmt = select(User).options(raiseload("*")).order_by(User.id.desc()).limit(limit + 1) # One extra row tells whether there is a next page
+    if before_id is not None:
+        stmt = stmt.where(User.id < before_id)
+    users = list(db.scalars(stmt))
+    next_before_id = users[limit - 1].id if len(users) > limit else None
+    return users[:limit], next_before_id
+
+def get_user_details(db: Session, whatsapp_id: str, message_limit: int, wishlist_limit: int) -> tuple[User, list[Message], list[WishlistItem]] | None:
+    """
+    User plus their latest messages and wishlist items for the admin pages, in three bounded
+    queries. The user's relationships are raiseload: templates cannot trigger lazy (N+1) loads.
+    """
+    user = db.scalars(select(User).options(raiseload("*")).where(User.whatsapp_id == whatsapp_id).limit(1)).first()
+    if user is None:
+        return None
+    return user, get_user_messages(db, user.id, limit=message_limit), get_wishlist_items(db, user.id, limit=wishlist_limit)
+
+def update_user_profile(db: Session, whatsapp_id: str, profile_data: Dict[str, Any], update_caches: bool = True) -> User | None:
+    """
+    Updates a user's profile information. Callers running it in a worker thread pass
+    update_caches=False and call profile_updated on the event loop afterwards.
+    """
     # Filter out keys that are not part of the User model's profile fields
     allowed_fields = ["profile_name", "style_preferences", "budget_range", "preferred_categories", "brand_preferences", "sizes", "shopping_context"]
     update_data = {k: v for k, v in profile_data.items() if k in allowed_fields}
@@ -59,7 +172,10 @@ def update_user_profile(db: Session, whatsapp_id: str, profile_data: Dict[str, A
         db.commit()
         if result.rowcount > 0:
             print(f"Updated profile for user {whatsapp_id}")
-            return get_user_by_whatsapp_id(db, whatsapp_id)
+            user = get_user_by_whatsapp_id(db, whatsapp_id)
+            if update_caches:
+                profile_updated(user, update_data)
+            return user
         else:
             print(f"User {whatsapp_id} not found for profile update.")
             return None
@@ -68,47 +184,347 @@ def update_user_profile(db: Session, whatsapp_id: str, profile_data: Dict[str, A
         print(f"Error updating user profile for {whatsapp_id}: {e}")
         return None
 
+def profile_updated(user: User, fields: Iterable[str]) -> None:
+    """Cache bookkeeping after a profile update (the caches are not thread-safe: call it on the event loop)."""
+    recommendation_cache.invalidate_user(user.id) # Ranked lists depend on the profile
+    if any(field in PROFILE_FIELDS for field in fields):
+        profile_blocks.refresh(user) # Prompt block rebuilt here only, not per message
+
 # --- Message CRUD Operations ---
 
-def create_message(db: Session, user_id: int, whatsapp_message_id: str, content: str, sender: str, metadata: Optional[Dict] = None) -> Message:
-    """Creates a new message associated with a user."""
-    db_message = Message(
+def create_message(db: Session, user_id: int, whatsapp_message_id: str, content: str, sender: str, metadata: Optional[Dict] = None) -> Message | None:
+    """Creates a new message associated with a user. Returns None if whatsapp_message_id is already stored."""
+    db_message = db.scalars(message_insert(db, user_id, whatsapp_message_id, content, sender, metadata)).first()
+    db.commit()
+    return message_stored(db_message, user_id, whatsapp_message_id, content, sender)
+
+def message_insert(db: Session | AsyncSession, user_id: int, whatsapp_message_id: str, content: str, sender: str, metadata: Optional[Dict]):
+    return insert_stmt(db, Message).values(
         user_id=user_id,
         whatsapp_message_id=whatsapp_message_id,
         content=content,
         sender=sender,
         message_metadata=metadata
+    ).on_conflict_do_nothing(index_elements=["whatsapp_message_id"]).returning(Message)
+
+def message_stored(db_message: Message | None, user_id: int, whatsapp_message_id: str, content: str, sender: str) -> Message | None:
+    """Post-insert bookkeeping shared by create_message and create_message_async."""
+    if db_message is None:
+        print(f"Duplicate message {whatsapp_message_id} ignored")
+    else:
+        context_builder.record_message(user_id, sender, content, whatsapp_message_id)
+    return db_message
+
+def record_inbound_batch(db: Session, inbound: List[Dict[str, Any]]) -> tuple[Dict[str, User], set[str]]:
+    """
+    Unit of work for a webhook batch: stores every inbound message in a single transaction.
+
+    Senders are got-or-created with one upsert (INSERT .. ON CONFLICT .. RETURNING, which also
+    picks up WhatsApp profile name changes) and the messages are written with one multi-row
+    INSERT .. RETURNING, so the batch costs three round trips (upsert, insert, commit) however
+    many users and messages it has. Each item needs whatsapp_id, phone_number,
+    whatsapp_message_id and content (profile_name and metadata are optional). Messages whose
+    whatsapp_message_id is already stored are skipped (insert on conflict do nothing).
+    Returns (whatsapp_id -> User, whatsapp_message_ids actually inserted).
+    """
+    if not inbound:
+        return {}, set()
+    try:
+        users = {user.whatsapp_id: user for user in db.scalars(user_upsert(db, inbound))}
+        rows = inbound_rows(inbound, users)
+        inserted_ids = set(db.scalars(inbound_insert(db, rows)))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return inbound_stored(rows, users, inserted_ids)
+
+def user_upsert(db: Session | AsyncSession, inbound: List[Dict[str, Any]]):
+    """Get-or-create of every sender in one statement; returns the User rows."""
+    values = {
+        item["whatsapp_id"]: {"whatsapp_id": item["whatsapp_id"], "phone_number": item["phone_number"], "profile_name": item.get("profile_name")}
+        for item in inbound
+    } # One row per user: ON CONFLICT cannot touch the same row twice in a statement
+    stmt = insert_stmt(db, User).values(list(values.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["whatsapp_id"],
+        set_={"profile_name": func.coalesce(stmt.excluded.profile_name, User.profile_name)},
     )
-    db.add(db_message)
+    return stmt.returning(User).execution_options(populate_existing=True)
+
+def inbound_rows(inbound: List[Dict[str, Any]], users: Dict[str, User]) -> List[Dict[str, Any]]:
+    claimed_at = time.time()
+    return [
+        {
+            "user_id": users[item["whatsapp_id"]].id,
+            "whatsapp_message_id": item["whatsapp_message_id"],
+            "content": item["content"],
+            "sender": "user",
+            "message_metadata": item.get("metadata"),
+            "claimed_at": claimed_at, # The batch that stores a message is the one that answers it
+        }
+        for item in inbound
+    ]
+
+def inbound_insert(db: Session | AsyncSession, rows: List[Dict[str, Any]]):
+    stmt = insert_stmt(db, Message).values(rows).on_conflict_do_nothing(index_elements=["whatsapp_message_id"])
+    return stmt.returning(Message.whatsapp_message_id)
+
+def inbound_stored(rows: List[Dict[str, Any]], users: Dict[str, User], inserted_ids: set[str]) -> tuple[Dict[str, User], set[str]]:
+    """Post-commit bookkeeping shared by record_inbound_batch and record_inbound_batch_async."""
+    for row in rows:
+        if row["whatsapp_message_id"] in inserted_ids:
+            context_builder.record_message(row["user_id"], "user", row["content"], row["whatsapp_message_id"])
+    print(f"Stored {len(inserted_ids)}/{len(rows)} inbound messages from {len(users)} users in one transaction")
+    return users, inserted_ids
+
+def get_user_messages(db: Session, user_id: int, limit: int = 20, after_id: Optional[int] = None) -> list[Message]:
+    """Retrieves the latest messages for a given user (optionally only those with id > after_id)."""
+    return list(db.scalars(user_messages_select(user_id, limit, after_id)))
+
+def user_messages_select(user_id: int, limit: int, after_id: Optional[int] = None):
+    stmt = select(Message).where(Message.user_id == user_id)
+    if after_id is not None:
+        stmt = stmt.where(Message.id > after_id)
+    # id breaks ties between messages stored within the same clock tick
+    return stmt.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit)
+
+# --- Conversation Summary Operations ---
+
+def get_conversation_summary(db: Session, user_id: int) -> ConversationSummary | None:
+    """Retrieves the rolling summary of a user's older messages, if any."""
+    return db.query(ConversationSummary).filter(ConversationSummary.user_id == user_id).first()
+
+def load_conversation_state(db: Session, user_id: int, limit: int = 50) -> tuple[Optional[str], list[Message]]:
+    """Summary text plus the latest messages not yet folded into it (newest first)."""
+    summary = get_conversation_summary(db, user_id)
+    if summary is None:
+        return None, get_user_messages(db, user_id, limit=limit)
+    return summary.summary, get_user_messages(db, user_id, limit=limit, after_id=summary.last_message_id)
+
+def get_unsummarized_messages(db: Session, user_id: int, limit: int) -> list[Message]:
+    """Oldest messages not yet folded into the user's summary (oldest first)."""
+    summary = get_conversation_summary(db, user_id)
+    query = db.query(Message).filter(Message.user_id == user_id)
+    if summary is not None:
+        query = query.filter(Message.id > summary.last_message_id)
+    return query.order_by(Message.id.asc()).limit(limit).all()
+
+def save_conversation_summary(db: Session, user_id: int, summary: str, last_message_id: int) -> None:
+    """Creates or replaces the user's conversation summary."""
+    stmt = insert_stmt(db, ConversationSummary).values(user_id=user_id, summary=summary, last_message_id=last_message_id)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={"summary": stmt.excluded.summary, "last_message_id": stmt.excluded.last_message_id, "updated_at": func.now()},
+    )
+    db.execute(stmt)
     db.commit()
-    db.refresh(db_message)
-    return db_message
 
-def get_user_messages(db: Session, user_id: int, limit: int = 20) -> list[Message]:
-    """Retrieves the latest messages for a given user."""
-    return db.query(Message).filter(Message.user_id == user_id).order_by(Message.timestamp.desc()).limit(limit).all()
+# --- Async CRUD Operations (webhook hot path) ---
+# AsyncSession versions of the queries run for every inbound message, so they do not block
+# the event loop. Same statements and side effects as the sync functions above, which stay
+# for the admin UI, scripts and background jobs.
+
+async def get_user_by_whatsapp_id_async(db: AsyncSession, whatsapp_id: str) -> User | None:
+    """Retrieves a user by their WhatsApp ID."""
+    return (await db.scalars(select(User).where(User.whatsapp_id == whatsapp_id).limit(1))).first()
+
+async def create_user_async(db: AsyncSession, phone_number: str, whatsapp_id: str, profile_name: Optional[str] = None) -> User:
+    """Creates a new user."""
+    db_user = User(phone_number=phone_number, whatsapp_id=whatsapp_id, profile_name=profile_name)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    print(f"Created user {db_user.id} for whatsapp_id {whatsapp_id}")
+    return db_user
+
+async def create_message_async(db: AsyncSession, user_id: int, whatsapp_message_id: str, content: str, sender: str, metadata: Optional[Dict] = None) -> Message | None:
+    """Creates a new message associated with a user. Returns None if whatsapp_message_id is already stored."""
+    db_message = (await db.scalars(message_insert(db, user_id, whatsapp_message_id, content, sender, metadata))).first()
+    await db.commit()
+    return message_stored(db_message, user_id, whatsapp_message_id, content, sender)
+
+async def record_inbound_batch_async(db: AsyncSession, inbound: List[Dict[str, Any]]) -> tuple[Dict[str, User], set[str]]:
+    """Async version of record_inbound_batch (upsert + insert + commit for the whole webhook batch)."""
+    if not inbound:
+        return {}, set()
+    try:
+        users = {user.whatsapp_id: user for user in await db.scalars(user_upsert(db, inbound))}
+        rows = inbound_rows(inbound, users)
+        inserted_ids = set(await db.scalars(inbound_insert(db, rows)))
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return inbound_stored(rows, users, inserted_ids)
+
+async def claim_inbound_async(db: AsyncSession, whatsapp_message_ids: List[str]) -> set[str]:
+    """
+    Claims inbound messages stored by an earlier delivery, so one worker answers each: a
+    conditional UPDATE takes those unclaimed or claimed more than INBOUND_CLAIM_TTL_SECONDS ago
+    (by a run that died). Returns the ids this call won.
+    """
+    if not whatsapp_message_ids:
+        return set()
+    now = time.time()
+    stmt = (
+        update(Message)
+        .where(Message.whatsapp_message_id.in_(whatsapp_message_ids), Message.sender == "user",
+               or_(Message.claimed_at.is_(None), Message.claimed_at < now - settings.INBOUND_CLAIM_TTL_SECONDS))
+        .values(claimed_at=now)
+        .returning(Message.whatsapp_message_id)
+        .execution_options(synchronize_session=False)
+    )
+    try:
+        claimed = set(await db.scalars(stmt))
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return claimed
+
+async def release_inbound_claims_async(db: AsyncSession, whatsapp_message_ids: List[str]) -> None:
+    """Drops the claims on messages that could not be answered, so a retry can take them at once."""
+    if not whatsapp_message_ids:
+        return
+    await db.execute(update(Message).where(Message.whatsapp_message_id.in_(whatsapp_message_ids))
+                     .values(claimed_at=None).execution_options(synchronize_session=False))
+    await db.commit()
+
+async def get_answered_ids_async(db: AsyncSession, whatsapp_message_ids: List[str]) -> set[str]:
+    """The inbound whatsapp_message_ids whose reply (the ai_<id> message) is already stored."""
+    if not whatsapp_message_ids:
+        return set()
+    reply_ids = [f"ai_{whatsapp_message_id}" for whatsapp_message_id in whatsapp_message_ids]
+    stored = await db.scalars(select(Message.whatsapp_message_id).where(Message.whatsapp_message_id.in_(reply_ids)))
+    return {reply_id[len("ai_"):] for reply_id in stored}
+
+async def get_user_messages_async(db: AsyncSession, user_id: int, limit: int = 20, after_id: Optional[int] = None) -> list[Message]:
+    """Retrieves the latest messages for a given user (optionally only those with id > after_id)."""
+    return list(await db.scalars(user_messages_select(user_id, limit, after_id)))
+
+async def load_conversation_state_async(db: AsyncSession, user_id: int, limit: int = 50) -> tuple[Optional[str], list[Message]]:
+    """Summary text plus the latest messages not yet folded into it (newest first)."""
+    summary = (await db.scalars(select(ConversationSummary).where(ConversationSummary.user_id == user_id))).first()
+    if summary is None:
+        return None, await get_user_messages_async(db, user_id, limit=limit)
+    return summary.summary, await get_user_messages_async(db, user_id, limit=limit, after_id=summary.last_message_id)
+
+# --- Product Catalog Cache Operations ---
+
+def get_cached_search(db: Session, platform: str, query: str) -> tuple[list[Product], float] | None:
+    """
+    Products a platform returned for `query` (in the platform's order) and the age of that
+    result in seconds, or None if the query was never cached. Freshness is up to the caller.
+    """
+    entry = db.query(ProductSearchCache).filter(
+        ProductSearchCache.platform == platform, ProductSearchCache.query == normalize(query)
+    ).first()
+    if entry is None:
+        return None
+    products = {product.id: product for product in db.query(Product).filter(Product.id.in_(entry.product_ids))}
+    return [products[product_id] for product_id in entry.product_ids if product_id in products], time.time() - entry.fetched_at
+
+def get_products_by_id(db: Session, product_ids: List[int]) -> Dict[int, Product]:
+    """products.id -> Product for the given ids (missing ids are left out)."""
+    return {product.id: product for product in db.query(Product).filter(Product.id.in_(product_ids))}
+
+def upsert_products(db: Session, platform: str, items: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Inserts or refreshes products of one platform with a single statement (no commit).
+    Each item needs external_id and name; other Product columns are optional.
+    Returns external_id -> products.id.
+    """
+    if not items:
+        return {}
+    columns = ["name", "category", "price", "price_display", "image_url", "product_url", "affiliate_link", "description"]
+    rows = {} # Keyed by external_id: a platform can list a product twice, one statement cannot update a row twice
+    for item in items:
+        rows[item["external_id"]] = {
+            "platform": platform,
+            "external_id": item["external_id"],
+            "normalized_name": normalize(item["name"]),
+            **{column: item.get(column) for column in columns},
+        }
+    stmt = insert_stmt(db, Product).values(list(rows.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["platform", "external_id"],
+        set_={**{column: stmt.excluded[column] for column in columns + ["normalized_name"]}, "fetched_at": func.now()},
+    )
+    return dict(db.execute(stmt.returning(Product.external_id, Product.id)).all())
+
+def store_search_results(db: Session, query: str, items_by_platform: Dict[str, List[Dict[str, Any]]],
+                         update_index: bool = True) -> Dict[str, list[Product]]:
+    """
+    Upserts the products each platform returned for `query` and caches the result lists,
+    all in one transaction. Returns platform -> products in the platform's order. Callers in a
+    worker thread pass update_index=False and index the returned products on the event loop.
+    """
+    product_ids_by_platform = {}
+    try:
+        for platform, items in items_by_platform.items():
+            ids = upsert_products(db, platform, items)
+            product_ids = list(dict.fromkeys(ids[item["external_id"]] for item in items))
+            stmt = insert_stmt(db, ProductSearchCache).values(platform=platform, query=normalize(query), product_ids=product_ids, fetched_at=time.time())
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["platform", "query"],
+                set_={"product_ids": stmt.excluded.product_ids, "fetched_at": stmt.excluded.fetched_at},
+            )
+            db.execute(stmt)
+            product_ids_by_platform[platform] = product_ids
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    all_ids = [product_id for product_ids in product_ids_by_platform.values() for product_id in product_ids]
+    products = {product.id: product for product in db.query(Product).filter(Product.id.in_(all_ids))}
+    if update_index:
+        search_index.index_products(products.values())
+    return {platform: [products[product_id] for product_id in product_ids] for platform, product_ids in product_ids_by_platform.items()}
 
 # --- Wishlist CRUD Operations ---
 
-def add_to_wishlist(db: Session, user_id: int, item_data: Dict[str, Any]) -> WishlistItem:
-    """Adds an item to the user's wishlist."""
+def add_to_wishlist(db: Session, user_id: int, item_data: Dict[str, Any], update_caches: bool = True) -> WishlistItem:
+    """
+    Adds an item to the user's wishlist. Details that are not given (name, links, platform,
+    price) are taken from the product catalog when product_id is found there. Items with a
+    platform have their price tracked from the current price on (see price_tracker.py).
+    In a worker thread, pass update_caches=False and call wishlist_changed on the event loop.
+    """
+    item_data = dict(item_data)
+    if item_data.get("product_id") and any(item_data.get(key) is None for key in ("product_name", "platform", "price")):
+        filters = [Product.external_id == item_data["product_id"]] + ([Product.platform == item_data["platform"]] if item_data.get("platform") else [])
+        product = db.query(Product).filter(*filters).first()
+        if product is not None:
+            catalog = {"product_name": product.name, "product_url": product.affiliate_link or product.product_url,
+                       "product_image_url": product.image_url, "platform": product.platform, "price": product.price}
+            item_data.update({key: value for key, value in catalog.items() if item_data.get(key) is None})
+    if not item_data.get("product_name"):
+        raise ValueError(f"Unknown product {item_data.get('product_id')!r}: product_name is required")
+    platform, price = item_data.get("platform"), item_data.get("price")
     db_item = WishlistItem(
         user_id=user_id,
         product_id=item_data.get("product_id"),
         product_name=item_data.get("product_name"),
         product_url=item_data.get("product_url"),
         product_image_url=item_data.get("product_image_url"),
-        notes=item_data.get("notes")
+        notes=item_data.get("notes"),
+        platform=platform,
+        current_price=price,
+        target_price=item_data.get("target_price"),
+        reference_price=price,
     )
     db.add(db_item)
     db.commit()
     db.refresh(db_item)
+    if update_caches:
+        wishlist_changed(user_id)
     print(f"Added item {db_item.id} to wishlist for user {user_id}")
     return db_item
 
-def get_wishlist_items(db: Session, user_id: int) -> List[WishlistItem]:
-    """Retrieves all items from the user's wishlist."""
-    return db.query(WishlistItem).filter(WishlistItem.user_id == user_id).order_by(WishlistItem.added_at.desc()).all()
+def get_wishlist_items(db: Session, user_id: int, limit: Optional[int] = None) -> List[WishlistItem]:
+    """Retrieves the items of the user's wishlist, newest first (all of them unless limit is given)."""
+    return db.query(WishlistItem).filter(WishlistItem.user_id == user_id).order_by(WishlistItem.added_at.desc()).limit(limit).all()
 
 def remove_from_wishlist(db: Session, user_id: int, item_id: int) -> bool:
     """Removes an item from the user's wishlist by its ID."""
@@ -116,11 +532,229 @@ def remove_from_wishlist(db: Session, user_id: int, item_id: int) -> bool:
     if db_item:
         db.delete(db_item)
         db.commit()
+        wishlist_changed(user_id)
         print(f"Removed item {item_id} from wishlist for user {user_id}")
         return True
     print(f"Item {item_id} not found in wishlist for user {user_id}")
     return False
 
+def wishlist_changed(user_id: int) -> None:
+    """Cache bookkeeping after a wishlist change (call it on the event loop, like profile_updated)."""
+    recommendation_cache.invalidate_user(user_id) # Ranked lists use the wishlist (collaborative scores)
+
+# --- Price Tracking Operations (price_tracker.py) ---
+
+def get_due_price_checks(db: Session, checked_before: float, limit: int) -> Dict[str, List[tuple[str, str, Optional[float]]]]:
+    """
+    Distinct wishlist products whose price was last checked before `checked_before` (or
+    never), stalest first: platform -> [(product_id, product_name, last known price)].
+    However many users saved a product, it appears (and is fetched) once.
+    """
+    tracked = (
+        select(WishlistItem.platform, WishlistItem.product_id, func.min(WishlistItem.product_name).label("name"))
+        .where(WishlistItem.platform.isnot(None), WishlistItem.product_id.isnot(None))
+        .group_by(WishlistItem.platform, WishlistItem.product_id)
+        .subquery()
+    )
+    checked_at = func.coalesce(Product.price_checked_at, 0.0)
+    stmt = (
+        select(tracked.c.platform, tracked.c.product_id, tracked.c.name, Product.price)
+        .outerjoin(Product, (Product.platform == tracked.c.platform) & (Product.external_id == tracked.c.product_id))
+        .where(checked_at < checked_before)
+        .order_by(checked_at)
+        .limit(limit)
+    )
+    due: Dict[str, List[tuple[str, str, Optional[float]]]] = {}
+    for platform, product_id, name, price in db.execute(stmt):
+        due.setdefault(platform, []).append((product_id, name, price))
+    return due
+
+def price_alert_due(price: float, reference_price: Optional[float], target_price: Optional[float], drop_percent: float) -> bool:
+    """Whether `price` is news for a user who last heard `reference_price`."""
+    if target_price is not None and price <= target_price and (reference_price is None or reference_price > target_price):
+        return True # Reached the target (and the user has not been told about a price below it yet)
+    return reference_price is not None and price <= reference_price * (1 - drop_percent / 100)
+
+def price_alert_text(item_name: str, price: float, reference_price: Optional[float], target_price: Optional[float], product_url: Optional[str]) -> str:
+    text = f"📉 Alerta de preço: *{item_name}*, da sua lista de desejos, está por {format_price(price)}"
+    if reference_price is not None:
+        text += f" (antes {format_price(reference_price)})"
+    text += "."
+    if target_price is not None and price <= target_price:
+        text += f" Chegou no preço que você queria ({format_price(target_price)})!"
+    if product_url:
+        text += f"\n{product_url}"
+    return text
+
+def record_price_checks(db: Session, platform: str, checked: List[tuple[str, str, Optional[float]]],
+                        prices: Dict[str, Optional[float]], checked_at: float, update_caches: bool = True) -> List[Dict[str, Any]]:
+    """
+    Stores one batch of price lookups of `platform` in a single transaction: the products'
+    price and price_checked_at (a product missing from `prices` keeps its price), a
+    price_history row for each change, the new price on the wishlist items of changed
+    products and, for the items whose price dropped past their threshold
+    (price_alert_due), an assistant message with the alert. `checked` holds
+    (product_id, name, previous price) as returned by get_due_price_checks.
+    Returns the alerts to send: [{"user_id", "phone_number", "content"}]. In a worker thread,
+    pass update_caches=False and call price_checks_stored on the event loop.
+    """
+    if not checked:
+        return []
+    rows, changed = [], {}
+    for product_id, name, previous_price in checked:
+        price = prices.get(product_id)
+        rows.append({
+            "platform": platform, "external_id": product_id, "name": name, "normalized_name": normalize(name),
+            "price": price, "price_display": format_price(price) if price is not None else None, "price_checked_at": checked_at,
+        })
+        if price is not None and price != previous_price:
+            changed[product_id] = price
+    alerts = []
+    try:
+        stmt = insert_stmt(db, Product)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["platform", "external_id"],
+            set_={
+                "price": func.coalesce(stmt.excluded.price, Product.price),
+                "price_display": func.coalesce(stmt.excluded.price_display, Product.price_display),
+                "price_checked_at": stmt.excluded.price_checked_at,
+            },
+        )
+        db.execute(stmt, rows) # executemany: compiled once for the whole batch
+        if changed:
+            db.execute(insert(PriceHistory), [{"platform": platform, "external_id": product_id, "price": price} for product_id, price in changed.items()])
+            items = db.execute(
+                select(WishlistItem.id, WishlistItem.user_id, WishlistItem.product_id, WishlistItem.product_name, WishlistItem.product_url,
+                       WishlistItem.target_price, WishlistItem.reference_price, User.phone_number)
+                .join(User, User.id == WishlistItem.user_id)
+                .where(WishlistItem.platform == platform, WishlistItem.product_id.in_(list(changed)))
+            ).all()
+            updates, messages = [], []
+            for item in items:
+                price = changed[item.product_id]
+                reference_price = item.reference_price
+                if price_alert_due(price, reference_price, item.target_price, settings.PRICE_DROP_ALERT_PERCENT):
+                    content = price_alert_text(item.product_name, price, reference_price, item.target_price, item.product_url)
+                    messages.append({"user_id": item.user_id, "whatsapp_message_id": f"price_alert_{item.id}_{int(checked_at)}",
+                                     "content": content, "sender": "assistant"})
+                    alerts.append({"user_id": item.user_id, "phone_number": item.phone_number, "content": content})
+                    reference_price = price
+                elif reference_price is None:
+                    reference_price = price # First price seen for an item saved before tracking existed
+                updates.append({"id": item.id, "current_price": price, "reference_price": reference_price})
+            if updates:
+                db.execute(update(WishlistItem), updates)
+            if messages:
+                db.execute(insert(Message), messages)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if update_caches:
+        price_checks_stored(alerts, get_repriced_products(db, platform, list(changed)))
+    return alerts
+
+def get_repriced_products(db: Session, platform: str, external_ids: List[str]) -> List[Product]:
+    """The products whose price changed, to refresh the search index's price facets (none when it is off)."""
+    if not external_ids or not settings.SEARCH_INDEX_ENABLED:
+        return []
+    return db.query(Product).filter(Product.platform == platform, Product.external_id.in_(external_ids)).all()
+
+def price_checks_stored(alerts: List[Dict[str, Any]], products: List[Product]) -> None:
+    """Cache bookkeeping after record_price_checks (call it on the event loop, like profile_updated)."""
+    for alert in alerts: # Part of the conversation from now on
+        context_builder.record_message(alert["user_id"], "assistant", alert["content"])
+    if products: # Keep the price facets current
+        search_index.index_products(products)
+
+# --- Collaborative Filtering Operations ---
+
+def record_recommendation_click(db: Session, user_id: int, product_id: str) -> RecommendationClick:
+    """Stores that the user followed a recommended product's link."""
+    click = RecommendationClick(user_id=user_id, product_id=product_id)
+    db.add(click)
+    db.commit()
+    return click
+
+def get_collaborative_scores(db: Session, user_id: int, limit: int = 200) -> Dict[int, float]:
+    """
+    products.id -> summed similarity of the catalog products most similar to the user's
+    wishlist (item_neighbors), excluding products already in it. One indexed query.
+    item_neighbors has no platform, so an external_id listed on several platforms scores once
+    (on its first-stored product).
+    """
+    wishlist = select(WishlistItem.product_id).where(WishlistItem.user_id == user_id, WishlistItem.product_id.isnot(None))
+    neighbor_score = func.sum(ItemNeighbor.score).label("score")
+    neighbors = (
+        select(ItemNeighbor.neighbor_id, neighbor_score)
+        .where(ItemNeighbor.item_id.in_(wishlist), ItemNeighbor.neighbor_id.not_in(wishlist))
+        .group_by(ItemNeighbor.neighbor_id)
+        .order_by(neighbor_score.desc())
+        .limit(limit)
+        .subquery()
+    )
+    stmt = (
+        select(Product.id, Product.external_id, neighbors.c.score)
+        .join(neighbors, Product.external_id == neighbors.c.neighbor_id)
+        .order_by(neighbors.c.score.desc(), Product.id)
+    )
+    scores: Dict[int, float] = {}
+    scored: set[str] = set()
+    for product_id, external_id, value in db.execute(stmt):
+        if external_id not in scored:
+            scored.add(external_id)
+            scores[product_id] = float(value)
+    return scores
+
+# --- LLM Usage Operations (llm_usage.py) ---
+
+def insert_llm_calls(db: Session, rows: List[Dict[str, Any]]) -> None:
+    """Writes a batch of recorded completions (one executemany INSERT)."""
+    db.execute(insert(LLMCall), rows)
+    db.commit()
+
+def get_llm_usage_report(db: Session, since: datetime, group_by: str, limit: int = 100) -> List[Dict[str, Any]]:
+    """
+    Completions since `since` aggregated by "day" (newest first), "model", "purpose" or "user"
+    (most expensive first): calls, tokens, cost, latency and the share of prompt tokens served
+    from the provider's prompt cache. One query over ix_llm_calls_created_at.
+    """
+    keys = {
+        "day": [func.date(LLMCall.created_at)],
+        "model": [LLMCall.model],
+        "purpose": [LLMCall.purpose],
+        "user": [LLMCall.user_id, User.whatsapp_id],
+    }[group_by]
+    cost = func.sum(LLMCall.cost_usd)
+    stmt = (
+        select(*keys, func.count(), func.sum(LLMCall.prompt_tokens), func.sum(LLMCall.cached_tokens), func.sum(LLMCall.completion_tokens),
+               cost, func.avg(LLMCall.latency_ms), func.max(LLMCall.latency_ms), func.avg(LLMCall.first_token_ms))
+        .where(LLMCall.created_at >= since)
+        .group_by(*keys)
+        .order_by(keys[0].desc() if group_by == "day" else cost.desc())
+        .limit(limit)
+    )
+    if group_by == "user":
+        stmt = stmt.outerjoin(User, User.id == LLMCall.user_id)
+    report = []
+    for row in db.execute(stmt):
+        key = row[:len(keys)]
+        calls, prompt_tokens, cached_tokens, completion_tokens, cost_usd, avg_latency, max_latency, avg_first_token = row[len(keys):]
+        report.append({
+            group_by: str(key[0]) if group_by == "day" else key[0],
+            **({"whatsapp_id": key[1]} if group_by == "user" else {}),
+            "calls": calls,
+            "prompt_tokens": prompt_tokens or 0,
+            "cached_tokens": cached_tokens or 0,
+            "completion_tokens": completion_tokens or 0,
+            "cache_hit_rate": round((cached_tokens or 0) / prompt_tokens, 3) if prompt_tokens else 0.0,
+            "cost_usd": round(cost_usd or 0.0, 4),
+            "avg_latency_ms": round(avg_latency or 0.0, 1),
+            "max_latency_ms": round(max_latency or 0.0, 1),
+            "avg_first_token_ms": round(avg_first_token, 1) if avg_first_token is not None else None,
+        })
+    return report
+
 # Add more CRUD operations as needed
 
 # Allow running this script directly to initialize the database
@@ -0,0 +1,138 @@
+# Connection pool configuration and telemetry for the SQLAlchemy engine (see models.py)
+#
+# - Pool size, overflow, timeout, recycle and pre-ping come from the DB_POOL_* settings.
+# - Checkouts are timed (time spent waiting for a free connection, including opening a new
+#   one), so a pool that is too small for the worker's concurrency shows up as wait time
+#   and timeouts in /admin/api/metrics before it shows up as errors.
+# - DB_PGBOUNCER=true is for a DATABASE_URL pointing at PgBouncer in transaction mode: no
+#   local pool (PgBouncer does the pooling; idle connections held here would pin its server
+#   connections) and no server-side prepared statements, which do not survive a
+#   transaction-mode connection switch. psycopg2 never prepares; psycopg 3 and asyncpg do and
+#   get the options below.
+# - The async engine of the webhook hot path (models.async_engine) uses the same settings with
+#   its own pool and its own statistics ("async" in pool_stats).
+
+import time
+from collections import deque
+from typing import Any, Dict
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+from .config import settings
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+def _new_stats() -> Dict[str, Any]:
+    return {"checkouts": 0, "timeouts": 0, "total_wait": 0.0, "max_wait": 0.0, "peak_in_use": 0}
+
+pool_stats = {"sync": _new_stats(), "async": _new_stats()}
+_recent_waits = {kind: deque(maxlen=1000) for kind in pool_stats} # Last checkout wait times, for percentiles
+
+class _TimedCheckout:
+    """Pool mixin that records how long each checkout took."""
+    stats_key = "sync"
+
+    def _do_get(self):
+        stats = pool_stats[self.stats_key]
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            stats["timeouts"] += 1
+            raise
+        finally:
+            wait = time.perf_counter() - started
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+            _recent_waits[self.stats_key].append(wait)
+        stats["checkouts"] += 1
+        stats["peak_in_use"] = max(stats["peak_in_use"], self.checkedout())
+        return connection
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    stats_key = "async"
+
+class TimedNullPool(_TimedCheckout, NullPool):
+    def checkedout(self) -> int:
+        return 0 # NullPool does not track connections
+
+class TimedAsyncNullPool(TimedNullPool):
+    stats_key = "async"
+
+def is_async_url(url: str) -> bool:
+    return url.startswith(tuple(f"{driver}:" for driver in ASYNC_DRIVERS.values()))
+
+def async_database_url(url: str) -> str:
+    """The same database with its asyncio driver: asyncpg for PostgreSQL, aiosqlite for SQLite."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend} databases")
+    parsed = parsed.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == "postgresql" and "sslmode" in parsed.query:
+        # libpq's sslmode is spelled ssl in asyncpg
+        parsed = parsed.difference_update_query(["sslmode"]).update_query_dict({"ssl": parsed.query["sslmode"]})
+    return parsed.render_as_string(hide_password=False)
+
+def engine_options(url: str) -> Dict[str, Any]:
+    """create_engine / create_async_engine keyword arguments for `url` according to the DB_POOL_* settings."""
+    is_async = is_async_url(url)
+    options: Dict[str, Any] = {"pool_pre_ping": settings.DB_POOL_PRE_PING}
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+        if ":memory:" in url or url.rstrip("/").endswith(":"):
+            return options # In-memory SQLite keeps its single-connection pool
+    if settings.DB_PGBOUNCER:
+        options["poolclass"] = TimedAsyncNullPool if is_async else TimedNullPool
+        options["connect_args"] = pgbouncer_connect_args(url)
+        return options
+    options.update(
+        poolclass=TimedAsyncQueuePool if is_async else TimedQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+    return options
+
+def pgbouncer_connect_args(url: str) -> Dict[str, Any]:
+    """Driver options that turn off server-side prepared statements."""
+    if url.startswith("postgresql+psycopg:"): # psycopg 3
+        return {"prepare_threshold": None}
+    if url.startswith("postgresql+asyncpg:"):
+        return {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+    return {} # psycopg2 (the default driver) does not use prepared statements
+
+def get_pool_metrics(engine) -> Dict[str, Any]:
+    """Current pool occupancy plus checkout wait statistics."""
+    pool = engine.pool
+    kind = getattr(pool, "stats_key", "sync")
+    stats = pool_stats[kind]
+    waits = sorted(_recent_waits[kind])
+    percentile = lambda pct: round(waits[min(len(waits) - 1, int(len(waits) * pct / 100))] * 1000, 2) if waits else 0.0
+    metrics: Dict[str, Any] = {
+        "pool_class": type(pool).__name__,
+        "pgbouncer_mode": settings.DB_PGBOUNCER,
+        "checkouts": stats["checkouts"],
+        "timeouts": stats["timeouts"],
+        "avg_wait_ms": round(stats["total_wait"] / stats["checkouts"] * 1000, 2) if stats["checkouts"] else 0.0,
+        "p95_wait_ms": percentile(95),
+        "p99_wait_ms": percentile(99),
+        "max_wait_ms": round(stats["max_wait"] * 1000, 2),
+        "peak_in_use": stats["peak_in_use"],
+    }
+    if isinstance(pool, QueuePool):
+        metrics.update(
+            size=pool.size(),
+            max_overflow=pool._max_overflow,
+            in_use=pool.checkedout(),
+            idle=pool.checkedin(),
+            overflow=max(0, pool.overflow()), # Negative while the pool has not opened all its connections yet
+            max_connections=pool.size() + pool._max_overflow,
+        )
+    return metrics
@@ -0,0 +1,65 @@
+# Deduplication of webhook deliveries
+#
+# Meta redelivers a webhook when we are slow to answer, so the same whatsapp_message_id
+# can arrive several times. A bounded in-memory LRU/TTL set rejects most duplicates before
+# any DB or LLM work; the rest (e.g. deliveries handled by another worker process) are
+# caught in the DB: a message counts as handled once its reply (ai_<whatsapp_message_id>) is
+# stored, and while it is unanswered only the worker holding its claim (messages.claimed_at)
+# answers it, so one stored by a run that died before replying is still answered on redelivery.
+
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+from .config import settings
+
+class RecentIdSet:
+    """Bounded set of recently seen ids with LRU eviction and a per-entry TTL."""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._seen: "OrderedDict[str, float]" = OrderedDict() # id -> expires_at
+
+    def add_if_new(self, key: str) -> bool:
+        """Records the id. Returns False if it was already seen (and not expired)."""
+        now = time.monotonic()
+        expires_at = self._seen.get(key)
+        if expires_at is not None and expires_at > now:
+            self._seen.move_to_end(key)
+            return False
+        self._seen[key] = now + self.ttl_seconds
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return True
+
+    def discard(self, key: str) -> None:
+        self._seen.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+seen_message_ids = RecentIdSet(max_size=settings.DEDUP_CACHE_SIZE, ttl_seconds=settings.DEDUP_CACHE_TTL_SECONDS)
+dedup_stats = {"accepted": 0, "dropped_cache": 0, "dropped_db": 0}
+
+def claim_message(whatsapp_message_id: Optional[str]) -> bool:
+    """Returns True if this delivery should be processed, False for a known duplicate."""
+    if not whatsapp_message_id:
+        return True
+    if seen_message_ids.add_if_new(whatsapp_message_id):
+        dedup_stats["accepted"] += 1
+        return True
+    dedup_stats["dropped_cache"] += 1
+    return False
+
+def release_messages(whatsapp_message_ids: Iterable[str]) -> None:
+    """Forgets claimed ids whose processing failed before being stored, so a redelivery is accepted."""
+    for whatsapp_message_id in whatsapp_message_ids:
+        seen_message_ids.discard(whatsapp_message_id)
+
+def record_db_duplicates(count: int) -> None:
+    dedup_stats["dropped_db"] += count
+
+def get_dedup_metrics() -> Dict[str, int]:
+    return {"cache_size": len(seen_message_ids), "cache_max_size": seen_message_ids.max_size, **dedup_stats}
@@ -0,0 +1,281 @@
+# Ingestion queue for incoming WhatsApp webhook payloads
+#
+# The webhook endpoint only enqueues the raw payload and returns; a pool of worker
+# tasks drains the queue. Two backends are available (INGESTION_QUEUE_BACKEND):
+# - "memory": asyncio.Queue inside the process (fast, lost on restart)
+# - "sql": rows in the webhook_jobs table on the existing engine (survives restarts/deploys)
+# Both give at-least-once delivery: a job is only removed after the handler succeeds,
+# failures are retried with backoff up to INGESTION_MAX_ATTEMPTS. A job interrupted by a
+# shutdown is released for redelivery without using up an attempt.
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import delete, func, or_, select, update
+
+from .config import settings
+from .models import SessionLocal, WebhookJob
+
+class QueueFullError(Exception):
+    """Raised by enqueue when the queue is above INGESTION_QUEUE_MAX_DEPTH."""
+
+@dataclass
+class Job:
+    id: Any
+    payload: Dict[str, Any]
+    attempts: int = 0
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff between delivery attempts (1s, 2s, 4s... capped at 60s)."""
+    return min(60.0, 2 ** max(0, attempts - 1))
+
+# --- Backends ---
+
+class InMemoryQueue:
+    """In-process backend. Unacked jobs are re-queued, but nothing survives a restart."""
+
+    def __init__(self, max_depth: int):
+        self.max_depth = max_depth
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._next_id = 0
+        self._in_flight = 0
+        self._delayed = 0 # Jobs waiting out their retry backoff
+
+    async def put(self, payload: Dict[str, Any]) -> None:
+        if self.max_depth and await self.depth() >= self.max_depth:
+            raise QueueFullError()
+        self._next_id += 1
+        self._queue.put_nowait(Job(id=self._next_id, payload=payload))
+
+    async def get(self) -> Job:
+        job = await self._queue.get()
+        job.attempts += 1
+        self._in_flight += 1
+        return job
+
+    async def ack(self, job: Job) -> None:
+        self._in_flight -= 1
+
+    async def nack(self, job: Job, error: str) -> bool:
+        """Schedules a retry. Returns False when the job has exhausted its attempts."""
+        self._in_flight -= 1
+        if job.attempts >= settings.INGESTION_MAX_ATTEMPTS:
+            return False
+        self._delayed += 1
+        asyncio.get_running_loop().call_later(retry_delay(job.attempts), self._requeue, job)
+        return True
+
+    def _requeue(self, job: Job) -> None:
+        self._delayed -= 1
+        self._queue.put_nowait(job)
+
+    async def release(self, job: Job) -> None:
+        """Puts an interrupted job back at once, without counting the attempt."""
+        self._in_flight -= 1
+        job.attempts -= 1
+        self._queue.put_nowait(job)
+
+    async def renew(self, job: Job) -> None:
+        pass # No leases: a job stays with its worker until acked or nacked
+
+    async def depth(self) -> int:
+        return self._queue.qsize() + self._in_flight + self._delayed
+
+class SQLQueue:
+    """Durable backend on the webhook_jobs table.
+
+    Jobs are claimed with a conditional UPDATE (works on PostgreSQL and SQLite) and leased
+    for INGESTION_LEASE_SECONDS, renewed while the handler runs; a job whose worker died is
+    redelivered once its lease expires.
+    """
+
+    def __init__(self, max_depth: int):
+        self.max_depth = max_depth
+        self._wakeup = asyncio.Event()
+        self._depth_cache = (0.0, 0) # (checked_at, depth) - avoids a COUNT(*) per webhook
+
+    # Blocking DB work runs in a thread so the event loop keeps serving webhooks
+
+    def _insert(self, payload: Dict[str, Any]) -> None:
+        with SessionLocal() as db:
+            db.add(WebhookJob(payload=payload, status="pending", attempts=0, available_at=time.time()))
+            db.commit()
+
+    def _claim(self) -> Optional[Job]:
+        now = time.time()
+        claimable = or_(
+            (WebhookJob.status == "pending") & (WebhookJob.available_at <= now),
+            (WebhookJob.status == "processing") & (WebhookJob.locked_until < now), # Expired lease
+        )
+        with SessionLocal() as db:
+            candidates = db.execute(select(WebhookJob.id).where(claimable).order_by(WebhookJob.id).limit(5)).scalars().all()
+            for job_id in candidates:
+                result = db.execute(
+                    update(WebhookJob)
+                    .where(WebhookJob.id == job_id, claimable)
+                    .values(status="processing", locked_until=now + settings.INGESTION_LEASE_SECONDS, attempts=WebhookJob.attempts + 1)
+                )
+                db.commit()
+                if result.rowcount == 1: # Another worker may have claimed it first
+                    job = db.get(WebhookJob, job_id)
+                    return Job(id=job.id, payload=job.payload, attempts=job.attempts)
+        return None
+
+    def _ack(self, job_id: int) -> None:
+        with SessionLocal() as db:
+            db.execute(delete(WebhookJob).where(WebhookJob.id == job_id))
+            db.commit()
+
+    def _nack(self, job: Job, error: str) -> bool:
+        exhausted = job.attempts >= settings.INGESTION_MAX_ATTEMPTS
+        values = {"status": "failed"} if exhausted else {"status": "pending", "available_at": time.time() + retry_delay(job.attempts)}
+        with SessionLocal() as db:
+            db.execute(update(WebhookJob).where(WebhookJob.id == job.id).values(locked_until=None, last_error=error[:2000], **values))
+            db.commit()
+        return not exhausted
+
+    def _release(self, job_id: int) -> None:
+        with SessionLocal() as db:
+            db.execute(
+                update(WebhookJob)
+                .where(WebhookJob.id == job_id, WebhookJob.status == "processing")
+                .values(status="pending", available_at=time.time(), locked_until=None, attempts=WebhookJob.attempts - 1)
+            )
+            db.commit()
+
+    def _renew(self, job_id: int) -> None:
+        with SessionLocal() as db:
+            db.execute(
+                update(WebhookJob)
+                .where(WebhookJob.id == job_id, WebhookJob.status == "processing")
+                .values(locked_until=time.time() + settings.INGESTION_LEASE_SECONDS)
+            )
+            db.commit()
+
+    def _count(self) -> int:
+        with SessionLocal() as db:
+            return db.execute(select(func.count()).select_from(WebhookJob).where(WebhookJob.status != "failed")).scalar_one()
+
+    async def put(self, payload: Dict[str, Any]) -> None:
+        if self.max_depth and await self.depth() >= self.max_depth:
+            raise QueueFullError()
+        await asyncio.to_thread(self._insert, payload)
+        checked_at, depth = self._depth_cache
+        self._depth_cache = (checked_at, depth + 1)
+        self._wakeup.set()
+
+    async def get(self) -> Job:
+        while True:
+            job = await asyncio.to_thread(self._claim)
+            if job:
+                return job
+            self._wakeup.clear()
+            try:
+                # Poll for jobs enqueued by other processes; local puts wake us up immediately
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.INGESTION_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def ack(self, job: Job) -> None:
+        await asyncio.to_thread(self._ack, job.id)
+
+    async def nack(self, job: Job, error: str) -> bool:
+        return await asyncio.to_thread(self._nack, job, error)
+
+    async def release(self, job: Job) -> None:
+        """Makes an interrupted job available again at once, without counting the attempt."""
+        await asyncio.to_thread(self._release, job.id)
+
+    async def renew(self, job: Job) -> None:
+        """Extends the job's lease by INGESTION_LEASE_SECONDS."""
+        await asyncio.to_thread(self._renew, job.id)
+
+    async def depth(self) -> int:
+        checked_at, depth = self._depth_cache
+        if time.monotonic() - checked_at > 1.0:
+            depth = await asyncio.to_thread(self._count)
+            self._depth_cache = (time.monotonic(), depth)
+        return depth
+
+def create_queue():
+    """Builds the backend selected by INGESTION_QUEUE_BACKEND."""
+    if settings.INGESTION_QUEUE_BACKEND == "sql":
+        return SQLQueue(max_depth=settings.INGESTION_QUEUE_MAX_DEPTH)
+    if settings.INGESTION_QUEUE_BACKEND != "memory":
+        print(f"WARNING: Unknown INGESTION_QUEUE_BACKEND '{settings.INGESTION_QUEUE_BACKEND}'. Using in-memory queue.")
+    return InMemoryQueue(max_depth=settings.INGESTION_QUEUE_MAX_DEPTH)
+
+# --- Module-level queue and worker pool ---
+
+queue = create_queue()
+queue_stats = {"enqueued": 0, "rejected": 0, "processed": 0, "retried": 0, "failed": 0, "in_flight": 0}
+_workers: List[asyncio.Task] = []
+
+async def enqueue(payload: Dict[str, Any]) -> None:
+    """Adds a webhook payload to the queue. Raises QueueFullError when backpressure applies."""
+    try:
+        await queue.put(payload)
+    except QueueFullError:
+        queue_stats["rejected"] += 1
+        raise
+    queue_stats["enqueued"] += 1
+
+async def _keep_leased(job: Job) -> None:
+    """Renews the job's lease while its handler runs, so a slow reply is not redelivered meanwhile."""
+    while True:
+        await asyncio.sleep(settings.INGESTION_LEASE_SECONDS / 3)
+        try:
+            await queue.renew(job)
+        except Exception as e:
+            print(f"ERROR: Could not renew the lease of job {job.id}: {e}")
+
+async def _worker_loop(worker_id: int, handler: Callable[[Dict[str, Any]], Awaitable[Any]]):
+    while True:
+        job = await queue.get()
+        queue_stats["in_flight"] += 1
+        lease = asyncio.create_task(_keep_leased(job))
+        try:
+            await handler(job.payload)
+        except asyncio.CancelledError:
+            lease.cancel()
+            await queue.release(job) # Shutting down: not a failed attempt
+            raise
+        except Exception as e:
+            print(f"ERROR: Ingestion worker {worker_id} failed job {job.id} (attempt {job.attempts}): {e}")
+            if await queue.nack(job, repr(e)):
+                queue_stats["retried"] += 1
+            else:
+                queue_stats["failed"] += 1
+                print(f"ERROR: Job {job.id} exhausted {settings.INGESTION_MAX_ATTEMPTS} attempts. Giving up.")
+        else:
+            await queue.ack(job)
+            queue_stats["processed"] += 1
+        finally:
+            lease.cancel()
+            queue_stats["in_flight"] -= 1
+
+async def start_workers(handler: Callable[[Dict[str, Any]], Awaitable[Any]], num_workers: Optional[int] = None) -> None:
+    """Starts the worker pool. Each worker calls `handler(payload)` for every job."""
+    num_workers = num_workers or settings.INGESTION_WORKERS
+    for worker_id in range(num_workers):
+        _workers.append(asyncio.create_task(_worker_loop(worker_id, handler)))
+    print(f"Started {num_workers} ingestion workers ({settings.INGESTION_QUEUE_BACKEND} backend).")
+
+async def stop_workers() -> None:
+    """Cancels the worker pool. In-flight jobs are released (and redelivered by the SQL backend)."""
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+async def get_queue_metrics() -> Dict[str, Any]:
+    """Queue depth and counters for the admin metrics endpoint."""
+    return {
+        "backend": settings.INGESTION_QUEUE_BACKEND,
+        "workers": len(_workers),
+        "depth": await queue.depth(),
+        "max_depth": settings.INGESTION_QUEUE_MAX_DEPTH,
+        **queue_stats,
+    }
@@ -0,0 +1,119 @@
+# Fast local intent classification of inbound messages (no LLM call)
+#
+# A linear model over the word unigrams and bigrams of the normalized message with hand-set
+# weights (there is no labelled data to train on yet): each intent sums the weights of the
+# n-grams it knows and the message gets the intent whose score reaches 1.0. Product search
+# wins over small talk ("oi, quero um tênis" is a search), and small talk only counts in short
+# messages (INTENT_SMALL_TALK_MAX_WORDS) made only of small-talk n-grams, one stopword aside:
+# "bom dia, qual o status" needs a real answer, and so does any message with "não" or "mas"
+# ("obrigado mas não gostei") or with a question mark and words left over ("oi, cadê meu
+# pedido?"). It takes a few microseconds, so it runs before the LLM call
+# (whatsapp_handler.respond_to_message):
+# - GREETING / THANKS: templated reply, no LLM call and no recommendations
+# - PRODUCT_SEARCH: product retrieval starts concurrently with the LLM call
+# - OTHER: LLM reply, then recommendations if the reply talks about products
+#
+# Tune the weights with benchmarks/bench_intent_classifier.py.
+
+import random
+from typing import Dict, List, Optional
+
+from .config import settings
+from .text_utils import tokenize
+
+GREETING = "greeting"
+THANKS = "thanks"
+PRODUCT_SEARCH = "product_search"
+OTHER = "other"
+
+SMALL_TALK_INTENTS = (GREETING, THANKS)
+NUMBER_FEATURE = "<num>" # Any number: prices and sizes make a search more likely
+
+WEIGHTS: Dict[str, Dict[str, float]] = {
+    GREETING: {
+        "oi": 1.0, "oie": 1.0, "ola": 1.0, "opa": 1.0, "eai": 1.0, "e ai": 1.0, "salve": 1.0, "hey": 1.0, "hi": 1.0, "hello": 1.0,
+        "bom dia": 1.0, "boa tarde": 1.0, "boa noite": 1.0, "tudo bem": 1.0, "tudo bom": 1.0, "como vai": 1.0,
+    },
+    THANKS: {
+        "obrigado": 1.0, "obrigada": 1.0, "obg": 1.0, "brigado": 1.0, "brigada": 1.0, "valeu": 1.0, "vlw": 1.0, "grato": 1.0,
+        "grata": 1.0, "agradeco": 1.0, "thanks": 1.0, "tchau": 1.0, "ate mais": 1.0, "ate logo": 1.0, "falou": 0.8,
+        "perfeito": 0.5, "otimo": 0.5, "show": 0.5, "beleza": 0.5, "muito obrigado": 1.0, "muito obrigada": 1.0, "pela ajuda": 0.5,
+    },
+    PRODUCT_SEARCH: {
+        "procuro": 1.0, "procurando": 1.0, "busco": 1.0, "buscando": 1.0, "comprar": 1.0, "presente": 1.0, "presentear": 1.0,
+        "recomenda": 1.0, "recomende": 1.0, "recomendacao": 1.0, "recomendacoes": 1.0, "sugestao": 1.0, "sugestoes": 1.0,
+        "sugere": 1.0, "sugira": 1.0, "indica": 1.0, "indicacao": 1.0, "encontrar": 0.8, "achar": 0.6, "quero": 0.6,
+        "queria": 0.6, "preciso": 0.6, "gostaria": 0.5, "opcoes": 0.4, "reais": 0.8, "ate r": 0.8, "barato": 0.6, "barata": 0.6,
+        "melhor": 0.3, "tem": 0.3, "um": 0.2, "uma": 0.2, NUMBER_FEATURE: 0.3,
+        # Common product nouns
+        "tenis": 0.7, "sapato": 0.7, "sandalia": 0.7, "bota": 0.7, "camiseta": 0.7, "camisa": 0.7, "vestido": 0.7,
+        "calca": 0.7, "jaqueta": 0.7, "blusa": 0.7, "bolsa": 0.7, "mochila": 0.7, "relogio": 0.7, "perfume": 0.7,
+        "celular": 0.7, "smartphone": 0.7, "iphone": 0.7, "notebook": 0.7, "fone": 0.7, "tv": 0.7, "televisao": 0.7,
+        "tablet": 0.7, "console": 0.7, "geladeira": 0.7, "cafeteira": 0.7, "airfryer": 0.7, "maquiagem": 0.7, "oculos": 0.7,
+    },
+}
+
+# A message is small talk only if at most one of these is left once the small-talk n-grams are taken out
+SMALL_TALK_STOPWORDS = {"e", "a", "o", "ai", "ta", "ja", "entao", "muito", "voce", "vc", "ajuda", "ok"}
+SMALL_TALK_BREAKERS = {"nao", "mas"} # "obrigado mas não gostei" is not a thank-you
+
+GREETING_REPLIES = [
+    "Oi{name}! 👋 Sou o ShopperGPT, seu assistente de compras. O que você está procurando hoje?",
+    "Olá{name}! 😊 Posso te ajudar a encontrar roupas, eletrônicos, presentes e muito mais. O que você precisa?",
+]
+THANKS_REPLIES = [
+    "Por nada{name}! 😊 Se precisar de mais alguma coisa, é só chamar.",
+    "Imagina{name}! Qualquer coisa, estou por aqui. 🛍️",
+]
+
+intent_stats: Dict[str, int] = {GREETING: 0, THANKS: 0, PRODUCT_SEARCH: 0, OTHER: 0, "templated_replies": 0}
+
+def features(tokens: List[str]) -> List[str]:
+    """Unigrams and bigrams of the normalized tokens, numbers replaced by NUMBER_FEATURE."""
+    tokens = [NUMBER_FEATURE if token.isdigit() else token for token in tokens]
+    return tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]
+
+def scores(tokens: List[str]) -> Dict[str, float]:
+    grams = features(tokens)
+    return {intent: sum(weights.get(gram, 0.0) for gram in grams) for intent, weights in WEIGHTS.items()}
+
+def small_talk_leftover(tokens: List[str]) -> List[str]:
+    """The tokens not part of any small-talk unigram or bigram."""
+    known = [WEIGHTS[intent] for intent in SMALL_TALK_INTENTS]
+    covered = [any(token in weights for weights in known) for token in tokens]
+    for index, pair in enumerate(zip(tokens, tokens[1:])):
+        if any(f"{pair[0]} {pair[1]}" in weights for weights in known):
+            covered[index] = covered[index + 1] = True
+    return [token for token, is_covered in zip(tokens, covered) if not is_covered]
+
+def is_small_talk(text: str, tokens: List[str]) -> bool:
+    """True when nothing but small talk is left to answer in the message."""
+    if len(tokens) > settings.INTENT_SMALL_TALK_MAX_WORDS or SMALL_TALK_BREAKERS.intersection(tokens):
+        return False
+    leftover = small_talk_leftover(tokens)
+    if leftover and "?" in text: # "oi, cadê meu pedido?" (but "tudo bem?" is a greeting)
+        return False
+    return not leftover or (len(leftover) == 1 and leftover[0] in SMALL_TALK_STOPWORDS)
+
+def classify(text: str) -> str:
+    """The intent of an inbound message: GREETING, THANKS, PRODUCT_SEARCH or OTHER."""
+    tokens = tokenize(text)
+    intent_scores = scores(tokens)
+    if intent_scores[PRODUCT_SEARCH] >= 1.0:
+        intent = PRODUCT_SEARCH
+    else:
+        intent = OTHER
+        best = max(SMALL_TALK_INTENTS, key=intent_scores.get)
+        if intent_scores[best] >= 1.0 and is_small_talk(text, tokens):
+            intent = best
+    intent_stats[intent] += 1
+    return intent
+
+def templated_reply(intent: str, profile_name: Optional[str] = None) -> Optional[str]:
+    """A ready-made reply for small-talk intents (None for the others)."""
+    templates = {GREETING: GREETING_REPLIES, THANKS: THANKS_REPLIES}.get(intent)
+    if templates is None:
+        return None
+    intent_stats["templated_replies"] += 1
+    first_name = (profile_name or "").split(" ")[0]
+    return random.choice(templates).format(name=f", {first_name}" if first_name else "")
@@ -0,0 +1,147 @@
+# Tools the LLM can call while writing a reply (OpenAI function calling)
+#
+# - search_products: recommendation_engine.get_recommendations for a query written by the
+#   model (optionally under a max price). The products found are sent to the user as product
+#   cards after the reply, so links and prices are never retyped by the model.
+# - add_to_wishlist: db_manager.add_to_wishlist for a product the model saw in a search
+# - update_user_profile: db_manager.update_user_profile with preferences the user stated
+#
+# ai_service runs the completion loop: every tool call of a completion runs concurrently
+# (each within LLM_TOOL_TIMEOUT_SECONDS), the results go back to the model as tool messages
+# and the model is called again, at most LLM_MAX_TOOL_ROUNDS times per reply. Tool errors
+# are returned to the model as {"error": ...} rather than failing the reply.
+
+import asyncio
+import json
+from typing import Any, Dict, List, Optional
+
+from . import db_manager
+from .config import settings
+from .models import SessionLocal, User
+from .recommendation_engine import get_recommendations
+
+TOOLS_PROMPT = (
+    "Tools: use search_products to find real products (never invent products or prices); the products it returns are sent "
+    "to the user as cards with price and link right after your reply, so refer to them by name and do not repeat links. "
+    "Use add_to_wishlist when the user asks to save a product you found, and update_user_profile when they state lasting "
+    "preferences (style, budget, categories, brands, sizes)."
+)
+
+TOOLS: List[Dict[str, Any]] = [
+    {
+        "type": "function",
+        "function": {
+            "name": "search_products",
+            "description": "Searches the affiliate catalog and returns the best products for the user, ranked for their profile.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "What to search for, in Portuguese, e.g. 'tênis de corrida feminino'"},
+                    "max_price": {"type": "number", "description": "Maximum price in BRL, if the user gave a budget"},
+                    "num_results": {"type": "integer", "description": "How many products to return (1-5)"},
+                },
+                "required": ["query"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "add_to_wishlist",
+            "description": "Saves a product returned by search_products to the user's wishlist (its price is then tracked).",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "product_id": {"type": "string", "description": "product_id from search_products"},
+                    "target_price": {"type": "number", "description": "Price in BRL the user is waiting for, if they said so"},
+                    "notes": {"type": "string"},
+                },
+                "required": ["product_id"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "update_user_profile",
+            "description": "Stores lasting shopping preferences the user stated. Only pass the fields that changed.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "style_preferences": {"type": "string"},
+                    "budget_range": {"type": "string", "description": "e.g. 'até R$ 300'"},
+                    "preferred_categories": {"type": "array", "items": {"type": "string"}},
+                    "brand_preferences": {"type": "array", "items": {"type": "string"}},
+                    "sizes": {"type": "object", "additionalProperties": {"type": "string"}, "description": "e.g. {\"camiseta\": \"M\", \"tênis\": \"38\"}"},
+                },
+            },
+        },
+    },
+]
+
+tool_stats: Dict[str, Dict[str, int]] = {tool["function"]["name"]: {"calls": 0, "errors": 0} for tool in TOOLS}
+
+class ToolContext:
+    """State shared by the tool calls of one reply."""
+
+    def __init__(self, user: User):
+        self.user = user
+        self.recommendations: List[Any] = [] # Products found by search_products, sent as cards after the reply
+        self.calls = 0
+
+async def search_products(context: ToolContext, query: str, max_price: Optional[float] = None, num_results: int = 3) -> Dict[str, Any]:
+    num_results = max(1, min(int(num_results), settings.LLM_SEARCH_MAX_RESULTS))
+    with SessionLocal() as catalog_db:
+        products = await get_recommendations(context.user, query, catalog_db, num_recommendations=num_results, max_price=max_price)
+    seen = {product.id for product in context.recommendations}
+    context.recommendations.extend(product for product in products if product.id not in seen)
+    return {"products": [{"product_id": product.id, "name": product.name, "price": product.price, "description": product.description[:200]}
+                         for product in products]}
+
+# The writes run in a worker thread; the in-memory caches they affect are updated back on the event loop
+
+def _add_to_wishlist(user_id: int, item_data: Dict[str, Any]) -> Dict[str, Any]:
+    with SessionLocal() as db:
+        item = db_manager.add_to_wishlist(db, user_id, item_data, update_caches=False)
+        return {"added": True, "product_name": item.product_name, "current_price": item.current_price, "target_price": item.target_price}
+
+async def add_to_wishlist(context: ToolContext, product_id: str, target_price: Optional[float] = None, notes: Optional[str] = None) -> Dict[str, Any]:
+    item_data = {"product_id": product_id, "target_price": target_price, "notes": notes}
+    result = await asyncio.to_thread(_add_to_wishlist, context.user.id, item_data)
+    db_manager.wishlist_changed(context.user.id)
+    return result
+
+def _update_user_profile(whatsapp_id: str, profile_data: Dict[str, Any]) -> Optional[User]:
+    with SessionLocal() as db:
+        return db_manager.update_user_profile(db, whatsapp_id, profile_data, update_caches=False)
+
+async def update_user_profile(context: ToolContext, **profile_data) -> Dict[str, Any]:
+    profile_data = {field: value for field, value in profile_data.items() if value not in (None, "", [], {})}
+    user = await asyncio.to_thread(_update_user_profile, context.user.whatsapp_id, profile_data)
+    if user is None:
+        return {"error": "Profile not updated"}
+    db_manager.profile_updated(user, profile_data)
+    return {"updated": sorted(profile_data)}
+
+HANDLERS = {"search_products": search_products, "add_to_wishlist": add_to_wishlist, "update_user_profile": update_user_profile}
+
+async def execute(context: ToolContext, name: str, arguments: str) -> str:
+    """Runs one tool call and returns its result as the JSON string for the tool message."""
+    handler = HANDLERS.get(name)
+    if handler is None:
+        return json.dumps({"error": f"Unknown tool {name}"})
+    stats = tool_stats[name]
+    stats["calls"] += 1
+    context.calls += 1
+    try:
+        result = await asyncio.wait_for(handler(context, **json.loads(arguments or "{}")), timeout=settings.LLM_TOOL_TIMEOUT_SECONDS)
+    except Exception as e: # Bad arguments, timeouts and DB errors go back to the model
+        stats["errors"] += 1
+        print(f"ERROR: Tool {name}({arguments}) failed: {e!r}")
+        result = {"error": str(e) or type(e).__name__}
+    return json.dumps(result, ensure_ascii=False, default=str)
+
+async def run_tool_calls(context: ToolContext, tool_calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Runs the tool calls of one completion concurrently. Returns the tool messages, in call order."""
+    results = await asyncio.gather(*(execute(context, call["function"]["name"], call["function"]["arguments"]) for call in tool_calls))
+    return [{"role": "tool", "tool_call_id": call["id"], "content": result} for call, result in zip(tool_calls, results)]
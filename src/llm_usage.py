@@ -0,0 +1,146 @@
+# Per-call LLM usage accounting (tokens, cached tokens, cost, latency)
+#
+# ai_service records every chat completion here (replies, tool rounds, summaries, profile
+# extraction) with the `usage` the API returns, streamed calls included (stream_options
+# include_usage). Rows are buffered in memory and written to the llm_calls table in one
+# INSERT every LLM_USAGE_FLUSH_SECONDS (or once LLM_USAGE_FLUSH_BATCH are pending), off the
+# event loop, so the reply path never waits for the DB. The cost is computed with LLM_PRICES
+# at record time. The admin usage page (/admin/usage-ui) aggregates the table per day, model,
+# purpose and user.
+#
+# The user a call is made for is taken from `current_user`, a ContextVar set by the code that
+# starts the work (ai_service, summarizer, profile_extractor), so the summarizer interface
+# does not need to carry it.
+
+import asyncio
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import settings
+from .models import SessionLocal
+from . import db_manager
+
+current_user: ContextVar[Optional[int]] = ContextVar("llm_usage_user", default=None)
+
+usage_stats = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0,
+               "rows_written": 0, "rows_dropped": 0, "flush_errors": 0}
+_pending: List[Dict[str, Any]] = []
+_flusher: Optional[asyncio.Task] = None
+_flushing: Optional[asyncio.Task] = None
+
+def prices_for(model: str) -> Optional[Tuple[float, float, float]]:
+    """(input, cached input, output) USD per 1M tokens for the longest LLM_PRICES name `model` starts with."""
+    names = [name for name in settings.LLM_PRICES if model.startswith(name)]
+    return settings.LLM_PRICES[max(names, key=len)] if names else None
+
+def call_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    prices = prices_for(model)
+    if prices is None:
+        return 0.0
+    input_price, cached_price, output_price = prices
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1_000_000
+
+def record(model: str, purpose: str, usage: Any, latency_ms: float, first_token_ms: Optional[float] = None,
+           prefix_hash: Optional[str] = None) -> None:
+    """Buffers one completion's usage (`usage` is the API's CompletionUsage, or None if it was not returned)."""
+    if not settings.LLM_USAGE_TRACKING_ENABLED:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+    cost = call_cost(model, prompt_tokens, cached_tokens, completion_tokens)
+    usage_stats["calls"] += 1
+    usage_stats["prompt_tokens"] += prompt_tokens
+    usage_stats["cached_tokens"] += cached_tokens
+    usage_stats["completion_tokens"] += completion_tokens
+    usage_stats["cost_usd"] += cost
+    _pending.append({
+        "created_at": datetime.now(timezone.utc),
+        "user_id": current_user.get(),
+        "purpose": purpose,
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "completion_tokens": completion_tokens,
+        "cost_usd": cost,
+        "latency_ms": round(latency_ms, 1),
+        "first_token_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+        "prefix_hash": prefix_hash,
+    })
+    if len(_pending) > settings.LLM_USAGE_MAX_PENDING:
+        dropped = len(_pending) - settings.LLM_USAGE_MAX_PENDING
+        del _pending[:dropped]
+        usage_stats["rows_dropped"] += dropped
+    if len(_pending) >= settings.LLM_USAGE_FLUSH_BATCH and _flusher is not None and (_flushing is None or _flushing.done()):
+        _schedule_flush()
+
+def _schedule_flush() -> None:
+    global _flushing
+    _flushing = asyncio.create_task(flush())
+
+def _write(rows: List[Dict[str, Any]]) -> None:
+    with SessionLocal() as db:
+        db_manager.insert_llm_calls(db, rows)
+
+async def flush() -> int:
+    """Writes the pending rows. On a DB error they are put back for the next flush."""
+    if not _pending:
+        return 0
+    rows = _pending[:]
+    del _pending[:]
+    try:
+        await asyncio.to_thread(_write, rows)
+    except Exception as e:
+        usage_stats["flush_errors"] += 1
+        print(f"ERROR: Writing {len(rows)} LLM usage rows failed: {e}")
+        _pending[:0] = rows
+        return 0
+    usage_stats["rows_written"] += len(rows)
+    return len(rows)
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(settings.LLM_USAGE_FLUSH_SECONDS)
+        await flush()
+
+def start_flusher() -> None:
+    global _flusher
+    if _flusher is None and settings.LLM_USAGE_TRACKING_ENABLED:
+        _flusher = asyncio.create_task(_flush_loop())
+
+async def stop_flusher() -> None:
+    """Stops the periodic flush and writes what is still pending."""
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        await asyncio.gather(_flusher, return_exceptions=True)
+        _flusher = None
+    if _flushing is not None:
+        await asyncio.gather(_flushing, return_exceptions=True)
+    await flush()
+
+def get_usage_metrics() -> Dict[str, Any]:
+    prompt_tokens = usage_stats["prompt_tokens"]
+    return {
+        "enabled": settings.LLM_USAGE_TRACKING_ENABLED,
+        "pending": len(_pending),
+        "cache_hit_rate": round(usage_stats["cached_tokens"] / prompt_tokens, 3) if prompt_tokens else 0.0,
+        **usage_stats,
+        "cost_usd": round(usage_stats["cost_usd"], 4),
+    }
+
+class Timer:
+    """Latency of one call: started when the request is sent, first token and end marked by the caller."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token_ms: Optional[float] = None
+
+    def mark_first_token(self) -> None:
+        if self.first_token_ms is None:
+            self.first_token_ms = (time.perf_counter() - self.started) * 1000
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
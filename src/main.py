@@ -1,7 +1,7 @@
-from fastapi import FastAPI, Request, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
+import asyncio
+from fastapi import FastAPI, Request, HTTPException
 
-from . import models, db_manager, whatsapp_handler, config
+from . import models, db_manager, whatsapp_handler, whatsapp_sender, ai_service, ingestion_queue, search_index, price_tracker, llm_usage, config
 from .admin_routes import router as admin_router # Import the admin router
 
 # Initialize database (create tables if they don't exist)
@@ -40,10 +40,14 @@ async def verify_whatsapp_webhook(request: Request):
         raise HTTPException(status_code=500, detail="Internal server error during verification")
 
 @app.post("/whatsapp/webhook", tags=["WhatsApp"])
-async def receive_whatsapp_message(payload: models.WhatsAppWebhookPayload, background_tasks: BackgroundTasks, db: Session = Depends(db_manager.get_db)):
+async def receive_whatsapp_message(payload: models.WhatsAppWebhookPayload):
     """Receives messages and events from WhatsApp webhook."""
-    # Process the message in the background to respond quickly to WhatsApp
-    background_tasks.add_task(whatsapp_handler.handle_message, payload, db)
+    # Hand the payload to the ingestion queue; workers process it so we can respond quickly to WhatsApp
+    try:
+        await ingestion_queue.enqueue(payload.model_dump())
+    except ingestion_queue.QueueFullError:
+        # A non-2xx answer makes Meta redeliver later instead of us piling up work
+        raise HTTPException(status_code=503, detail="Ingestion queue is full, retry later")
     # Acknowledge receipt immediately
     return {"status": "received"}
 
@@ -52,12 +56,24 @@ async def receive_whatsapp_message(payload: models.WhatsAppWebhookPayload, backg
 @app.on_event("startup")
 async def startup_event():
     print("ShopperGPT API starting up...")
-    # Perform any startup tasks if needed
+    if config.settings.SEARCH_INDEX_ENABLED:
+        await asyncio.to_thread(search_index.warm_start)
+    await ingestion_queue.start_workers(whatsapp_handler.process_webhook_payload)
+    llm_usage.start_flusher()
+    if config.settings.PRICE_TRACKING_ENABLED:
+        price_tracker.start_scheduler()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     print("ShopperGPT API shutting down...")
-    # Perform any cleanup tasks if needed
+    await ingestion_queue.stop_workers()
+    await price_tracker.stop_scheduler()
+    await llm_usage.stop_flusher() # Writes the usage rows still pending
+    await ai_service.close_client()
+    await whatsapp_sender.sender.close()
+    if config.settings.SEARCH_INDEX_ENABLED and config.settings.SEARCH_INDEX_SNAPSHOT_ON_SHUTDOWN:
+        search_index.save_snapshot()
+    await models.async_engine.dispose()
 
 # --- Run Instruction (for local development) ---
 # To run locally: uvicorn src.main:app --host 0.0.0.0 --port=int(os.getenv("PORT", 8000)) --reload --app-dir /home/ubuntu/shoppergpt
@@ -2,26 +2,39 @@
 
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, JSON
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Float, ForeignKey, JSON, Index, UniqueConstraint
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.sql import func
 from .config import settings # Import settings to get DATABASE_URL
+from .db_pool import engine_options, async_database_url
+from .query_budget import instrument
 
 # --- SQLAlchemy Setup ---
 
 # Check if DATABASE_URL is set, otherwise use a default SQLite for local dev/testing
+# Pooling (size, overflow, recycle, pre-ping, PgBouncer mode) is configured in db_pool.py
 if settings.DATABASE_URL and settings.DATABASE_URL.startswith("postgresql"):
     print(f'Using PostgreSQL database: {settings.DATABASE_URL.split("@")[1]}') # Avoid logging credentials
-    engine = create_engine(settings.DATABASE_URL)
+    engine = create_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL))
 elif settings.DATABASE_URL and settings.DATABASE_URL.startswith("sqlite"):
     print(f"Using SQLite database: {settings.DATABASE_URL}")
-    engine = create_engine(settings.DATABASE_URL, connect_args={"check_same_thread": False})
+    engine = create_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL))
 else:
     db_path = "./shoppergpt.db"
     print(f"WARNING: DATABASE_URL not configured correctly. Using default local SQLite DB: {db_path}")
-    engine = create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+    engine = create_engine(f"sqlite:///{db_path}", **engine_options(f"sqlite:///{db_path}"))
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Async engine on the same database for the webhook hot path (asyncpg / aiosqlite drivers).
+# The sync engine above stays for the admin UI, scripts and background jobs.
+# expire_on_commit=False: objects stay readable after commit without an implicit (blocking) reload
+ASYNC_DATABASE_URL = async_database_url(engine.url.render_as_string(hide_password=False))
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+instrument(engine) # Per-route SQL query budgets (query_budget.py)
+instrument(async_engine.sync_engine)
 Base = declarative_base()
 
 # --- SQLAlchemy Models ---
@@ -52,15 +65,20 @@ class Message(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    whatsapp_message_id = Column(String, index=True) # Not always unique if AI message ID is placeholder
+    whatsapp_message_id = Column(String, unique=True, index=True) # Dedup key for webhook redeliveries (AI replies use "ai_<id>")
     content = Column(Text, nullable=False)
     sender = Column(String, nullable=False) # 'user' or 'assistant'
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     # Add metadata if needed, e.g., message type, media URL
     message_metadata = Column(JSON, nullable=True)
+    # Epoch seconds a worker took the inbound message to answer it (see whatsapp_handler.handle_message)
+    claimed_at = Column(Float, nullable=True)
 
     user = relationship("User", back_populates="messages")
 
+    # Matches get_user_messages (user_id = ? ORDER BY timestamp DESC, id DESC LIMIT n)
+    __table_args__ = (Index("ix_messages_user_id_timestamp", user_id, timestamp.desc(), id.desc()),)
+
 class WishlistItem(Base):
     __tablename__ = "wishlist_items"
 
@@ -72,11 +90,136 @@ class WishlistItem(Base):
     product_image_url = Column(String, nullable=True)
     added_at = Column(DateTime(timezone=True), server_default=func.now())
     notes = Column(Text, nullable=True)
-    # Add price tracking fields if needed (current_price, target_price)
+    # Price tracking (see price_tracker.py)
+    platform = Column(String, nullable=True) # Affiliate platform of product_id; items without one are not tracked
+    current_price = Column(Float, nullable=True) # Latest price seen (BRL)
+    target_price = Column(Float, nullable=True) # Alert as soon as the price reaches this
+    reference_price = Column(Float, nullable=True) # Price the user last heard about; drops are measured from here
 
     user = relationship("User", back_populates="wishlist_items")
 
-# Add other models as needed (e.g., Products cache, AdminUser)
+    __table_args__ = (
+        # Matches get_wishlist_items (user_id = ? ORDER BY added_at DESC)
+        Index("ix_wishlist_items_user_id_added_at", user_id, added_at.desc()),
+        # Distinct tracked products and the items to alert for a product (price_tracker.py)
+        Index("ix_wishlist_items_platform_product_id", platform, product_id),
+    )
+
+class ConversationSummary(Base):
+    """Rolling summary of a user's older messages (see summarizer.py)."""
+    __tablename__ = "conversation_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), unique=True, nullable=False)
+    summary = Column(Text, nullable=False)
+    last_message_id = Column(Integer, nullable=False) # Messages up to this id are folded into the summary
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class WebhookJob(Base):
+    """Durable ingestion queue entry (used when INGESTION_QUEUE_BACKEND=sql)."""
+    __tablename__ = "webhook_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    payload = Column(JSON, nullable=False)
+    status = Column(String, nullable=False, default="pending") # 'pending', 'processing' or 'failed'
+    attempts = Column(Integer, nullable=False, default=0)
+    # Epoch seconds: plain floats compare the same way on PostgreSQL and SQLite
+    available_at = Column(Float, nullable=False)
+    locked_until = Column(Float, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (Index("ix_webhook_jobs_status_available_at", "status", "available_at"),)
+
+class Product(Base):
+    """Local copy of a product returned by an affiliate platform (see affiliate_manager.py)."""
+    __tablename__ = "products"
+
+    id = Column(Integer, primary_key=True, index=True)
+    platform = Column(String, nullable=False) # 'amazon', 'magalu', 'aliexpress'
+    external_id = Column(String, nullable=False, index=True) # Product ID on the platform (ASIN, SKU...), as in wishlist_items.product_id
+    name = Column(String, nullable=False)
+    normalized_name = Column(String, nullable=False, index=True) # text_utils.normalize(name), for lookups
+    category = Column(String, nullable=True, index=True)
+    price = Column(Float, nullable=True, index=True) # Numeric price in BRL, for filtering and sorting
+    price_display = Column(String, nullable=True) # As shown by the platform, e.g. "R$ 99,90"
+    image_url = Column(String, nullable=True)
+    product_url = Column(String, nullable=True)
+    affiliate_link = Column(String, nullable=True)
+    description = Column(Text, nullable=True)
+    fetched_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    price_checked_at = Column(Float, nullable=True) # Epoch seconds of the last price refresh (price_tracker.py)
+
+    __table_args__ = (
+        UniqueConstraint("platform", "external_id", name="uq_products_platform_external_id"),
+        Index("ix_products_category_price", "category", "price"),
+    )
+
+class PriceHistory(Base):
+    """A price observed for a product; a row is added only when the price changes."""
+    __tablename__ = "price_history"
+
+    id = Column(Integer, primary_key=True, index=True)
+    platform = Column(String, nullable=False)
+    external_id = Column(String, nullable=False) # products.external_id / wishlist_items.product_id
+    price = Column(Float, nullable=False)
+    recorded_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (Index("ix_price_history_platform_external_id_recorded_at", "platform", "external_id", "recorded_at"),)
+
+class LLMCall(Base):
+    """Token usage, cost and latency of one chat completion (written in batches by llm_usage.py)."""
+    __tablename__ = "llm_calls"
+
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now()) # Set to the call time by llm_usage.record
+    user_id = Column(Integer, nullable=True) # users.id, None for calls not made for a user (no FK: usage outlives deleted users)
+    purpose = Column(String, nullable=False) # "reply", "summary", "profile_extraction"
+    model = Column(String, nullable=False)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    cached_tokens = Column(Integer, nullable=False, default=0) # Prompt tokens served from the provider's prompt cache
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    cost_usd = Column(Float, nullable=False, default=0.0) # At the LLM_PRICES in effect when the call was made
+    latency_ms = Column(Float, nullable=False) # Request to last token (excludes waiting for a concurrency slot)
+    first_token_ms = Column(Float, nullable=True) # Streamed calls only
+    prefix_hash = Column(String, nullable=True) # Hash of the static prompt prefix: a change explains a cache hit rate drop
+
+    __table_args__ = (
+        Index("ix_llm_calls_created_at", "created_at"),
+        Index("ix_llm_calls_user_id_created_at", "user_id", "created_at"),
+    )
+
+class ProductSearchCache(Base):
+    """Which products a platform returned for a (normalized) search query, and when."""
+    __tablename__ = "product_search_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+    platform = Column(String, nullable=False)
+    query = Column(String, nullable=False) # text_utils.normalize(query)
+    product_ids = Column(JSON, nullable=False) # products.id in the platform's ranking order
+    fetched_at = Column(Float, nullable=False) # Epoch seconds; expired after PRODUCT_CACHE_TTL_BY_PLATFORM[platform]
+
+    __table_args__ = (UniqueConstraint("platform", "query", name="uq_product_search_cache_platform_query"),)
+
+class RecommendationClick(Base):
+    """A user followed the link of a recommended product (implicit feedback for collaborative filtering)."""
+    __tablename__ = "recommendation_clicks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    product_id = Column(String, nullable=False) # Same key as wishlist_items.product_id
+    clicked_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class ItemNeighbor(Base):
+    """Precomputed item-item similarities (see collaborative_filtering.py); rank 0 is the most similar."""
+    __tablename__ = "item_neighbors"
+
+    item_id = Column(String, primary_key=True) # wishlist_items.product_id / products.external_id
+    rank = Column(Integer, primary_key=True)
+    neighbor_id = Column(String, nullable=False)
+    score = Column(Float, nullable=False) # Cosine similarity
+
+# Add other models as needed (e.g., AdminUser)
 
 # --- Pydantic Models ---
 
@@ -88,9 +231,13 @@ class WhatsAppMessageValue(BaseModel):
     messages: Optional[List[dict]] = None
     statuses: Optional[List[dict]] = None
 
+class WhatsAppChange(BaseModel):
+    field: Optional[str] = None # "messages" for message and status notifications
+    value: WhatsAppMessageValue
+
 class WhatsAppMessageEntry(BaseModel):
     id: str
-    changes: List[WhatsAppMessageValue]
+    changes: List[WhatsAppChange]
 
 class WhatsAppWebhookPayload(BaseModel):
     object: str
@@ -112,6 +259,10 @@ class UserProfile(BaseModel):
     class Config:
         from_attributes = True # Replaces orm_mode in Pydantic v2
 
+class UserPage(BaseModel):
+    users: List[UserProfile]
+    next_before_id: Optional[int] = None # Cursor for the next page (before_id), None on the last page
+
 # Pydantic model for Wishlist Item
 class WishlistItemBase(BaseModel):
     product_id: str
@@ -119,6 +270,8 @@ class WishlistItemBase(BaseModel):
     product_url: Optional[str] = None
     product_image_url: Optional[str] = None
     notes: Optional[str] = None
+    platform: Optional[str] = None
+    target_price: Optional[float] = None
 
 class WishlistItemCreate(WishlistItemBase):
     pass
@@ -127,6 +280,7 @@ class WishlistItemResponse(WishlistItemBase):
     id: int
     user_id: int
     added_at: Any
+    current_price: Optional[float] = None
 
     class Config:
         from_attributes = True
@@ -0,0 +1,143 @@
+# Wishlist price tracking: batched price refresh and price-drop alerts
+#
+# Each cycle takes the distinct (platform, product_id) pairs of all wishlists whose price is
+# older than PRICE_REFRESH_INTERVAL_SECONDS, stalest first and at most PRICE_REFRESH_MAX_PER_CYCLE,
+# so a product saved by thousands of users is fetched once. Per platform, IDs are looked up in
+# batches of the provider's price_batch_size with PRICE_REFRESH_CONCURRENCY calls in flight,
+# paced by a token bucket (PRICE_REFRESH_RATE_<PLATFORM>) and guarded by the provider's
+# deadline and circuit breaker; platforms run concurrently.
+#
+# Results are stored every PRICE_REFRESH_WRITE_BATCH products (db_manager.record_price_checks:
+# one transaction with prices, history, wishlist prices and alert messages), so the refresh is
+# incremental: an interrupted cycle resumes with the products it did not reach, and a failed
+# lookup is simply retried next cycle. Alerts go out through whatsapp_sender as they are found.
+#
+# Run the scheduler on one instance only (PRICE_TRACKING_ENABLED=true), or run one cycle from
+# cron with: python -m src.price_tracker
+
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import affiliate_manager, db_manager, whatsapp_sender
+from .config import settings
+from .models import SessionLocal
+from .whatsapp_sender import RateLimiter
+
+tracker_stats = {
+    "cycles": 0, "products_checked": 0, "products_failed": 0, "price_changes": 0, "alerts": 0,
+    "throttled": 0, "last_cycle_seconds": 0.0, "last_cycle_due": 0,
+}
+
+_scheduler: Optional[asyncio.Task] = None
+
+def chunks(items: List[Any], size: int) -> List[List[Any]]:
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+async def lookup_prices(provider: affiliate_manager.AffiliateProvider, limiter: RateLimiter, semaphore: asyncio.Semaphore,
+                        product_ids: List[str]) -> Optional[Dict[str, Optional[float]]]:
+    async with semaphore:
+        await limiter.acquire()
+        return await affiliate_manager.query_prices(provider, product_ids)
+
+async def refresh_platform(platform: str, due: List[Tuple[str, str, Optional[float]]]) -> None:
+    """Refreshes the due products of one platform, storing and alerting one write batch at a time."""
+    provider = affiliate_manager.providers.get(platform)
+    if provider is None:
+        print(f"WARNING: No affiliate provider registered for '{platform}', {len(due)} tracked products skipped")
+        return
+    limiter = RateLimiter(settings.PRICE_REFRESH_RATE_BY_PLATFORM.get(platform, settings.PRICE_REFRESH_REQUESTS_PER_SECOND), stats=tracker_stats)
+    semaphore = asyncio.Semaphore(settings.PRICE_REFRESH_CONCURRENCY)
+    storing: Optional[asyncio.Task] = None # The previous window is stored while the next one is fetched
+    for start in range(0, len(due), settings.PRICE_REFRESH_WRITE_BATCH):
+        window = due[start:start + settings.PRICE_REFRESH_WRITE_BATCH]
+        batches = chunks(window, provider.price_batch_size)
+        results = await asyncio.gather(*(lookup_prices(provider, limiter, semaphore, [product_id for product_id, _, _ in batch]) for batch in batches))
+        checked, prices = [], {}
+        for batch, batch_prices in zip(batches, results):
+            if batch_prices is None: # Failed or short-circuited: left due, retried next cycle
+                tracker_stats["products_failed"] += len(batch)
+                continue
+            checked.extend(batch)
+            prices.update(batch_prices)
+        if storing is not None:
+            await storing
+            storing = None
+        if checked:
+            storing = asyncio.create_task(store_and_alert(platform, checked, prices))
+        elif affiliate_manager.breakers[platform].state == "open":
+            print(f"WARNING: Price refresh on {platform} stopped for this cycle (circuit open)")
+            tracker_stats["products_failed"] += len(due) - start - len(window)
+            break
+    if storing is not None:
+        await storing
+
+async def store_and_alert(platform: str, checked: List[Tuple[str, str, Optional[float]]], prices: Dict[str, Optional[float]]) -> None:
+    alerts, repriced = await asyncio.to_thread(store_checks, platform, checked, prices)
+    # The conversation cache and search index are used on the event loop: update them here
+    db_manager.price_checks_stored(alerts, repriced)
+    tracker_stats["products_checked"] += len(checked)
+    tracker_stats["price_changes"] += sum(1 for product_id, _, previous in checked if prices.get(product_id) not in (None, previous))
+    tracker_stats["alerts"] += len(alerts)
+    # Waiting for the sends keeps a burst of alerts from piling up in the sender's queues
+    await asyncio.gather(*(whatsapp_sender.send_text(alert["phone_number"], alert["content"]) for alert in alerts))
+
+def store_checks(platform: str, checked: List[Tuple[str, str, Optional[float]]],
+                 prices: Dict[str, Optional[float]]) -> Tuple[List[Dict[str, Any]], List[Any]]:
+    """Stores a batch of checks (in a worker thread). Returns the alerts and the repriced Product rows."""
+    with SessionLocal() as db:
+        alerts = db_manager.record_price_checks(db, platform, checked, prices, time.time(), update_caches=False)
+        changed = [product_id for product_id, _, previous in checked if prices.get(product_id) not in (None, previous)]
+        return alerts, db_manager.get_repriced_products(db, platform, changed)
+
+def load_due() -> Dict[str, List[Tuple[str, str, Optional[float]]]]:
+    with SessionLocal() as db:
+        return db_manager.get_due_price_checks(db, time.time() - settings.PRICE_REFRESH_INTERVAL_SECONDS, settings.PRICE_REFRESH_MAX_PER_CYCLE)
+
+async def run_cycle() -> int:
+    """One refresh cycle over every platform. Returns the number of due products."""
+    started = time.perf_counter()
+    due = await asyncio.to_thread(load_due)
+    total = sum(len(products) for products in due.values())
+    await asyncio.gather(*(refresh_platform(platform, products) for platform, products in due.items()))
+    tracker_stats["cycles"] += 1
+    tracker_stats["last_cycle_due"] = total
+    tracker_stats["last_cycle_seconds"] = round(time.perf_counter() - started, 2)
+    if total:
+        print(f"Price refresh: {total} products due, cycle took {tracker_stats['last_cycle_seconds']}s")
+    return total
+
+async def _scheduler_loop() -> None:
+    while True:
+        try:
+            await run_cycle()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"ERROR: Price refresh cycle failed: {e}")
+        await asyncio.sleep(settings.PRICE_REFRESH_CYCLE_SECONDS)
+
+def start_scheduler() -> None:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = asyncio.create_task(_scheduler_loop())
+        print(f"Started price refresh scheduler (every {settings.PRICE_REFRESH_CYCLE_SECONDS:.0f}s).")
+
+async def stop_scheduler() -> None:
+    global _scheduler
+    if _scheduler is not None:
+        _scheduler.cancel()
+        await asyncio.gather(_scheduler, return_exceptions=True)
+        _scheduler = None
+
+def get_tracker_metrics() -> Dict[str, Any]:
+    return {"enabled": settings.PRICE_TRACKING_ENABLED, "running": _scheduler is not None, **tracker_stats}
+
+async def _main() -> None:
+    try:
+        await run_cycle()
+    finally:
+        await whatsapp_sender.sender.close()
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,131 @@
+# Background extraction of profile preferences from the conversation
+#
+# Every PROFILE_EXTRACTION_EVERY_MESSAGES user messages (small talk does not count), a
+# background task sends the user's recent turns (from the in-memory conversation window, no
+# DB read) and their current profile block to the chat model, which returns the profile
+# fields that changed as JSON. Changed fields are stored with db_manager.update_user_profile
+# in a worker thread, then the cached profile block (profile_prompt.py) is rebuilt back on the
+# event loop; when nothing changed, nothing is written and the block stays as it is. The
+# reply to the user never waits for it.
+
+import asyncio
+import json
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .config import settings
+from .models import SessionLocal, User
+from . import context_builder, db_manager, llm_usage, profile_prompt
+from .ai_service import create_chat_completion
+
+EXTRACTION_PROMPT = """
+You keep the shopping profile of a WhatsApp shopper up to date. From the conversation, extract lasting preferences
+the user stated about themselves (not one-off requests, not the assistant's suggestions). Answer with a JSON object
+containing only the fields that are new or changed, with their complete new value:
+- style_preferences: string
+- budget_range: string, e.g. "até R$ 300"
+- preferred_categories: list of strings
+- brand_preferences: list of strings
+- sizes: object, e.g. {"camiseta": "M", "tênis": "38"}
+Answer {} when nothing changed.
+"""
+
+extraction_stats = {"runs": 0, "profiles_updated": 0, "fields_updated": 0, "errors": 0}
+_running: Set[int] = set()
+_tasks: Set[asyncio.Task] = set() # Strong references so pending tasks are not garbage collected
+
+def maybe_schedule_extraction(user_id: int) -> bool:
+    """
+    Counts a user message and starts a background extraction every PROFILE_EXTRACTION_EVERY_MESSAGES.
+    The count lives on the user's conversation window, so it is bounded (and reset) with the cache.
+    """
+    if not settings.PROFILE_EXTRACTION_ENABLED:
+        return False
+    window = context_builder.conversation_cache.peek(user_id)
+    if window is None: # Nothing to extract from anyway
+        return False
+    window.messages_since_extraction += 1
+    if window.messages_since_extraction < settings.PROFILE_EXTRACTION_EVERY_MESSAGES or user_id in _running:
+        return False
+    window.messages_since_extraction = 0
+    _running.add(user_id)
+    task = asyncio.create_task(extract_profile(user_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return True
+
+def clean_profile(data: Any) -> Dict[str, Any]:
+    """Keeps the known profile fields with the expected types (model output is not trusted)."""
+    if not isinstance(data, dict):
+        return {}
+    cleaned = {}
+    for field in ("style_preferences", "budget_range"):
+        if isinstance(data.get(field), str) and data[field].strip():
+            cleaned[field] = data[field].strip()
+    for field in ("preferred_categories", "brand_preferences"):
+        if isinstance(data.get(field), list):
+            values = [str(value).strip() for value in data[field] if str(value).strip()]
+            if values:
+                cleaned[field] = values
+    if isinstance(data.get("sizes"), dict):
+        sizes = {str(key).strip(): str(value).strip() for key, value in data["sizes"].items() if str(key).strip() and str(value).strip()}
+        if sizes:
+            cleaned["sizes"] = sizes
+    return cleaned
+
+async def request_profile(profile: str, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = await create_chat_completion(
+        messages=[
+            {"role": "system", "content": EXTRACTION_PROMPT},
+            {"role": "user", "content": f"Current profile:\n{profile or '(empty)'}\n\nConversation:\n{transcript}"},
+        ],
+        max_tokens=settings.PROFILE_EXTRACTION_MAX_TOKENS,
+        temperature=0,
+        response_format={"type": "json_object"},
+        purpose="profile_extraction",
+    )
+    return clean_profile(json.loads(response.choices[0].message.content or "{}"))
+
+def _apply(user_id: int, extracted: Dict[str, Any]) -> Tuple[Optional[User], List[str]]:
+    """
+    Stores the extracted fields that differ from the stored profile (in a worker thread).
+    Returns the updated user and the fields written; the caches are updated by the caller.
+    """
+    with SessionLocal() as db:
+        user = db.get(User, user_id)
+        if user is None:
+            return None, []
+        changed = {field: value for field, value in extracted.items() if getattr(user, field) != value}
+        if not changed:
+            return None, []
+        user = db_manager.update_user_profile(db, user.whatsapp_id, changed, update_caches=False)
+        if user is None:
+            raise RuntimeError("Profile not updated")
+        return user, sorted(changed)
+
+async def extract_profile(user_id: int) -> Optional[List[str]]:
+    """Updates the user's profile fields from their recent messages."""
+    _running.add(user_id)
+    llm_usage.current_user.set(user_id)
+    try:
+        window = context_builder.conversation_cache.peek(user_id)
+        messages = window.last_messages(settings.PROFILE_EXTRACTION_CONTEXT_TOKENS) if window else []
+        if not any(m["role"] == "user" for m in messages):
+            return None
+        extracted = await request_profile(profile_prompt.profile_blocks.peek(user_id) or "", messages)
+        extraction_stats["runs"] += 1
+        if not extracted:
+            return []
+        user, changed = await asyncio.to_thread(_apply, user_id, extracted)
+        if changed:
+            db_manager.profile_updated(user, changed) # On the event loop: the caches are not thread-safe
+            extraction_stats["profiles_updated"] += 1
+            extraction_stats["fields_updated"] += len(changed)
+            print(f"Extracted profile fields for user {user_id}: {', '.join(changed)}")
+        return changed
+    except Exception as e:
+        extraction_stats["errors"] += 1
+        print(f"ERROR: Profile extraction failed for user {user_id}: {e}")
+        return None
+    finally:
+        _running.discard(user_id)
@@ -0,0 +1,101 @@
+# Per-user profile block for the LLM prompt
+#
+# The profile fields that shape a reply (style, budget, categories, brands, sizes) are turned
+# into one compact system message ("User profile: style: casual | budget: até R$ 300 | ...").
+# The block is built once per user and kept in an LRU keyed by user_id:
+# - a miss loads the user with db.get (no query when the row is already in the session, as in
+#   the webhook path) and builds the block
+# - db_manager.profile_updated rebuilds it after a commit that touched these fields (the
+#   update_user_profile tool and profile_extractor.py call it on the event loop once their
+#   write in a worker thread returns)
+# - entries expire after PROFILE_BLOCK_TTL_SECONDS, so updates made by other workers show up
+# Users without any preferences get no block (and no extra prompt tokens).
+
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .models import User
+
+PROFILE_FIELDS = ("style_preferences", "budget_range", "preferred_categories", "brand_preferences", "sizes")
+LABELS = {"style_preferences": "style", "budget_range": "budget", "preferred_categories": "categories", "brand_preferences": "brands", "sizes": "sizes"}
+
+def format_value(value) -> str:
+    if isinstance(value, dict):
+        return ", ".join(f"{key} {size}" for key, size in value.items() if size)
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value if item)
+    return " ".join(str(value).split()) if value else ""
+
+def profile_block(user: Optional[User]) -> str:
+    """The profile system message for `user` ("" when no preference is set)."""
+    if user is None:
+        return ""
+    parts = []
+    for field in PROFILE_FIELDS:
+        text = format_value(getattr(user, field))
+        if text:
+            parts.append(f"{LABELS[field]}: {text}")
+    if not parts:
+        return ""
+    return f"User profile: {' | '.join(parts)}"[:settings.PROFILE_BLOCK_MAX_CHARS]
+
+def block_fingerprint(block: str) -> str:
+    """Short hash of a profile block (same profile -> same fingerprint), used to key the reply cache."""
+    return hashlib.sha1(block.encode("utf-8")).hexdigest()[:16]
+
+class ProfileBlockCache:
+    """LRU of user_id -> (profile block, built_at)."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "regenerations": 0, "unchanged_updates": 0}
+
+    async def get_async(self, db: AsyncSession, user_id: int) -> str:
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl_seconds:
+            self._entries.move_to_end(user_id)
+            self.stats["hits"] += 1
+            return entry[0]
+        self.stats["misses"] += 1
+        block = profile_block(await db.get(User, user_id))
+        self._store(user_id, block)
+        return block
+
+    def peek(self, user_id: int) -> Optional[str]:
+        """The cached block, if any, without loading or touching LRU order."""
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else None
+
+    def refresh(self, user: User) -> bool:
+        """Rebuilds the user's block after a profile update. Returns True if it changed."""
+        block = profile_block(user)
+        entry = self._entries.get(user.id)
+        if entry is not None and entry[0] == block:
+            self.stats["unchanged_updates"] += 1
+            changed = False
+        else:
+            self.stats["regenerations"] += 1
+            changed = True
+        self._store(user.id, block)
+        return changed
+
+    def invalidate(self, user_id: int) -> None:
+        self._entries.pop(user_id, None)
+
+    def _store(self, user_id: int, block: str) -> None:
+        self._entries[user_id] = (block, time.monotonic())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def metrics(self) -> Dict[str, int]:
+        return {"users": len(self._entries), "max_entries": self.max_entries, **self.stats}
+
+profile_blocks = ProfileBlockCache(max_entries=settings.PROFILE_BLOCK_CACHE_SIZE, ttl_seconds=settings.PROFILE_BLOCK_TTL_SECONDS)
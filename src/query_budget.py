@@ -0,0 +1,87 @@
+# SQL query counting and per-route query budgets
+#
+# An engine event counts every statement executed while a count_queries() block is active
+# (tracked per request/task with a ContextVar, so concurrent requests do not mix). Routes
+# decorated with @query_budget(n) are checked after they return, template rendering included:
+# over budget is logged and counted in /admin/api/metrics, or raises QueryBudgetExceeded when
+# QUERY_BUDGET_ENFORCE=true (tests/CI), which catches N+1 lazy loads as soon as they appear.
+#
+#     with count_queries() as counter:
+#         client.get("/admin/users-ui/5511...")
+#     assert counter.count <= 3, counter.statements
+
+import functools
+import inspect
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import event
+
+from .config import settings
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements: List[str] = []
+
+_current: ContextVar[Optional[QueryCounter]] = ContextVar("query_counter", default=None)
+budget_stats: Dict[str, Dict[str, int]] = {} # route -> {"calls", "max_queries", "over_budget"}
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    counter = _current.get()
+    if counter is not None:
+        counter.count += 1
+        counter.statements.append(statement)
+
+def instrument(engine) -> None:
+    """Counts the statements of `engine` (a sync Engine; pass async_engine.sync_engine for the async one)."""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+
+@contextmanager
+def count_queries() -> Iterator[QueryCounter]:
+    """Counts the statements executed inside the block (nested blocks count separately)."""
+    counter = QueryCounter()
+    token = _current.set(counter)
+    try:
+        yield counter
+    finally:
+        _current.reset(token)
+
+def check_budget(name: str, counter: QueryCounter, max_queries: int) -> None:
+    stats = budget_stats.setdefault(name, {"budget": max_queries, "calls": 0, "max_queries": 0, "over_budget": 0})
+    stats["calls"] += 1
+    stats["max_queries"] = max(stats["max_queries"], counter.count)
+    if counter.count <= max_queries:
+        return
+    stats["over_budget"] += 1
+    message = f"{name} ran {counter.count} SQL queries (budget {max_queries}):\n" + "\n".join(f"  {statement}" for statement in counter.statements)
+    if settings.QUERY_BUDGET_ENFORCE:
+        raise QueryBudgetExceeded(message)
+    print(f"WARNING: {message}")
+
+def query_budget(max_queries: int):
+    """Route decorator: at most `max_queries` SQL statements per call (see module docstring)."""
+    def decorator(route):
+        name = route.__name__
+        if inspect.iscoroutinefunction(route):
+            @functools.wraps(route)
+            async def async_wrapper(*args, **kwargs):
+                with count_queries() as counter:
+                    result = await route(*args, **kwargs)
+                check_budget(name, counter, max_queries)
+                return result
+            return async_wrapper
+
+        @functools.wraps(route)
+        def wrapper(*args, **kwargs):
+            with count_queries() as counter:
+                result = route(*args, **kwargs)
+            check_budget(name, counter, max_queries)
+            return result
+        return wrapper
+    return decorator
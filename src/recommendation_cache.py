@@ -0,0 +1,88 @@
+# Per-user cache of ranked recommendation lists
+#
+# get_recommendations ranks RECOMMENDATION_CACHE_DEPTH products for a (user, normalized query)
+# and stores the whole list, so follow-ups such as "mais opções" or "mais baratas" are served
+# as a page of the cached list (one dictionary read) instead of a new retrieval. Each user's
+# last query and how far they have paged through it are remembered for those follow-ups.
+# Entries expire after RECOMMENDATION_CACHE_TTL_SECONDS and are dropped as soon as the user's
+# profile or wishlist changes (db_manager calls invalidate_user).
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .config import settings
+from .text_utils import normalize
+
+class RankedList:
+    """Ranked recommendations for one (user, query) plus the user's position in it."""
+
+    def __init__(self, query: str, items: List[Any], ttl_seconds: float):
+        self.query = query
+        self.items = items
+        self.next_offset = 0 # Where "mais opções" continues
+        self.last_shown: List[Any] = [] # Reference for "mais baratas"
+        self.expires_at = time.monotonic() + ttl_seconds
+
+class RecommendationCache:
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[int, str], RankedList]" = OrderedDict()
+        self._keys_by_user: Dict[int, Set[Tuple[int, str]]] = {}
+        self._last_key: Dict[int, Tuple[int, str]] = {} # user_id -> key of their latest query
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, user_id: int, query: str) -> Optional[RankedList]:
+        return self._get((user_id, normalize(query)))
+
+    def last(self, user_id: int) -> Optional[RankedList]:
+        """The user's most recent ranked list (what "mais opções" refers to)."""
+        key = self._last_key.get(user_id)
+        return self._get(key) if key is not None else None
+
+    def _get(self, key: Tuple[int, str]) -> Optional[RankedList]:
+        entry = self._entries.get(key)
+        if entry is None or entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self._last_key[key[0]] = key
+        self.stats["hits"] += 1
+        return entry
+
+    def put(self, user_id: int, query: str, items: List[Any]) -> RankedList:
+        key = (user_id, normalize(query))
+        self._remove(key)
+        entry = self._entries[key] = RankedList(query, items, self.ttl_seconds)
+        self._keys_by_user.setdefault(user_id, set()).add(key)
+        self._last_key[user_id] = key
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+        return entry
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Drops every cached list of the user (their profile or wishlist changed)."""
+        for key in list(self._keys_by_user.get(user_id, ())):
+            self._remove(key)
+        self.stats["invalidations"] += 1
+
+    def _remove(self, key: Tuple[int, str]) -> None:
+        if self._entries.pop(key, None) is None:
+            return
+        keys = self._keys_by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[key[0]]
+                self._last_key.pop(key[0], None)
+
+    def metrics(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "users": len(self._keys_by_user), "max_entries": self.max_entries, **self.stats}
+
+recommendation_cache = RecommendationCache(
+    max_entries=settings.RECOMMENDATION_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.RECOMMENDATION_CACHE_TTL_SECONDS,
+)
@@ -1,82 +1,134 @@
 # Recommendation engine for ShopperGPT
 
+import asyncio
+from typing import Dict, Optional
 from sqlalchemy.orm import Session
-from .models import User, Product # Assuming a Product model exists or will be added
-from .db_manager import get_db # Potentially needed
-from .affiliate_manager import search_products # Assuming affiliate manager can search products
+from .models import User
+from .affiliate_manager import search_products
+from .db_manager import get_collaborative_scores, get_products_by_id
+from .config import settings
+from .recommendation_cache import recommendation_cache
+from .text_utils import normalize
+from . import search_index, reranker
+
+# Follow-up requests about the last recommendations (matched on normalized text)
+FOLLOW_UP_MORE = ("mais opcoes", "outras opcoes", "mais sugestoes", "outras sugestoes", "mostrar mais", "mostra mais", "ver mais", "tem outros", "tem outras")
+FOLLOW_UP_CHEAPER = ("mais barat", "menor preco", "mais em conta", "mais economic")
 
-# Placeholder for product data structure (replace with actual model/API response)
 class RecommendedProduct:
-    def __init__(self, id, name, price, image_url, affiliate_link, description=""):
+    def __init__(self, id, name, price, image_url, affiliate_link, description="", price_value=None):
         self.id = id
         self.name = name
         self.price = price
         self.image_url = image_url
         self.affiliate_link = affiliate_link
         self.description = description
+        self.price_value = price_value # Numeric price, for "cheaper" follow-ups
+
+    @classmethod
+    def from_product(cls, product) -> "RecommendedProduct":
+        """Builds a recommendation from a Product row or an affiliate_manager.AffiliateProduct."""
+        return cls(
+            id=getattr(product, "external_id", product.id),
+            name=product.name,
+            price=getattr(product, "price_display", product.price),
+            image_url=product.image_url,
+            affiliate_link=product.affiliate_link,
+            description=product.description or "",
+            price_value=getattr(product, "price_value", product.price),
+        )
 
-def get_recommendations(user: User, query: str, db: Session, num_recommendations: int = 3) -> list[RecommendedProduct]:
+def retrieve(user: User, query: str, k: int, collaborative: Optional[Dict[int, float]] = None) -> list[tuple[int, float]]:
     """
-    Generates product recommendations based on user profile, query, and context.
-    
-    This is a placeholder implementation. A real implementation would involve:
-    1. Understanding the query intent (using NLP/LLM or keywords).
-    2. Fetching relevant products (from DB cache or affiliate APIs).
-    3. Filtering/ranking products based on user profile (style, budget), history, and query.
-    4. Potentially using collaborative filtering or content-based models.
-    5. Formatting results with affiliate links.
+    Top `k` (product_id, score) for the query. With RERANK_ENABLED, RERANK_CANDIDATES products
+    are retrieved by text relevance and re-ranked against the user's profile and their
+    collaborative filtering scores (reranker.py).
     """
-    print(f"Generating recommendations for user {user.id} based on query: '{query}'")
+    index = search_index.product_index
+    if not settings.RERANK_ENABLED:
+        return index.search(query, k=k)
+    slots, relevance = index.top_slots(query, k=max(k, settings.RERANK_CANDIDATES))
+    slots, scores = reranker.rerank(index, slots, relevance, reranker.profile_features(user), k=k, collaborative=collaborative)
+    return list(zip(index.product_ids(slots).tolist(), scores.tolist()))
 
-    # --- Placeholder Logic --- 
-    # In a real scenario, this would involve complex logic.
-    # For now, let's simulate searching products via an assumed affiliate manager function
-    # and returning dummy data.
+async def rank_recommendations(user: User, query: str, db: Session, depth: int) -> list[RecommendedProduct]:
+    """
+    The `depth` best recommendations for the query, best first.
 
-    # Example: Try searching based on the query using the (yet to be implemented) affiliate manager
-    try:
-        # Note: affiliate_manager.search_products needs to be implemented in step 009
-        # searched_products = search_products(query, limit=num_recommendations)
-        # For now, return dummy products
-        print("Recommendation engine: Using dummy product data for now.")
-        dummy_products = [
-            RecommendedProduct(
-                id="DUMMY001", 
-                name=f"Produto Sugerido 1 para '{query[:20]}...'", 
-                price="R$ 99,90", 
-                image_url="https://via.placeholder.com/150", 
-                affiliate_link="#link1",
-                description="Descrição do produto sugerido 1."
-            ),
-            RecommendedProduct(
-                id="DUMMY002", 
-                name=f"Produto Sugerido 2", 
-                price="R$ 149,00", 
-                image_url="https://via.placeholder.com/150", 
-                affiliate_link="#link2",
-                description="Descrição do produto sugerido 2."
-            ),
-            RecommendedProduct(
-                id="DUMMY003", 
-                name=f"Opção Mais Barata", 
-                price="R$ 59,99", 
-                image_url="https://via.placeholder.com/150", 
-                affiliate_link="#link3",
-                description="Uma opção mais acessível."
-            ),
-        ]
-        recommendations = dummy_products[:num_recommendations]
+    Candidates come from the in-process product search index (search_index.py) over the
+    cached catalog, re-ranked against the user's profile. When it has too few matches the
+    affiliate platforms are searched; their results are cached and indexed on the way, so
+    the next similar query is served locally. Queries on the (sync) catalog session run in a
+    worker thread, off the event loop.
+    """
+    # Products similar to the user's wishlist (precomputed by collaborative_filtering.py)
+    collaborative = await asyncio.to_thread(get_collaborative_scores, db, user.id) if settings.RERANK_ENABLED else None
+    hits = retrieve(user, query, depth, collaborative)
+    fetched = []
+    if len(hits) < depth:
+        fetched = await search_products(query, limit=depth, db=db)
+        hits = retrieve(user, query, depth, collaborative)
+    products = await asyncio.to_thread(get_products_by_id, db, [product_id for product_id, _ in hits])
+    ranked = [RecommendedProduct.from_product(products[product_id]) for product_id, _ in hits if product_id in products]
+    # Platform results that did not match the query terms still beat no answer
+    seen = {recommendation.id for recommendation in ranked}
+    ranked += [RecommendedProduct.from_product(product) for product in fetched if product.id not in seen]
+    return ranked[:depth]
 
-    except Exception as e:
-        print(f"Error during recommendation generation (using dummy data): {e}")
-        recommendations = []
+async def get_recommendations(user: User, query: str, db: Session, num_recommendations: int = 3, offset: int = 0,
+                              max_price: Optional[float] = None) -> list[RecommendedProduct]:
+    """
+    Generates product recommendations based on user profile, query, and context.
 
+    The ranked list (RECOMMENDATION_CACHE_DEPTH deep) is cached per user and normalized query,
+    so asking again, for the next page (`offset`) or under a `max_price`, does not rank again.
+    """
+    print(f"Generating recommendations for user {user.id} based on query: '{query}'")
+    entry = recommendation_cache.get(user.id, query)
+    if entry is None:
+        try:
+            ranked = await rank_recommendations(user, query, db, depth=max(settings.RECOMMENDATION_CACHE_DEPTH, offset + num_recommendations))
+        except Exception as e:
+            print(f"Error during recommendation generation: {e}")
+            return []
+        entry = recommendation_cache.put(user.id, query, ranked)
+    if max_price is None:
+        recommendations = entry.items[offset:offset + num_recommendations]
+        entry.next_offset = offset + len(recommendations)
+    else:
+        positions = [position for position in range(offset, len(entry.items))
+                     if entry.items[position].price_value is not None and entry.items[position].price_value <= max_price][:num_recommendations]
+        recommendations = [entry.items[position] for position in positions]
+        entry.next_offset = positions[-1] + 1 if positions else offset
+    entry.last_shown = recommendations
     print(f"Generated {len(recommendations)} recommendations.")
     return recommendations
 
+def get_follow_up_recommendations(user: User, message: str, num_recommendations: int = 3) -> Optional[list[RecommendedProduct]]:
+    """
+    Serves "mais opções" (next page) or "mais baratas" (cheaper than the last ones shown) from
+    the user's last cached recommendation list. Returns None when the message is not such a
+    follow-up or there is nothing cached to follow up on.
+    """
+    text = normalize(message)
+    cheaper = any(marker in text for marker in FOLLOW_UP_CHEAPER)
+    if not cheaper and not any(marker in text for marker in FOLLOW_UP_MORE):
+        return None
+    entry = recommendation_cache.last(user.id)
+    if entry is None:
+        return None
+    if cheaper:
+        shown_prices = [item.price_value for item in entry.last_shown if item.price_value is not None]
+        ceiling = min(shown_prices) if shown_prices else float("inf")
+        recommendations = [item for item in entry.items if item.price_value is not None and item.price_value < ceiling][:num_recommendations]
+    else:
+        recommendations = entry.items[entry.next_offset:entry.next_offset + num_recommendations]
+        entry.next_offset += len(recommendations)
+    if recommendations:
+        entry.last_shown = recommendations
+    print(f"Follow-up on '{entry.query}' for user {user.id}: {len(recommendations)} recommendations from cache")
+    return recommendations
+
 # Future enhancements:
-# - Implement content-based filtering (match product attributes with user profile/query)
-# - Implement collaborative filtering (find similar users/items)
-# - Cache product data and recommendations
 # - Integrate tightly with the LLM for understanding context and refining queries
 
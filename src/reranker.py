@@ -0,0 +1,152 @@
+# Profile-aware re-ranking of retrieved products
+#
+# Candidates from the search index are encoded as a feature matrix (one row per product):
+# - relevance: BM25 score, scaled to [0, 1]
+# - budget: 1 inside User.budget_range, decaying the further the price is outside it
+# - category: product category matches User.preferred_categories
+# - brand: product text contains one of User.brand_preferences
+# - style: share of User.style_preferences terms found in the product text
+# - collaborative: similarity to the user's wishlist from the precomputed item_neighbors
+#   (collaborative_filtering.py), scaled to [0, 1]
+# and scored with a single matrix-vector product against RERANK_WEIGHTS. The user's profile
+# is parsed once and cached until it changes (keyed by its fingerprint).
+
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .config import settings
+from .response_cache import profile_fingerprint
+from .text_utils import normalize, parse_price, tokenize
+
+FEATURES = ("relevance", "budget", "category", "brand", "style", "collaborative")
+STYLE_STOPWORDS = {"de", "da", "do", "das", "dos", "com", "sem", "para", "que", "uma", "mais", "muito", "gosto", "estilo",
+                   "and", "the", "with", "for", "like", "style"}
+
+@dataclass
+class ProfileFeatures:
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    categories: List[str] = field(default_factory=list) # Normalized
+    brands: List[List[str]] = field(default_factory=list) # Tokens of each brand
+    style_terms: List[str] = field(default_factory=list)
+
+def parse_budget_figure(number: str) -> Optional[float]:
+    """A budget figure such as "3.000", "1.299,90" or "99.90": a dot followed by exactly three digits
+    separates thousands (budgets are written the Brazilian way), otherwise parse_price decides."""
+    if re.fullmatch(r"\d{1,3}(?:\.\d{3})+", number):
+        number = number.replace(".", "")
+    return parse_price(number)
+
+def parse_budget(budget_range: Optional[str]) -> Tuple[Optional[float], Optional[float]]:
+    """(min, max) price from free text such as "R$ 100-300", "até 200", "under $50" or "acima de 500"."""
+    if not budget_range:
+        return None, None
+    values = [value for value in (parse_budget_figure(number) for number in re.findall(r"\d+(?:[.,]\d+)*", budget_range)) if value is not None]
+    if not values:
+        return None, None
+    if len(values) >= 2:
+        return min(values), max(values)
+    text = normalize(budget_range)
+    if any(marker in text for marker in ("acima", "mais de", "a partir", "minimo", "over", "above", "at least")):
+        return values[0], None
+    return None, values[0] # "até 200", "under 50", or a single figure: treat it as the ceiling
+
+def parse_profile(user) -> ProfileFeatures:
+    min_price, max_price = parse_budget(user.budget_range)
+    return ProfileFeatures(
+        min_price=min_price,
+        max_price=max_price,
+        categories=[normalize(category) for category in user.preferred_categories or [] if normalize(category)],
+        brands=[tokens for tokens in (tokenize(brand) for brand in user.brand_preferences or []) if tokens],
+        style_terms=[term for term in dict.fromkeys(tokenize(user.style_preferences or "")) if len(term) > 2 and term not in STYLE_STOPWORDS],
+    )
+
+class ProfileFeatureCache:
+    """LRU of user_id -> parsed profile, re-parsed when the profile fingerprint changes."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, Tuple[str, ProfileFeatures]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, user) -> ProfileFeatures:
+        fingerprint = profile_fingerprint(user)
+        entry = self._entries.get(user.id)
+        if entry is not None and entry[0] == fingerprint:
+            self._entries.move_to_end(user.id)
+            self.stats["hits"] += 1
+            return entry[1]
+        self.stats["misses"] += 1
+        features = parse_profile(user)
+        self._entries[user.id] = (fingerprint, features)
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return features
+
+profile_cache = ProfileFeatureCache(max_entries=settings.RERANK_PROFILE_CACHE_SIZE)
+
+def profile_features(user) -> ProfileFeatures:
+    return profile_cache.get(user)
+
+def weight_vector(weights: Optional[Dict[str, float]] = None) -> np.ndarray:
+    weights = weights or settings.RERANK_WEIGHTS
+    return np.array([weights.get(name, 0.0) for name in FEATURES], dtype=np.float32)
+
+def encode_candidates(index, slots: np.ndarray, relevance: np.ndarray, features: ProfileFeatures,
+                      collaborative: Optional[Dict[int, float]] = None) -> np.ndarray:
+    """
+    Feature matrix (len(slots) x len(FEATURES)) of the candidates for this profile.
+    `collaborative` maps product ids to the user's collaborative filtering score.
+    """
+    matrix = np.zeros((len(slots), len(FEATURES)), dtype=np.float32)
+    if not len(slots):
+        return matrix
+    top = float(relevance.max())
+    matrix[:, 0] = relevance / top if top > 0 else 0.0
+
+    prices = index.prices(slots)
+    if features.min_price is None and features.max_price is None:
+        budget = np.full(len(slots), 0.5, dtype=np.float32)
+    else:
+        over = np.maximum(0.0, prices - features.max_price) / features.max_price if features.max_price else np.zeros(len(slots))
+        under = np.maximum(0.0, features.min_price - prices) / features.min_price if features.min_price else np.zeros(len(slots))
+        budget = 1.0 / (1.0 + 4.0 * over + under) # Over budget hurts more than a cheaper product
+        budget = np.where(np.isnan(prices), 0.5, budget) # Unknown price: neutral
+    matrix[:, 1] = budget
+
+    if features.categories:
+        preferred = set(features.categories)
+        codes = [code for code, name in enumerate(index.category_names)
+                 if normalize(name) in preferred or preferred & set(tokenize(name))]
+        matrix[:, 2] = np.isin(index.category_codes(slots), codes)
+
+    terms = sorted({term for brand in features.brands for term in brand} | set(features.style_terms))
+    if terms:
+        presence = index.term_presence(slots, terms)
+        row = {term: i for i, term in enumerate(terms)}
+        if features.brands:
+            matrix[:, 3] = np.any([presence[[row[term] for term in brand]].all(axis=0) for brand in features.brands], axis=0)
+        if features.style_terms:
+            matrix[:, 4] = presence[[row[term] for term in features.style_terms]].mean(axis=0)
+
+    if collaborative:
+        keys = np.fromiter(collaborative.keys(), dtype=np.int64, count=len(collaborative))
+        values = np.fromiter(collaborative.values(), dtype=np.float64, count=len(collaborative))
+        order = np.argsort(keys)
+        keys, values = keys[order], values[order] / values.max()
+        product_ids = index.product_ids(slots)
+        positions = np.minimum(np.searchsorted(keys, product_ids), len(keys) - 1)
+        matrix[:, 5] = np.where(keys[positions] == product_ids, values[positions], 0.0)
+    return matrix
+
+def rerank(index, slots: np.ndarray, relevance: np.ndarray, features: ProfileFeatures, k: int,
+           weights: Optional[Dict[str, float]] = None, collaborative: Optional[Dict[int, float]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Top `k` candidate slots by weighted profile score, best first, with their scores."""
+    scores = encode_candidates(index, slots, relevance, features, collaborative) @ weight_vector(weights)
+    order = np.argsort(-scores, kind="stable")[:k]
+    return slots[order], scores[order]
@@ -0,0 +1,122 @@
+# Opt-in cache of LLM replies for repeated stateless queries ("oi", "quero um presente"...)
+#
+# Two layers, both keyed by a fingerprint of the user's profile so personalised answers are
+# never served to a user with different preferences:
+# - exact: normalized message text (lowercase, no accents/punctuation, collapsed spaces)
+# - similar: character trigram Jaccard similarity >= RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+#   looked up through an inverted trigram index so only overlapping entries are compared;
+#   the numbers in both messages must be identical ("tamanho 42" never matches "tamanho 40")
+# Entries expire after RESPONSE_CACHE_TTL_SECONDS and the least recently used are evicted
+# beyond RESPONSE_CACHE_MAX_ENTRIES.
+
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from .config import settings
+from .text_utils import normalize
+
+def trigrams(normalized: str) -> Set[str]:
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def numbers(normalized: str) -> Tuple[str, ...]:
+    """Digit tokens of a normalized message (sizes, prices, quantities), in order."""
+    return tuple(re.findall(r"\d+", normalized))
+
+def profile_fingerprint(user) -> str:
+    """Short hash of the profile fields that shape a reply (empty profile -> same fingerprint)."""
+    if user is None:
+        return "anonymous"
+    profile = [user.style_preferences, user.budget_range, user.preferred_categories, user.brand_preferences, user.sizes]
+    return hashlib.sha1(json.dumps(profile, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+class ResponseCache:
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity_threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, float, Set[str]]]" = OrderedDict() # key -> (reply, expires_at, trigrams)
+        self._trigram_index: Dict[str, Set[Tuple[str, str]]] = {}
+        self.stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def get(self, fingerprint: str, message: str) -> Optional[str]:
+        normalized = normalize(message)
+        if not normalized:
+            return None
+        key = (fingerprint, normalized)
+        entry = self._entries.get(key)
+        if entry is not None and self._alive(key, entry):
+            self._entries.move_to_end(key)
+            self.stats["exact_hits"] += 1
+            return entry[0]
+
+        grams = trigrams(normalized)
+        digits = numbers(normalized)
+        candidates = {other for gram in grams for other in self._trigram_index.get(gram, ()) if other[0] == fingerprint}
+        candidates = {other for other in candidates if numbers(other[1]) == digits}
+        best_key, best_score = None, 0.0
+        for other in candidates:
+            other_grams = self._entries[other][2]
+            score = len(grams & other_grams) / len(grams | other_grams)
+            if score > best_score:
+                best_key, best_score = other, score
+        if best_key is not None and best_score >= self.similarity_threshold and self._alive(best_key, self._entries[best_key]):
+            self._entries.move_to_end(best_key)
+            self.stats["similar_hits"] += 1
+            return self._entries[best_key][0]
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, fingerprint: str, message: str, reply: str) -> None:
+        normalized = normalize(message)
+        if not normalized:
+            return
+        key = (fingerprint, normalized)
+        self._remove(key)
+        grams = trigrams(normalized)
+        self._entries[key] = (reply, time.monotonic() + self.ttl_seconds, grams)
+        for gram in grams:
+            self._trigram_index.setdefault(gram, set()).add(key)
+        self.stats["stores"] += 1
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    def _alive(self, key, entry) -> bool:
+        if entry[1] > time.monotonic():
+            return True
+        self._remove(key)
+        return False
+
+    def _remove(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for gram in entry[2]:
+            keys = self._trigram_index.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._trigram_index[gram]
+
+    def metrics(self) -> Dict[str, float]:
+        hits = self.stats["exact_hits"] + self.stats["similar_hits"]
+        lookups = hits + self.stats["misses"]
+        return {
+            "enabled": settings.RESPONSE_CACHE_ENABLED,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            **self.stats,
+        }
+
+response_cache = ResponseCache(
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+    similarity_threshold=settings.RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+)
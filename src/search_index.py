@@ -0,0 +1,355 @@
+# In-process BM25 search index over the cached product catalog (products table)
+#
+# - Inverted index term -> (slots, term frequencies) held in growable NumPy arrays, so a query
+#   scores every matching product with a few vectorized operations instead of a table scan.
+# - Price and category facets: filter by price range / categories and count matches per facet.
+# - Incremental: db_manager.store_search_results indexes products as soon as they are upserted.
+#   A product whose text changed gets a new slot and the old one is tombstoned.
+# - Snapshots (SEARCH_INDEX_PATH, .npz) let workers start warm: warm_start() loads the
+#   snapshot and only indexes products fetched after it was taken. Build one offline with
+#   `python -m src.search_index`.
+
+import json
+import math
+import os
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .config import settings
+from .text_utils import tokenize
+
+PRICE_BUCKETS = [0, 50, 100, 200, 500, 1000, 2000] # Lower bounds (BRL) of the price facet buckets
+
+class _Column:
+    """Append-only NumPy array with amortized O(1) growth."""
+
+    def __init__(self, dtype, values: Optional[np.ndarray] = None):
+        self.data = np.asarray(values, dtype=dtype) if values is not None else np.empty(8, dtype=dtype)
+        self.size = len(values) if values is not None else 0
+
+    def extend(self, values) -> None:
+        values = np.asarray(values, dtype=self.data.dtype)
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            grown = np.empty(max(needed, 2 * len(self.data)), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    def view(self) -> np.ndarray:
+        return self.data[:self.size]
+
+class ProductIndex:
+    """BM25 index of product names/categories with price and category facets."""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # Per slot (one slot per indexed version of a product)
+        self._product_ids = _Column(np.int64)
+        self._prices = _Column(np.float64) # NaN when unknown
+        self._categories = _Column(np.int32) # -1 when unknown
+        self._lengths = _Column(np.float32)
+        self._signatures = _Column(np.uint32) # CRC of the indexed tokens, to detect text changes
+        self._alive = _Column(np.bool_)
+        self._postings: Dict[str, Tuple[_Column, _Column]] = {} # term -> (slots, term frequencies)
+        self._slot_of: Dict[int, int] = {} # product id -> live slot
+        self.category_names: List[str] = []
+        self._category_codes: Dict[str, int] = {}
+        self.total_length = 0.0
+        self.high_water: Optional[str] = None # Latest products.fetched_at indexed (ISO format)
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def _category_code(self, category: Optional[str]) -> int:
+        if not category:
+            return -1
+        code = self._category_codes.get(category)
+        if code is None:
+            code = self._category_codes[category] = len(self.category_names)
+            self.category_names.append(category)
+        return code
+
+    def add_many(self, rows: Iterable[Tuple[int, str, Optional[str], Optional[float]]]) -> int:
+        """
+        Indexes (product_id, text, category, price) rows; re-adding a product updates it.
+        Returns the number of new slots.
+        """
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        new_columns = ([], [], [], [], []) # product_ids, prices, categories, lengths, signatures
+        slot = self._product_ids.size
+        rows = {row[0]: row for row in rows} # A product listed twice in one batch is indexed once
+        for product_id, text, category, price in rows.values():
+            tokens = tokenize(text)
+            signature = zlib.crc32(" ".join(tokens).encode("utf-8"))
+            price = float("nan") if price is None else float(price)
+            old_slot = self._slot_of.get(product_id)
+            if old_slot is not None:
+                if self._signatures.data[old_slot] == signature:
+                    # Same text: update the facets in place
+                    self._prices.data[old_slot] = price
+                    self._categories.data[old_slot] = self._category_code(category)
+                    continue
+                self._tombstone(old_slot)
+            counts: Dict[str, int] = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for term, tf in counts.items():
+                slots, tfs = postings.setdefault(term, ([], []))
+                slots.append(slot)
+                tfs.append(tf)
+            for column, value in zip(new_columns, (product_id, price, self._category_code(category), len(tokens), signature)):
+                column.append(value)
+            self._slot_of[product_id] = slot
+            self.total_length += len(tokens)
+            slot += 1
+
+        added = len(new_columns[0])
+        if added:
+            for column, values in zip((self._product_ids, self._prices, self._categories, self._lengths, self._signatures), new_columns):
+                column.extend(values)
+            self._alive.extend(np.ones(added, dtype=np.bool_))
+            for term, (slots, tfs) in postings.items():
+                posting = self._postings.get(term)
+                if posting is None:
+                    self._postings[term] = (_Column(np.int32, slots), _Column(np.float32, tfs))
+                else:
+                    posting[0].extend(slots)
+                    posting[1].extend(tfs)
+        return added
+
+    def _tombstone(self, slot: int) -> None:
+        if self._alive.data[slot]:
+            self._alive.data[slot] = False
+            self.total_length -= float(self._lengths.data[slot])
+
+    def remove(self, product_id: int) -> None:
+        slot = self._slot_of.pop(product_id, None)
+        if slot is not None:
+            self._tombstone(slot)
+
+    def _match(self, query: str, min_price: Optional[float], max_price: Optional[float],
+               categories: Optional[Sequence[str]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Live slots matching the query and facet filters, with their BM25 scores."""
+        terms = set(tokenize(query))
+        live = len(self._slot_of)
+        if not terms or not live:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = np.zeros(self._product_ids.size, dtype=np.float32)
+        lengths = self._lengths.view()
+        avg_length = self.total_length / live or 1.0
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            slots, tfs = posting[0].view(), posting[1].view()
+            idf = math.log(1 + (live - len(slots) + 0.5) / (len(slots) + 0.5))
+            length_norm = self.k1 * (1 - self.b + self.b * lengths[slots] / avg_length)
+            scores[slots] += idf * tfs * (self.k1 + 1) / (tfs + length_norm)
+
+        candidates = np.flatnonzero(scores)
+        mask = self._alive.view()[candidates]
+        if min_price is not None or max_price is not None:
+            prices = self._prices.view()[candidates]
+            if min_price is not None:
+                mask &= prices >= min_price # NaN (unknown price) never matches a price filter
+            if max_price is not None:
+                mask &= prices <= max_price
+        if categories:
+            codes = [self._category_codes[c] for c in categories if c in self._category_codes]
+            mask &= np.isin(self._categories.view()[candidates], codes)
+        candidates = candidates[mask]
+        return candidates, scores[candidates]
+
+    def top_slots(self, query: str, k: int = 10, min_price: Optional[float] = None, max_price: Optional[float] = None,
+                  categories: Optional[Sequence[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Slots and BM25 scores of the top `k` matches, best first."""
+        candidates, scores = self._match(query, min_price, max_price, categories)
+        if len(candidates) > k:
+            top = np.argpartition(-scores, k)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return candidates[order], scores[order]
+
+    def search(self, query: str, k: int = 10, min_price: Optional[float] = None, max_price: Optional[float] = None,
+               categories: Optional[Sequence[str]] = None) -> List[Tuple[int, float]]:
+        """Top `k` (product_id, score) for `query`, best first."""
+        slots, scores = self.top_slots(query, k, min_price, max_price, categories)
+        return list(zip(self.product_ids(slots).tolist(), scores.tolist()))
+
+    # --- Per-slot features (used by reranker.py) ---
+
+    def product_ids(self, slots: np.ndarray) -> np.ndarray:
+        return self._product_ids.view()[slots]
+
+    def prices(self, slots: np.ndarray) -> np.ndarray:
+        return self._prices.view()[slots]
+
+    def category_codes(self, slots: np.ndarray) -> np.ndarray:
+        return self._categories.view()[slots]
+
+    def term_presence(self, slots: np.ndarray, terms: Sequence[str]) -> np.ndarray:
+        """Boolean matrix (len(terms) x len(slots)): whether each slot's text contains each term."""
+        presence = np.zeros((len(terms), len(slots)), dtype=np.bool_)
+        if not len(slots):
+            return presence
+        marks = np.zeros(self._product_ids.size, dtype=np.bool_)
+        for row, term in enumerate(terms):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            term_slots = posting[0].view()
+            marks[term_slots] = True
+            presence[row] = marks[slots]
+            marks[term_slots] = False
+        return presence
+
+    def facets(self, query: str, min_price: Optional[float] = None, max_price: Optional[float] = None,
+               categories: Optional[Sequence[str]] = None) -> Dict[str, Dict[str, int]]:
+        """Match counts per category and per price bucket for `query` (after the given filters)."""
+        candidates, _ = self._match(query, min_price, max_price, categories)
+        codes = self._categories.view()[candidates]
+        category_counts = np.bincount(codes[codes >= 0], minlength=len(self.category_names))
+        prices = self._prices.view()[candidates]
+        prices = prices[~np.isnan(prices)]
+        bucket_counts = np.bincount(np.searchsorted(PRICE_BUCKETS, prices, side="right") - 1, minlength=len(PRICE_BUCKETS))
+        bucket_names = [f"{low}-{high}" for low, high in zip(PRICE_BUCKETS, PRICE_BUCKETS[1:])] + [f"{PRICE_BUCKETS[-1]}+"]
+        return {
+            "categories": {name: int(count) for name, count in zip(self.category_names, category_counts) if count},
+            "price": {name: int(count) for name, count in zip(bucket_names, bucket_counts) if count},
+        }
+
+    # --- Snapshots ---
+
+    def save(self, path: str) -> None:
+        """Writes the index to `path` (atomically, via a temporary file)."""
+        terms = list(self._postings)
+        offsets = np.cumsum([0] + [self._postings[term][0].size for term in terms], dtype=np.int64)
+        empty_slots, empty_tfs = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        meta = {"k1": self.k1, "b": self.b, "total_length": self.total_length, "high_water": self.high_water, "saved_at": time.time()}
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                product_ids=self._product_ids.view(), prices=self._prices.view(), categories=self._categories.view(),
+                lengths=self._lengths.view(), signatures=self._signatures.view(), alive=self._alive.view(),
+                # Terms never contain newlines (see text_utils.normalize)
+                terms=np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8),
+                offsets=offsets,
+                slots=np.concatenate([self._postings[term][0].view() for term in terms] or [empty_slots]),
+                tfs=np.concatenate([self._postings[term][1].view() for term in terms] or [empty_tfs]),
+                category_names=np.frombuffer("\n".join(self.category_names).encode("utf-8"), dtype=np.uint8),
+                meta=np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ProductIndex":
+        with np.load(path) as data:
+            meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+            index = cls(k1=meta["k1"], b=meta["b"])
+            index.total_length = meta["total_length"]
+            index.high_water = meta["high_water"]
+            index._product_ids = _Column(np.int64, data["product_ids"])
+            index._prices = _Column(np.float64, data["prices"])
+            index._categories = _Column(np.int32, data["categories"])
+            index._lengths = _Column(np.float32, data["lengths"])
+            index._signatures = _Column(np.uint32, data["signatures"])
+            index._alive = _Column(np.bool_, data["alive"])
+            names = data["category_names"].tobytes().decode("utf-8")
+            index.category_names = names.split("\n") if names else []
+            index._category_codes = {name: code for code, name in enumerate(index.category_names)}
+            terms = data["terms"].tobytes().decode("utf-8")
+            offsets, slots, tfs = data["offsets"], data["slots"], data["tfs"]
+            for i, term in enumerate(terms.split("\n") if terms else []):
+                start, end = offsets[i], offsets[i + 1]
+                index._postings[term] = (_Column(np.int32, slots[start:end]), _Column(np.float32, tfs[start:end]))
+        alive = index._alive.view()
+        index._slot_of = {int(product_id): slot for slot, product_id in enumerate(index._product_ids.view()) if alive[slot]}
+        return index
+
+    def metrics(self) -> Dict[str, float]:
+        return {"products": len(self), "slots": self._product_ids.size, "terms": len(self._postings), "high_water": self.high_water}
+
+product_index = ProductIndex()
+
+def product_row(product) -> Tuple[int, str, Optional[str], Optional[float]]:
+    """The (product_id, text, category, price) row indexed for a Product."""
+    return product.id, f"{product.name} {product.category or ''}", product.category, product.price
+
+def index_products(products: Iterable) -> None:
+    """Adds freshly upserted Product rows to the live index (called by db_manager)."""
+    if not settings.SEARCH_INDEX_ENABLED:
+        return
+    products = list(products)
+    product_index.add_many(product_row(product) for product in products)
+    _advance_high_water(product_index, products)
+
+def _advance_high_water(index: ProductIndex, products: Sequence) -> None:
+    stamps = [product.fetched_at.isoformat(sep=" ") for product in products if product.fetched_at is not None]
+    if stamps:
+        index.high_water = max([index.high_water or "", *stamps])
+
+def build_from_db(db, index: Optional[ProductIndex] = None, since: Optional[str] = None, batch_size: int = 10000) -> ProductIndex:
+    """Indexes every product (or those fetched at/after `since`), streaming from the DB in batches."""
+    from .models import Product # Imported here: models creates the engine on import
+
+    index = index or ProductIndex()
+    query = db.query(Product)
+    if since:
+        query = query.filter(Product.fetched_at >= datetime.fromisoformat(since))
+    batch = []
+    for product in query.order_by(Product.id).yield_per(batch_size):
+        batch.append(product)
+        if len(batch) >= batch_size:
+            index.add_many(product_row(p) for p in batch)
+            _advance_high_water(index, batch)
+            batch = []
+    index.add_many(product_row(p) for p in batch)
+    _advance_high_water(index, batch)
+    return index
+
+def warm_start(path: Optional[str] = None) -> ProductIndex:
+    """Loads the snapshot (if any), catches up with products fetched since, and installs the index."""
+    global product_index
+    from .models import SessionLocal
+
+    path = path or settings.SEARCH_INDEX_PATH
+    started = time.perf_counter()
+    index = None
+    if os.path.exists(path):
+        try:
+            index = ProductIndex.load(path)
+        except Exception as e:
+            print(f"ERROR: Could not load search index snapshot {path}, rebuilding: {e}")
+    db = SessionLocal()
+    try:
+        index = build_from_db(db, index=index, since=index.high_water if index else None)
+    finally:
+        db.close()
+    product_index = index
+    print(f"Search index ready: {len(index)} products in {time.perf_counter() - started:.2f}s")
+    return index
+
+def save_snapshot(path: Optional[str] = None) -> None:
+    path = path or settings.SEARCH_INDEX_PATH
+    started = time.perf_counter()
+    product_index.save(path)
+    print(f"Search index snapshot written to {path} ({len(product_index)} products, {time.perf_counter() - started:.2f}s)")
+
+if __name__ == "__main__":
+    # Offline build: python -m src.search_index
+    from .models import SessionLocal
+
+    session = SessionLocal()
+    try:
+        product_index = build_from_db(session)
+    finally:
+        session.close()
+    save_snapshot()
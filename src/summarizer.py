@@ -0,0 +1,134 @@
+# Rolling conversation summarization
+#
+# Once a user's unsummarized history grows past SUMMARY_TRIGGER_TOKENS, a background task folds
+# the older turns into the stored per-user summary (conversation_summaries) and keeps only the
+# newest SUMMARY_KEEP_RECENT_TOKENS verbatim. get_ai_response prepends the summary, so prompt
+# size stays flat however long the conversation gets.
+#
+# The summarizer itself is pluggable (SUMMARIZER setting or set_summarizer()):
+# - LLMSummarizer: asks the chat model to update the summary
+# - TruncatingSummarizer: deterministic and local, for tests and offline runs
+
+import asyncio
+from typing import Dict, List, Optional, Protocol, Set, Tuple
+
+from .config import settings
+from .models import SessionLocal
+from . import context_builder, db_manager, llm_usage
+
+SUMMARY_PROMPT = """
+You maintain a running summary of a WhatsApp conversation between a shopper and ShopperGPT, their shopping assistant.
+Update the existing summary with the new messages. Keep facts useful for future recommendations:
+needs, products discussed, budget, sizes, brands and styles liked or rejected, occasions, pending questions.
+Drop greetings and small talk. Write in the user's language, in at most {max_tokens} tokens.
+"""
+
+class Summarizer(Protocol):
+    async def summarize(self, previous_summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+        """Returns the new summary covering `previous_summary` plus `messages` (oldest first)."""
+        ...
+
+class LLMSummarizer:
+    """Summarizes with the chat model (shares the client and concurrency limiter of ai_service)."""
+
+    async def summarize(self, previous_summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+        from .ai_service import create_chat_completion # Late import: ai_service is heavier and optional here
+
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        response = await create_chat_completion(
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT.format(max_tokens=settings.SUMMARY_MAX_TOKENS)},
+                {"role": "user", "content": f"Existing summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}"},
+            ],
+            max_tokens=settings.SUMMARY_MAX_TOKENS,
+            temperature=0.2,
+            purpose="summary",
+        )
+        return response.choices[0].message.content.strip()
+
+class TruncatingSummarizer:
+    """Deterministic stub: appends the messages to the summary and keeps its most recent tail."""
+
+    def __init__(self, max_chars: Optional[int] = None):
+        self.max_chars = max_chars or settings.SUMMARY_MAX_TOKENS * 4
+
+    async def summarize(self, previous_summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+        lines = ([previous_summary] if previous_summary else []) + [f"{m['role']}: {m['content']}" for m in messages]
+        return "\n".join(lines)[-self.max_chars:]
+
+def _default_summarizer() -> Summarizer:
+    if settings.SUMMARIZER == "truncate":
+        return TruncatingSummarizer()
+    return LLMSummarizer()
+
+summarizer: Summarizer = _default_summarizer()
+summary_stats = {"runs": 0, "messages_folded": 0, "errors": 0}
+_running: Set[int] = set() # Users with a summarization in progress
+_tasks: Set[asyncio.Task] = set() # Strong references so pending tasks are not garbage collected
+
+def set_summarizer(new_summarizer: Summarizer) -> None:
+    """Replaces the summarizer (e.g. with a stub in tests)."""
+    global summarizer
+    summarizer = new_summarizer
+
+def maybe_schedule_summary(user_id: int) -> bool:
+    """Starts a background summarization if the user's cached history crossed the threshold."""
+    if not settings.SUMMARY_ENABLED or user_id in _running:
+        return False
+    window = context_builder.conversation_cache.peek(user_id)
+    if window is None or window.tokens < settings.SUMMARY_TRIGGER_TOKENS:
+        return False
+    _running.add(user_id)
+    task = asyncio.create_task(summarize_user(user_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return True
+
+def _messages_to_fold(user_id: int) -> Optional[Tuple[Optional[str], List[Dict[str, str]], int]]:
+    """(previous summary, older messages to fold, id of the last of them), or None if nothing needs folding."""
+    with SessionLocal() as db:
+        previous = db_manager.get_conversation_summary(db, user_id)
+        messages = db_manager.get_unsummarized_messages(db, user_id, limit=settings.SUMMARY_MAX_MESSAGES_PER_RUN)
+
+    # Keep the newest SUMMARY_KEEP_RECENT_TOKENS verbatim; everything older gets folded
+    kept_tokens, split = 0, len(messages)
+    while split > 0:
+        tokens = context_builder.estimate_tokens(messages[split - 1].content) + context_builder.MESSAGE_OVERHEAD_TOKENS
+        if kept_tokens + tokens > settings.SUMMARY_KEEP_RECENT_TOKENS:
+            break
+        kept_tokens += tokens
+        split -= 1
+    if split == 0:
+        return None
+    to_fold = [{"role": context_builder.role_for(m.sender), "content": m.content} for m in messages[:split]]
+    return previous.summary if previous else None, to_fold, messages[split - 1].id
+
+def _save(user_id: int, summary: str, last_message_id: int) -> None:
+    with SessionLocal() as db:
+        db_manager.save_conversation_summary(db, user_id, summary, last_message_id=last_message_id)
+
+async def summarize_user(user_id: int) -> Optional[str]:
+    """Folds the user's older unsummarized messages into their stored summary."""
+    _running.add(user_id)
+    llm_usage.current_user.set(user_id)
+    try:
+        # Sync session: the DB work runs in worker threads, and no connection is held while the (slow) summarizer runs
+        state = await asyncio.to_thread(_messages_to_fold, user_id)
+        if state is None:
+            return None
+        previous_summary, to_fold, last_message_id = state
+
+        new_summary = await summarizer.summarize(previous_summary, to_fold)
+        await asyncio.to_thread(_save, user_id, new_summary, last_message_id)
+        # The cached window still holds the folded turns; the next read reloads summary + the rest
+        context_builder.conversation_cache.invalidate(user_id)
+        summary_stats["runs"] += 1
+        summary_stats["messages_folded"] += len(to_fold)
+        print(f"Summarized {len(to_fold)} messages for user {user_id}")
+        return new_summary
+    except Exception as e:
+        summary_stats["errors"] += 1
+        print(f"ERROR: Conversation summarization failed for user {user_id}: {e}")
+        return None
+    finally:
+        _running.discard(user_id)
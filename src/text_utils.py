@@ -0,0 +1,31 @@
+# Text normalization shared by caches, search and intent detection
+
+import re
+import unicodedata
+from typing import List, Optional
+
+def normalize(text: str) -> str:
+    """Lowercase, accent-free, punctuation-free text with single spaces."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", text)).strip()
+
+def tokenize(text: str) -> List[str]:
+    """Normalized words of `text`."""
+    return normalize(text).split()
+
+def parse_price(price: Optional[str]) -> Optional[float]:
+    """Parses a display price such as "R$ 1.299,90" (or "1299.90") into a float."""
+    if not price:
+        return None
+    digits = re.sub(r"[^\d,.]", "", price)
+    if "," in digits: # Brazilian format: dot thousands separator, comma decimals
+        digits = digits.replace(".", "").replace(",", ".")
+    try:
+        return float(digits)
+    except ValueError:
+        return None
+
+def format_price(price: float) -> str:
+    """Formats a BRL price the Brazilian way, e.g. 1299.9 -> "R$ 1.299,90"."""
+    return "R$ " + f"{price:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
@@ -1,23 +1,27 @@
 # Handles incoming WhatsApp messages and sends replies
 
-import requests
+import asyncio
 import json
+import weakref
 from fastapi import Request, HTTPException, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from .config import settings
-from .models import WhatsAppWebhookPayload, User, Message
-from .db_manager import get_db, get_user_by_whatsapp_id, create_user, create_message
-from .ai_service import get_ai_response
+from .models import SessionLocal, AsyncSessionLocal, WhatsAppWebhookPayload, User, Message
+from .db_manager import get_async_db, create_message_async, record_inbound_batch_async, get_answered_ids_async, claim_inbound_async, release_inbound_claims_async
+from .ai_service import get_ai_response, stream_ai_response
+from . import dedup, whatsapp_sender, summarizer, intent_classifier, llm_tools, profile_extractor
 # Import recommendation engine (ensure it exists)
 try:
-    from .recommendation_engine import get_recommendations, RecommendedProduct
+    from .recommendation_engine import get_recommendations, get_follow_up_recommendations, RecommendedProduct
 except ImportError:
     print("WARNING: Recommendation engine not found or has issues. Recommendations disabled.")
     # Define a dummy function/class if import fails to avoid runtime errors later
     class RecommendedProduct:
         def __init__(self, **kwargs): pass
-    def get_recommendations(*args, **kwargs) -> list:
+    async def get_recommendations(*args, **kwargs) -> list:
         return []
+    def get_follow_up_recommendations(*args, **kwargs):
+        return None
 
 async def verify_webhook(request: Request):
     """Verifies the webhook subscription with WhatsApp."""
@@ -35,115 +39,241 @@ async def verify_webhook(request: Request):
     else:
         raise HTTPException(status_code=400, detail="Missing mode or token")
 
-async def handle_message(payload: WhatsAppWebhookPayload, db: Session = Depends(get_db)):
-    """Processes incoming WhatsApp messages from the webhook."""
-    print("Received webhook payload:", payload.model_dump_json(indent=2))
+async def process_webhook_payload(payload: dict):
+    """Ingestion queue handler: validates a queued payload and processes it with its own DB session."""
+    async with AsyncSessionLocal() as db:
+        return await handle_message(WhatsAppWebhookPayload.model_validate(payload), db)
 
-    if payload.entry and payload.entry[0].changes:
-        change = payload.entry[0].changes[0]
-        if change.value and change.value.messages:
-            message_data = change.value.messages[0]
+def extract_batch(payload: WhatsAppWebhookPayload) -> tuple[list[dict], list[dict]]:
+    """
+    Flattens every entry/change of a webhook payload.
 
-            if message_data.get("type") == "text":
-                phone_number_id = change.value.metadata.get("phone_number_id")
+    Returns (text_messages, statuses). Meta may pack several messages and status updates
+    (from different users) into one POST, so nothing here assumes a single message.
+    """
+    text_messages, statuses = [], []
+    for entry in payload.entry:
+        for change in entry.changes:
+            value = change.value
+            statuses.extend(value.statuses or [])
+            contacts = {contact.get("wa_id"): contact for contact in (value.contacts or [])}
+            for message_data in value.messages or []:
                 from_number = message_data.get("from")
-                whatsapp_message_id = message_data.get("id")
+                if message_data.get("type") != "text":
+                    print(f'Ignoring non-text message type: {message_data.get("type")}')
+                    continue
                 msg_body = message_data.get("text", {}).get("body")
-                timestamp = message_data.get("timestamp")
-                profile_name = change.value.contacts[0].get("profile", {}).get("name") if change.value.contacts else from_number
-                whatsapp_user_id = change.value.contacts[0].get("wa_id") if change.value.contacts else from_number
-
+                # Single-contact changes may omit wa_id matching; fall back to the sender number
+                contact = contacts.get(from_number) or (value.contacts[0] if value.contacts and len(value.contacts) == 1 else {})
+                whatsapp_user_id = contact.get("wa_id") or from_number
                 if not msg_body or not whatsapp_user_id:
                     print("Ignoring message: Missing body or user ID")
-                    return {"status": "ignored", "reason": "Missing body or user ID"}
-
-                print(f"Processing message from {profile_name} ({whatsapp_user_id}): {msg_body}")
-
-                user = get_user_by_whatsapp_id(db, whatsapp_id=whatsapp_user_id)
-                if not user:
-                    print(f"Creating new user for {whatsapp_user_id}")
-                    user = create_user(db, phone_number=from_number, whatsapp_id=whatsapp_user_id)
-
-                create_message(db, user_id=user.id, whatsapp_message_id=whatsapp_message_id, content=msg_body, sender="user")
-
-                ai_reply = await get_ai_response(user_id=user.id, user_message=msg_body, db=db)
-
-                create_message(db, user_id=user.id, whatsapp_message_id=f"ai_{whatsapp_message_id}", content=ai_reply, sender="assistant")
-
-                # Check if recommendations might be relevant based on AI response keywords
-                recommendations = []
-                recommendation_keywords = ["recomendo", "sugestões", "opções", "produtos", "encontrei", "alternativas"]
-                if any(keyword in ai_reply.lower() for keyword in recommendation_keywords):
-                    print("AI response suggests recommendations might be needed. Calling recommendation engine.")
-                    recommendation_query = msg_body # Use user message as query for now
-                    try:
-                        # Pass the actual user object
-                        recommendations = get_recommendations(user=user, query=recommendation_query, db=db, num_recommendations=2)
-                    except Exception as e:
-                        print(f"Error calling recommendation engine: {e}")
-
-                # Send the main AI reply first
-                send_whatsapp_message(to=from_number, message_body=ai_reply)
-
-                # Send recommendations if any (as separate messages)
-                if recommendations:
-                    print(f"Sending {len(recommendations)} recommendations...")
-                    for product in recommendations:
-                        # Basic text format - Enhance with WhatsApp formatting or templates later
-                        product_message = (
-                            f"*{product.name}*\n"
-                            f"Preço: {product.price}\n"
-                            # f"{product.description}\n" # Keep it concise for chat
-                            f"Link: {product.affiliate_link}"
-                            # Add image URL if possible/desired: f"\nImagem: {product.image_url}"
-                        )
-                        send_whatsapp_message(to=from_number, message_body=product_message)
-                else:
-                    print("No recommendations generated or triggered.")
-
-                return {"status": "processed"}
-            else:
-                print(f'Ignoring non-text message type: {message_data.get("type")}')
-                return {"status": "ignored", "reason": "Non-text message"}
-        elif change.value and change.value.statuses:
-            print(f"Received status update: {change.value.statuses[0]}")
-            return {"status": "status_update_received"}
-
-    print("Ignoring webhook event: Not a message or status update")
-    return {"status": "ignored", "reason": "Not a message or status update"}
-
-def send_whatsapp_message(to: str, message_body: str):
-    """Sends a text message via the WhatsApp Cloud API."""
-    if not settings.WHATSAPP_API_TOKEN or not settings.WHATSAPP_PHONE_NUMBER_ID:
-        print("ERROR: WhatsApp API Token or Phone Number ID not configured. Cannot send message.")
-        return None
+                    continue
+                text_messages.append({
+                    "whatsapp_id": whatsapp_user_id,
+                    "phone_number": from_number,
+                    "profile_name": contact.get("profile", {}).get("name"),
+                    "whatsapp_message_id": message_data.get("id"),
+                    "content": msg_body,
+                    "timestamp": int(message_data.get("timestamp") or 0),
+                })
+    return text_messages, statuses
+
+# One lock per user serializes their messages across concurrent batches/workers.
+# Weak values let idle users' locks be garbage collected.
+_user_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _get_user_lock(whatsapp_user_id: str) -> asyncio.Lock:
+    lock = _user_locks.get(whatsapp_user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[whatsapp_user_id] = lock
+    return lock
+
+async def handle_message(payload: WhatsAppWebhookPayload, db: AsyncSession = Depends(get_async_db)):
+    """Processes every message and status update in a WhatsApp webhook batch."""
+    print("Received webhook payload:", payload.model_dump_json(indent=2))
+
+    text_messages, statuses = extract_batch(payload)
+    for status in statuses:
+        print(f"Received status update: {status}")
 
-    url = f"https://graph.facebook.com/v19.0/{settings.WHATSAPP_PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {settings.WHATSAPP_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    data = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "text",
-        "text": {"body": message_body},
-    }
+    if not text_messages:
+        if statuses:
+            return {"status": "status_update_received", "statuses": len(statuses)}
+        print("Ignoring webhook event: Not a message or status update")
+        return {"status": "ignored", "reason": "Not a message or status update"}
 
+    # Drop redelivered messages before any DB or LLM work
+    text_messages = [m for m in text_messages if dedup.claim_message(m["whatsapp_message_id"])]
+    if not text_messages:
+        print("All messages in batch were duplicate deliveries. Ignoring.")
+        return {"status": "ignored", "reason": "Duplicate delivery"}
+
+    text_messages.sort(key=lambda m: m["timestamp"]) # Stable: keeps payload order on ties
+
+    # All inbound messages of the batch (and any new users) are written in one transaction
     try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        print(f"Message sent to {to}. Status: {response.status_code}. Response: {response.json()}")
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"ERROR: Failed to send WhatsApp message to {to}: {e}")
-        if e.response is not None:
-            print(f"Response status: {e.response.status_code}")
-            print(f"Response text: {e.response.text}")
-        return None
+        users, inserted_ids = await record_inbound_batch_async(db, text_messages)
+    except Exception:
+        dedup.release_messages(m["whatsapp_message_id"] for m in text_messages if m["whatsapp_message_id"])
+        raise # Nothing stored: the ingestion queue retries the batch
+
+    # Messages already in the DB may be answered, or being answered, by another worker (or before a
+    # restart). New rows are claimed by this batch on insert; for the others a conditional UPDATE
+    # decides which worker answers, and a claim older than INBOUND_CLAIM_TTL_SECONDS (its run
+    # died) is taken over. Of the claimed ones, only a stored reply counts as answered.
+    stored_before = [m["whatsapp_message_id"] for m in text_messages if m["whatsapp_message_id"] and m["whatsapp_message_id"] not in inserted_ids]
+    claimed_ids = await claim_inbound_async(db, stored_before)
+    dedup.release_messages(set(stored_before) - claimed_ids) # Claimed elsewhere: accept a redelivery if that worker dies
+    answered_ids = await get_answered_ids_async(db, list(claimed_ids))
+    skipped = (set(stored_before) - claimed_ids) | answered_ids
+    if skipped:
+        dedup.record_db_duplicates(len(skipped))
+        print(f"Skipping {len(skipped)} messages already answered or being answered by another worker")
+        text_messages = [m for m in text_messages if m["whatsapp_message_id"] not in skipped]
+    if len(claimed_ids) > len(answered_ids):
+        print(f"Answering {len(claimed_ids) - len(answered_ids)} messages stored earlier without a reply")
+    if not text_messages:
+        return {"status": "ignored", "reason": "Duplicate delivery"}
+
+    # Fan out per user: a user's messages are answered in order, different users in parallel
+    messages_by_user: dict[str, list[dict]] = {}
+    for message in text_messages:
+        messages_by_user.setdefault(message["whatsapp_id"], []).append(message)
+
+    try:
+        results = await asyncio.gather(
+            *(process_user_messages(users[whatsapp_user_id], messages) for whatsapp_user_id, messages in messages_by_user.items()),
+            return_exceptions=True,
+        )
+    except asyncio.CancelledError:
+        message_ids = [m["whatsapp_message_id"] for m in text_messages if m["whatsapp_message_id"]]
+        dedup.release_messages(message_ids)
+        await release_claims(db, message_ids, shielded=True)
+        raise
+    failed = [(whatsapp_user_id, result) for whatsapp_user_id, result in zip(messages_by_user, results) if isinstance(result, BaseException)]
+    if failed:
+        for whatsapp_user_id, error in failed:
+            print(f"ERROR: Failed to answer messages from {whatsapp_user_id}: {error!r}")
+            message_ids = [m["whatsapp_message_id"] for m in messages_by_user[whatsapp_user_id] if m["whatsapp_message_id"]]
+            dedup.release_messages(message_ids)
+            await release_claims(db, message_ids)
+        # The ingestion queue retries the batch; messages answered meanwhile are skipped on their stored reply
+        raise failed[0][1]
+
+    return {"status": "processed", "messages": len(text_messages), "users": len(messages_by_user), "statuses": len(statuses)}
+
+async def release_claims(db: AsyncSession, whatsapp_message_ids: list[str], shielded: bool = False) -> None:
+    """
+    Best effort: lets the retry answer the messages at once. A claim left behind (DB error,
+    or the process stopping first) expires after INBOUND_CLAIM_TTL_SECONDS.
+    """
+    try:
+        release = release_inbound_claims_async(db, whatsapp_message_ids)
+        await (asyncio.shield(release) if shielded else release) # Shielded: the handler is being cancelled
     except Exception as e:
-        print(f"ERROR: An unexpected error occurred while sending WhatsApp message: {e}")
-        return None
+        print(f"ERROR: Could not release the claims on {len(whatsapp_message_ids)} messages: {e!r}")
+
+async def process_user_messages(user: User, messages: list[dict]):
+    """Answers one user's messages from a batch, in order, under that user's lock."""
+    async with _get_user_lock(messages[0]["whatsapp_id"]):
+        async with AsyncSessionLocal() as db: # Own session: units for different users run concurrently
+            # The row returned by the batch upsert: later db.get(User, ...) calls need no query
+            await db.merge(user, load=False)
+            for message in messages:
+                await respond_to_message(db, user.id, message)
+
+async def respond_to_message(db: AsyncSession, user_id: int, message: dict):
+    """Generates and sends the assistant reply (and recommendations) for one stored inbound message."""
+    from_number = message["phone_number"]
+    msg_body = message["content"]
+    whatsapp_message_id = message["whatsapp_message_id"]
+    print(f"Processing message from {message['profile_name'] or from_number} ({message['whatsapp_id']}): {msg_body}")
+
+    user = await db.get(User, user_id) # No query: process_user_messages merged the row into the session
+    # "Mais opções" / "mais baratas" continue the user's last recommendations from the cache
+    recommendations = get_follow_up_recommendations(user, msg_body, num_recommendations=2)
+    intent = intent_classifier.classify(msg_body) if settings.INTENT_CLASSIFIER_ENABLED else intent_classifier.OTHER
+    # With tool calling the model searches products itself (llm_tools.py)
+    tool_context = llm_tools.ToolContext(user) if settings.LLM_TOOLS_ENABLED else None
+    retrieval = None
+    if recommendations is None and intent == intent_classifier.PRODUCT_SEARCH and tool_context is None:
+        # Retrieval only needs the user's message: run it while the LLM writes the reply
+        retrieval = asyncio.create_task(recommend(user, msg_body))
+
+    sends = []
+    ai_reply = intent_classifier.templated_reply(intent, user.profile_name)
+    if ai_reply is not None:
+        print(f"Small talk ({intent}): templated reply, no LLM call")
+        sends.append(asyncio.create_task(send_whatsapp_message(to=from_number, message_body=ai_reply)))
+    elif settings.STREAMING_REPLIES:
+        # Each chunk is queued for sending as soon as it is complete (the per-recipient queue
+        # keeps them in order); the full reply is stored once at the end
+        chunks = []
+        async for chunk in stream_ai_response(user_id=user_id, user_message=msg_body, db=db, tool_context=tool_context,
+                                              message_id=whatsapp_message_id):
+            chunks.append(chunk)
+            sends.append(asyncio.create_task(send_whatsapp_message(to=from_number, message_body=chunk.strip())))
+        ai_reply = "".join(chunks).strip()
+    else:
+        ai_reply = await get_ai_response(user_id=user_id, user_message=msg_body, db=db, tool_context=tool_context,
+                                         message_id=whatsapp_message_id)
+        # Queue the main AI reply first; the per-recipient queue keeps the order
+        sends.append(asyncio.create_task(send_whatsapp_message(to=from_number, message_body=ai_reply)))
+
+    await create_message_async(db, user_id=user_id, whatsapp_message_id=f"ai_{whatsapp_message_id}", content=ai_reply, sender="assistant")
+    # Fold older turns into the rolling summary in the background once history gets long
+    summarizer.maybe_schedule_summary(user_id)
+    # Every few messages, update the stored preferences from the conversation in the background
+    if intent not in intent_classifier.SMALL_TALK_INTENTS:
+        profile_extractor.maybe_schedule_extraction(user_id)
+
+    if retrieval is not None:
+        recommendations = await retrieval
+    elif tool_context is not None:
+        recommendations = recommendations or tool_context.recommendations # Products the model found with search_products
+    elif recommendations is None and intent == intent_classifier.OTHER:
+        # Unclassified messages: recommend if the AI reply talks about products
+        recommendation_keywords = ["recomendo", "sugestões", "opções", "produtos", "encontrei", "alternativas"]
+        if any(keyword in ai_reply.lower() for keyword in recommendation_keywords):
+            print("AI response suggests recommendations might be needed. Calling recommendation engine.")
+            recommendations = await recommend(user, msg_body) # Use user message as query for now
+
+    # Send recommendations if any (as separate messages)
+    if recommendations:
+        print(f"Sending {len(recommendations)} recommendations...")
+        for product in recommendations:
+            # Basic text format - Enhance with WhatsApp formatting or templates later
+            product_message = (
+                f"*{product.name}*\n"
+                f"Preço: {product.price}\n"
+                # f"{product.description}\n" # Keep it concise for chat
+                f"Link: {product.affiliate_link}"
+                # Add image URL if possible/desired: f"\nImagem: {product.image_url}"
+            )
+            sends.append(send_whatsapp_message(to=from_number, message_body=product_message))
+    else:
+        print("No recommendations generated or triggered.")
+
+    await asyncio.gather(*sends)
+
+async def recommend(user: User, query: str) -> list:
+    """Recommendations for the message (errors are logged and give no recommendations)."""
+    try:
+        # Product search and ranking use the sync catalog session; its queries run in worker threads
+        with SessionLocal() as catalog_db:
+            return await get_recommendations(user=user, query=query, db=catalog_db, num_recommendations=2)
+    except Exception as e:
+        print(f"Error calling recommendation engine: {e}")
+        return []
+
+async def send_whatsapp_message(to: str, message_body: str):
+    """Sends a text message via the WhatsApp Cloud API (pooled, ordered per recipient, retried)."""
+    response = await whatsapp_sender.send_text(to, message_body)
+    if response is not None:
+        print(f"Message sent to {to}. Response: {response}")
+    return response
 
 # Add functions to send other message types (images, buttons, lists) as needed
 
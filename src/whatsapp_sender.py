@@ -0,0 +1,172 @@
+# Outbound delivery to the WhatsApp Cloud API
+#
+# - One shared keep-alive httpx.AsyncClient (HTTP/2 when the `h2` package is installed),
+#   so sends reuse TLS connections to graph.facebook.com instead of a handshake per message.
+# - A FIFO queue per recipient keeps each user's messages in order while different users
+#   are sent concurrently.
+# - A token bucket caps the phone number's throughput (WHATSAPP_MESSAGES_PER_SECOND, set it
+#   to the Cloud API tier of the number).
+# - 429 and 5xx responses (and network errors) are retried with jittered exponential backoff,
+#   honouring Retry-After when present.
+
+import asyncio
+import random
+import time
+from typing import Any, Dict, Optional, Set
+
+import httpx
+
+from .config import settings
+
+try:
+    import h2 # noqa: F401 - only needed to enable HTTP/2 in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+sender_stats = {"sent": 0, "failed": 0, "retries": 0, "throttled": 0}
+
+class RateLimiter:
+    """Token bucket: allows `rate` sends per second with bursts of up to `burst`. Waits are counted in stats["throttled"]."""
+
+    def __init__(self, rate: float, burst: Optional[int] = None, stats: Optional[Dict[str, int]] = None):
+        self.rate = rate
+        self.stats = sender_stats if stats is None else stats
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock: # Waiters are served in FIFO order
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                self.stats["throttled"] += 1
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Full-jitter exponential backoff (base 0.5s, capped at 30s); Retry-After wins when given."""
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, min(30.0, 0.5 * 2 ** attempt))
+
+class WhatsAppSender:
+    """Pooled async sender with per-recipient ordering, rate limiting and retries."""
+
+    def __init__(self, base_url: str, phone_number_id: Optional[str], api_token: Optional[str],
+                 messages_per_second: float, max_retries: int, timeout: float, max_connections: int):
+        self.url = f"{base_url.rstrip('/')}/{phone_number_id}/messages"
+        self.configured = bool(api_token and phone_number_id)
+        self.max_retries = max_retries
+        self.rate_limiter = RateLimiter(messages_per_second)
+        self._headers = {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
+        self._client_options = {
+            "http2": HTTP2_AVAILABLE,
+            "timeout": timeout,
+            "limits": httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        }
+        self._client: Optional[httpx.AsyncClient] = None
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._drains: Set[asyncio.Task] = set() # Strong references so running drains are not garbage collected
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created lazily so it binds to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(**self._client_options)
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def enqueue(self, to: str, data: Dict[str, Any]) -> asyncio.Future:
+        """Queues a message for `to`. The returned future resolves to the API response JSON (or None on failure)."""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(to)
+        if queue is None:
+            queue = self._queues[to] = asyncio.Queue()
+            task = asyncio.create_task(self._drain(to, queue))
+            self._drains.add(task)
+            task.add_done_callback(self._drains.discard)
+        queue.put_nowait((data, future))
+        return future
+
+    async def _drain(self, to: str, queue: asyncio.Queue) -> None:
+        """Sends one recipient's messages in order; exits once their queue is empty."""
+        try:
+            while not queue.empty():
+                data, future = queue.get_nowait()
+                try:
+                    result = await self._post_with_retries(to, data)
+                except Exception as e:
+                    print(f"ERROR: An unexpected error occurred while sending WhatsApp message: {e}")
+                    result = None
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            # No await between the empty check and removal, so no message can be stranded
+            self._queues.pop(to, None)
+
+    async def _post_with_retries(self, to: str, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            retry_after = None
+            try:
+                response = await self.client.post(self.url, headers=self._headers, json=data)
+                if response.status_code < 400:
+                    sender_stats["sent"] += 1
+                    return response.json()
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    print(f"ERROR: Failed to send WhatsApp message to {to}: {response.status_code} {response.text}")
+                    break
+                retry_after = response.headers.get("Retry-After")
+                error = f"HTTP {response.status_code}"
+            except httpx.TransportError as e:
+                error = repr(e)
+            if attempt < self.max_retries:
+                delay = backoff_delay(attempt, retry_after)
+                print(f"WARNING: WhatsApp send to {to} failed ({error}). Retrying in {delay:.2f}s ({attempt + 1}/{self.max_retries})")
+                sender_stats["retries"] += 1
+                await asyncio.sleep(delay)
+            else:
+                print(f"ERROR: Giving up sending WhatsApp message to {to} after {attempt + 1} attempts ({error})")
+        sender_stats["failed"] += 1
+        return None
+
+sender = WhatsAppSender(
+    base_url=settings.WHATSAPP_API_BASE_URL,
+    phone_number_id=settings.WHATSAPP_PHONE_NUMBER_ID,
+    api_token=settings.WHATSAPP_API_TOKEN,
+    messages_per_second=settings.WHATSAPP_MESSAGES_PER_SECOND,
+    max_retries=settings.WHATSAPP_SEND_MAX_RETRIES,
+    timeout=settings.WHATSAPP_SEND_TIMEOUT_SECONDS,
+    max_connections=settings.WHATSAPP_MAX_CONNECTIONS,
+)
+
+async def send_text(to: str, message_body: str) -> Optional[Dict[str, Any]]:
+    """Queues a text message and waits until it is delivered (or given up on)."""
+    if not sender.configured:
+        print("ERROR: WhatsApp API Token or Phone Number ID not configured. Cannot send message.")
+        return None
+    data = {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "type": "text",
+        "text": {"body": message_body},
+    }
+    return await sender.enqueue(to, data)
+
+def get_sender_metrics() -> Dict[str, Any]:
+    return {"http2": HTTP2_AVAILABLE, "active_recipients": len(sender._queues), **sender_stats}
@@ -0,0 +1,94 @@
+"""
+SQL query budgets of the admin routes, with QUERY_BUDGET_ENFORCE on.
+
+Every budgeted route is requested against a seeded SQLite database (a user with enough
+messages, wishlist items and LLM calls that a lazy load per row would show up) and must stay
+within its @query_budget; the statements each one ran are also checked exactly.
+
+Run with: python -m pytest tests
+"""
+
+import os
+import tempfile
+from datetime import datetime, timezone
+
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{tempfile.mkdtemp()}/test.db",
+    "QUERY_BUDGET_ENFORCE": "true",
+    "SEARCH_INDEX_ENABLED": "false",
+})
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+
+from src import db_manager
+from src.config import settings
+from src.main import app
+from src.models import LLMCall, Message, SessionLocal, User, WishlistItem, engine
+from src.query_budget import QueryBudgetExceeded, budget_stats, count_queries, query_budget
+
+WHATSAPP_ID = "5511999900000" # User 1
+AUTH = (settings.ADMIN_USERNAME, settings.ADMIN_PASSWORD)
+
+# route name -> (path, statements it runs)
+ROUTES = {
+    "list_users_html": ("/admin/users-ui", 1),
+    "get_user_details_html": (f"/admin/users-ui/{WHATSAPP_ID}", 3),
+    "llm_usage_html": ("/admin/usage-ui", 4),
+    "list_users_api": ("/admin/api/users", 1),
+    "get_user_details_api": (f"/admin/api/users/{WHATSAPP_ID}", 1),
+    "get_user_conversation_api": (f"/admin/api/users/{WHATSAPP_ID}/messages", 2),
+    "get_user_wishlist_api": (f"/admin/api/users/{WHATSAPP_ID}/wishlist", 2),
+    "get_llm_usage_api": ("/admin/api/llm-usage", 4),
+}
+
+
+@pytest.fixture(scope="module")
+def client():
+    db_manager.init_db()
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": i + 1, "whatsapp_id": f"55119999{i:05d}", "phone_number": f"55119999{i:05d}"} for i in range(20)])
+        conn.execute(insert(Message), [{"user_id": 1, "whatsapp_message_id": f"wamid.{i}", "content": f"mensagem {i}",
+                                        "sender": "user" if i % 2 == 0 else "assistant"} for i in range(30)])
+        conn.execute(insert(WishlistItem), [{"user_id": 1, "product_id": f"p{i}", "product_name": f"Produto {i}"} for i in range(10)])
+        conn.execute(insert(LLMCall), [{"created_at": datetime.now(timezone.utc), "user_id": 1 + i % 5, "purpose": "reply", "model": "gpt-4o-mini",
+                                        "prompt_tokens": 1000, "cached_tokens": 500, "completion_tokens": 100, "cost_usd": 0.0002,
+                                        "latency_ms": 800.0} for i in range(25)])
+    return TestClient(app) # Without the context manager: no startup tasks (queue workers, flushers)
+
+
+@pytest.mark.parametrize("name", ROUTES)
+def test_admin_route_within_budget(client, name):
+    path, expected = ROUTES[name]
+    response = client.get(path, auth=AUTH)
+    assert response.status_code == 200, response.text
+    stats = budget_stats[name]
+    assert stats["over_budget"] == 0
+    assert stats["max_queries"] == expected <= stats["budget"]
+
+
+def test_over_budget_raises_when_enforced(client):
+    budget_app = FastAPI()
+
+    @budget_app.get("/users")
+    @query_budget(1)
+    def users_with_lazy_loads():
+        with SessionLocal() as db:
+            return [len(user.messages) for user in db.query(User).limit(3)] # One query, then one per user
+
+    with pytest.raises(QueryBudgetExceeded, match=r"users_with_lazy_loads ran 4 SQL queries \(budget 1\)"):
+        TestClient(budget_app).get("/users")
+
+
+def test_count_queries(client):
+    with SessionLocal() as db:
+        with count_queries() as counter:
+            db_manager.get_user_by_whatsapp_id(db, WHATSAPP_ID)
+            with count_queries() as inner:
+                db_manager.get_wishlist_items(db, user_id=1)
+            db_manager.get_user_messages(db, user_id=1)
+    assert counter.count == 2 # Nested blocks count separately
+    assert inner.count == 1
+    assert "wishlist_items" in inner.statements[0]
@@ -0,0 +1,30 @@
+"""
+Budget parsing of the re-ranker: free-text User.budget_range into (min, max) prices.
+
+Run with: python -m pytest tests
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test.db")
+
+import pytest
+
+from src.reranker import parse_budget
+
+
+@pytest.mark.parametrize("budget_range, expected", [
+    ("até R$ 3.000", (None, 3000.0)),
+    ("R$ 1.000 - R$ 2.500", (1000.0, 2500.0)),
+    ("até R$ 300", (None, 300.0)),
+    ("R$ 1.299,90", (None, 1299.9)),
+    ("R$ 1.000.000", (None, 1000000.0)),
+    ("under $99.90", (None, 99.9)),
+    ("R$ 100-300", (100.0, 300.0)),
+    ("acima de 2.000", (2000.0, None)),
+    ("", (None, None)),
+    ("sem limite", (None, None)),
+])
+def test_parse_budget(budget_range, expected):
+    assert parse_budget(budget_range) == expected
@@ -0,0 +1,39 @@
+"""
+Reply cache lookups: exact and trigram-similar hits within a profile fingerprint.
+
+Run with: python -m pytest tests
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test.db")
+
+from src.response_cache import ResponseCache
+
+
+def make_cache() -> ResponseCache:
+    return ResponseCache(max_entries=100, ttl_seconds=60, similarity_threshold=0.8)
+
+
+def test_similar_message_hits():
+    cache = make_cache()
+    cache.put("profile", "Quero um tênis Nike de corrida", "reply")
+    assert cache.get("profile", "quero um tenis nike de corrida!") == "reply" # Exact after normalization
+    assert cache.get("profile", "quero uns tenis nike de corrida") == "reply"
+    assert cache.stats["similar_hits"] == 1
+
+
+def test_different_numbers_never_match():
+    cache = make_cache()
+    cache.put("profile", "tenis nike tamanho 42", "reply 42")
+    assert cache.get("profile", "tenis nike tamanho 40") is None
+    assert cache.get("profile", "tenis nike tamanho 42 ") == "reply 42"
+    assert cache.get("profile", "tenis nike tamanhos 42") == "reply 42"
+    assert cache.get("profile", "tenis nike tamanho") is None
+
+
+def test_other_profile_misses():
+    cache = make_cache()
+    cache.put("profile", "quero um presente", "reply")
+    assert cache.get("other", "quero um presente") is None